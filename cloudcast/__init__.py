@@ -5,17 +5,14 @@ Tools for loading and processing CloudCast templates into CloudFormation JSON te
 '''
 import json, os.path
 from cloudcast.elements import *
+import cloudcast._utils
+from cloudcast import tracing
 
 def _caller_folder():
     """
     Returns the folder where the code of the caller's caller lives
     """
-    import inspect
-    caller_file = inspect.stack()[2][1]
-    if os.path.exists(caller_file):
-        return os.path.abspath(os.path.dirname(caller_file))
-    else:
-        return os.path.abspath(os.getcwd())
+    return cloudcast._utils.frame_folder(2)
 
 def _run_resources_file(path, stack):
     """
@@ -53,9 +50,23 @@ def _run_resources_file(path, stack):
     sys.meta_path = old_meta_path
     sys.path = old_path
     for modname in sys.modules.keys():
-        if not modname in old_sys_modules:
+        if not modname in old_sys_modules and not _outlives_template(modname):
             del sys.modules[modname]
     return srcmodule
+
+def _outlives_template(modname):
+    """
+    Tells if a module first imported by a template is kept after loading it.
+    The cloudcast modules are: the objects the template creates with them
+    (ISCM modules, image registries...) are used later on, and python 2
+    clears the globals of the modules that are dropped, which breaks those
+    objects. Their caches are kept along too. Modules with stack elements
+    (cloudcast.library) and the template itself must be loaded afresh
+    """
+    if not modname.startswith("cloudcast."):
+        return False
+    return not (modname == "cloudcast.library" or modname.startswith("cloudcast.library.") or
+                modname.startswith("cloudcast._template_"))
     
 class _CustomJSONEncoder(json.JSONEncoder):
     """
@@ -72,6 +83,13 @@ class _CustomJSONEncoder(json.JSONEncoder):
         else:
             return super(self.__class__, self).default(o)
 
+def _expand_template(t):
+    """
+    Returns a plain copy of the given template object, where all the stack
+    elements and expressions have been expanded into JSON-ready data
+    """
+    return json.loads(_CustomJSONEncoder().encode(t))
+
 class _stackElements(object):
     """
     This class is a glorified dictionary of stack's elements
@@ -88,15 +106,18 @@ class _stackElements(object):
         """
         This function actually fills the stack with definitions coming from a template file
         """
-        srcmodule = _run_resources_file(path, stack)
+        with tracing.span("run_resources_file", path=path):
+            srcmodule = _run_resources_file(path, stack)
         # Process the loaded module and find the stack elements
-        elements = self.find_stack_elements(srcmodule)
+        with tracing.span("find_stack_elements"):
+            elements = self.find_stack_elements(srcmodule)
         elements = sorted(elements, key=lambda x: x[:-1])
         # Assign a name to each element and add to our dictionaries
-        for (module_name, el_name, element) in elements:
-            full_name = self.generate_cfn_name(module_name, el_name)
-            self.name_stack_element(element, full_name)
-            self.add_stack_element(element)
+        with tracing.span("name_stack_elements", count=len(elements)):
+            for (module_name, el_name, element) in elements:
+                full_name = self.generate_cfn_name(module_name, el_name)
+                self.name_stack_element(element, full_name)
+                self.add_stack_element(element)
         
     def find_stack_elements(self, module, module_name="", _visited_modules=None):
         """
@@ -171,14 +192,17 @@ class _stackElements(object):
         """
         Add resource definitions to the given template object
         """
+        def contents(e):
+            with tracing.span("contents", e):
+                return e.contents(stack)
         if len(self.Parameters) > 0:
-            t['Parameters'] = dict([e.contents(stack) for e in self.Parameters])
+            t['Parameters'] = dict([contents(e) for e in self.Parameters])
         if len(self.Mappings) > 0:
-            t['Mappings'] = dict([e.contents(stack) for e in self.Mappings])
+            t['Mappings'] = dict([contents(e) for e in self.Mappings])
         if len(self.Resources) > 0:
-            t['Resources'] = dict([e.contents(stack) for e in self.Resources])
+            t['Resources'] = dict([contents(e) for e in self.Resources])
         if len(self.Outputs) > 0:
-            t['Outputs'] = dict([e.contents(stack) for e in self.Outputs])
+            t['Outputs'] = dict([contents(e) for e in self.Outputs])
 
 class Stack(object):
     """
@@ -189,6 +213,9 @@ class Stack(object):
         self.description = None
         self.required_capabilities = []
         self.env = {}
+        self.hoist_report = None
+        self.template_hash = None
+        self.image_registry = None
         self.elements = _stackElements()
         # Obtain base dir of the caller, if available
         self.base_dir = _caller_folder()
@@ -197,6 +224,9 @@ class Stack(object):
             self.description = kwargs["description"]
         if kwargs.has_key("env"):
             self.env = _env_dict(kwargs["env"])
+        if kwargs.has_key("image_registry"):
+            # See cloudcast.images
+            self.image_registry = kwargs["image_registry"]
         if kwargs.has_key("resources_file"):
             self.load_resources(kwargs["resources_file"])
 
@@ -222,7 +252,8 @@ class Stack(object):
                     break
                 # if path doesn't exist the function below will fail anyway
         #
-        self.elements.load_template_srcmodule(self, path)
+        with tracing.span("load_resources", path=path):
+            self.elements.load_template_srcmodule(self, path)
 
     def has_element(self, name):
         return self.elements.elements.has_key(name)
@@ -241,19 +272,69 @@ class Stack(object):
                 if not self.has_element(el_name) or not self.get_element(el_name) == val:
                     raise RuntimeError("Broken reference: " + str(val))
         
-    def dump_json(self, pretty=True):
+    def template_obj(self):
         """
-        Return a string representation of this CloudFormation template.
+        Returns the CloudFormation template as an object, before any helper
+        expressions in it are expanded
         """
-        # Build template
         t = {}
         t['AWSTemplateFormatVersion'] = '2010-09-09'        
         if self.description is not None:
             t['Description'] = self.description
-        self.elements.dump_to_template_obj(self, t)
+        with tracing.span("dump_to_template_obj"):
+            self.elements.dump_to_template_obj(self, t)
+        return t
 
-        return _CustomJSONEncoder(indent=2 if pretty else None,
-                                  sort_keys=False).encode(t)                                    
+    def dump_json(self, pretty=True, hoist_threshold=None, canonical=False):
+        """
+        Return a string representation of this CloudFormation template.
+
+        If hoist_threshold is given, string literals of at least that length
+        that are repeated across the template are moved into a generated
+        mapping. A summary of the savings is left in self.hoist_report
+
+        In canonical mode, the output is byte for byte the same whenever the
+        inputs are: keys are sorted and separators are fixed. The sha256 of
+        the output is left in self.template_hash, to be used as the key of
+        the template in caches, or for skipping updates of unchanged stacks
+        """
+        t = self.template_obj()
+        if canonical:
+            encoder = _CustomJSONEncoder(indent=2 if pretty else None,
+                                         separators=(',', ': ') if pretty else (',', ':'),
+                                         sort_keys=True)
+        else:
+            encoder = _CustomJSONEncoder(indent=2 if pretty else None,
+                                         sort_keys=False)
+        if hoist_threshold is None:
+            with tracing.span("encode"):
+                output = encoder.encode(t)
+        else:
+            from cloudcast._hoist import hoist_literals
+            with tracing.span("hoist_literals", threshold=hoist_threshold):
+                t = _expand_template(t)
+                bytes_before = len(encoder.encode(t))
+                hoisted = hoist_literals(t, hoist_threshold)
+            with tracing.span("encode"):
+                output = encoder.encode(t)
+            self.hoist_report = dict(
+                literals_hoisted = hoisted,
+                bytes_before = bytes_before,
+                bytes_after = len(output),
+                bytes_saved = bytes_before - len(output)
+            )
+        if canonical:
+            self.template_hash = template_hash(output)
+        return output
+
+def template_hash(output):
+    """
+    Returns the content hash (hex sha256) of a rendered template
+    """
+    import hashlib
+    if isinstance(output, unicode):
+        output = output.encode("utf-8")
+    return hashlib.sha256(output).hexdigest()
       
 class _env_dict(dict):
     def __init__(self, *args, **kw):
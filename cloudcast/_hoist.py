@@ -0,0 +1,104 @@
+'''
+Render-time common-subexpression pass: large string literals that are repeated
+across the template are hoisted into a generated Mapping, and each occurrence
+is replaced with a "Fn::FindInMap" lookup.
+
+@author: David Losada Carballo <david@tuxpiper.com>
+'''
+
+HOISTED_MAPPING_NAME = "CloudCastHoistedLiterals"
+DEFAULT_THRESHOLD = 512
+
+# CloudFormation limits the number of attributes in a mapping, so the
+# hoisted literals are spread over several top level keys
+_keys_per_group = 64
+
+# Intrinsic functions whose arguments must remain literal strings
+_literal_only_fns = [ "Ref", "Fn::GetAtt", "Fn::FindInMap", "Fn::GetAZs", "Condition" ]
+# Intrinsic functions whose first argument must remain a literal string: the
+# template string of Fn::Sub, the condition name of Fn::If and delimiters
+_literal_first_fns = [ "Fn::Sub", "Fn::If", "Fn::Join", "Fn::Split" ]
+
+def _hoisting_roots(t):
+    """
+    Yields the template sections where intrinsic functions are allowed, and
+    thus literals can be replaced by mapping lookups, as (container, key).
+    Of the outputs, that's only their value: descriptions, export names and
+    conditions must be literal
+    """
+    for res in t.get('Resources', {}).values():
+        for k in [ 'Properties', 'Metadata' ]:
+            if res.has_key(k):
+                yield (res, k)
+    for output in t.get('Outputs', {}).values():
+        if output.has_key('Value'):
+            yield (output, 'Value')
+
+def _walk_root(container, key, visit):
+    value = container[key]
+    if isinstance(value, basestring):
+        visit(container, key, value)
+    else:
+        _walk_literals(value, visit)
+
+def _walk_literals(obj, visit):
+    """
+    Calls visit(container, key, value) for every string value found inside
+    the given (expanded) object. Dictionary keys are never visited.
+    """
+    if type(obj) == dict:
+        if len(obj) == 1 and obj.keys()[0] in _literal_only_fns:
+            return
+        if len(obj) == 1 and obj.keys()[0] in _literal_first_fns:
+            args = obj.values()[0]
+            if type(args) != list:
+                return
+            items = list(enumerate(args))[1:]
+            obj = args
+        else:
+            items = obj.items()
+    elif type(obj) == list:
+        items = enumerate(obj)
+    else:
+        return
+    for (k, v) in items:
+        if isinstance(v, basestring):
+            visit(obj, k, v)
+        else:
+            _walk_literals(v, visit)
+
+def hoist_literals(t, threshold=DEFAULT_THRESHOLD):
+    """
+    Hoists repeated literals, at least threshold characters long, from the
+    given expanded template into a generated mapping. The template is
+    modified in place. Returns the number of distinct literals hoisted.
+    """
+    counts = {}
+    def count(container, key, value):
+        if len(value) >= threshold:
+            counts[value] = counts.get(value, 0) + 1
+    for (container, key) in _hoisting_roots(t):
+        _walk_root(container, key, count)
+    #
+    repeated = sorted([ v for (v, n) in counts.items() if n > 1 ])
+    if not repeated:
+        return 0
+    mappings = t.setdefault('Mappings', {})
+    if mappings.has_key(HOISTED_MAPPING_NAME):
+        raise RuntimeError("Mapping name %s is reserved for hoisted literals" % HOISTED_MAPPING_NAME)
+    mapping = {}
+    lookups = {}
+    for (i, literal) in enumerate(repeated):
+        group = "G%d" % (i / _keys_per_group)
+        key = "L%03d" % i
+        mapping.setdefault(group, {})[key] = literal
+        lookups[literal] = (group, key)
+    mappings[HOISTED_MAPPING_NAME] = mapping
+    #
+    def replace(container, key, value):
+        if lookups.has_key(value):
+            (group, lkey) = lookups[value]
+            container[key] = { "Fn::FindInMap": [ HOISTED_MAPPING_NAME, group, lkey ] }
+    for (container, key) in _hoisting_roots(t):
+        _walk_root(container, key, replace)
+    return len(repeated)
@@ -1,16 +1,29 @@
-import os.path
+import os.path, sys
+from contextlib import contextmanager
 
-def caller_folder():
+def frame_folder(depth=1):
     """
-    Returns the folder where the code of the caller's caller lives
+    Returns the folder of the code running the given number of frames up
+    the stack from the caller (0 being the caller itself). The current
+    directory is returned for code that isn't in a file
     """
-    import inspect
-    caller_file = inspect.stack()[2][1]
+    if hasattr(sys, "_getframe"):
+        caller_file = sys._getframe(depth + 1).f_code.co_filename
+    else:
+        import inspect
+        caller_file = inspect.stack(0)[depth + 1][1]
     if os.path.exists(caller_file):
         return os.path.abspath(os.path.dirname(caller_file))
     else:
         return os.path.abspath(os.getcwd())
 
+def caller_folder():
+    """
+    Returns the folder where the code of the caller's caller lives: the
+    folder of the template, or of the helper module, creating an ISCM module
+    """
+    return frame_folder(2)
+
 def search_file(filepath, *where):
     if not os.path.isabs(filepath):
         search_paths = map(lambda x: os.path.join(x, filepath), where)
@@ -31,6 +44,20 @@ def search_path(path, *where):
     else:
         return path    
 
+# Results of stat_cached, keyed by file and stat information
+_stat_cache = {}
+
+def stat_cached(path, compute, namespace=""):
+    """
+    Returns compute(path), which is only invoked again when the file's
+    stat information (inode, size, modification time) changes
+    """
+    st = os.stat(path)
+    key = (namespace, os.path.abspath(path), st.st_ino, st.st_size, st.st_mtime)
+    if not _stat_cache.has_key(key):
+        _stat_cache[key] = compute(path)
+    return _stat_cache[key]
+
 def walk_values(obj):
     if type(obj) == dict:
         for v in obj.values():
@@ -41,7 +68,6 @@ def walk_values(obj):
     else:
         yield obj
 
-from contextlib import contextmanager
 @contextmanager
 def in_mem_gzip_file(src_path, basename, mtime=0.0):
     from gzip import GzipFile
@@ -61,4 +87,99 @@ def in_mem_gzip(contents, basename, mtime=0.0):
     with GzipFile(filename=basename, mode="w", compresslevel=9, fileobj=stringbuf, mtime=mtime) as gz:
         gz.write(contents)
     yield stringbuf
-    stringbuf.close()
\ No newline at end of file
+    stringbuf.close()
+
+
+class DigestTree(object):
+    """
+    Merkle-style digest (sha256) of a nested data structure. The digest of
+    a dictionary or a list is computed from the digests of its members:
+
+      - string: sha256("s:" + utf-8 bytes)
+      - number, boolean or None: sha256("n:" + JSON representation)
+      - list or tuple: sha256("l:" + digests of the members, in order)
+      - dictionary: sha256("d:" + digest of each key and its value, sorted by key)
+      - any other object: the digest of the data it's rendered into in the
+        template (see cloudcast._expand_template), or sha256("o:" +
+        repr(object)) for helper expressions and what can't be rendered
+
+    Plain data subtrees are digested once, when the tree is built, so the
+    data shouldn't be modified afterwards. Subtrees with other objects
+    (i.e. CloudFormation expressions, whose representation depends on the
+    names that stack elements get later) are digested on every call.
+    DigestTrees may be nested in the data of other DigestTrees.
+    """
+    def __init__(self, obj):
+        self.node = _digest_node(obj)
+
+    def hexdigest(self):
+        return _digest_eval(self.node)
+
+class DigestedStr(str):
+    """
+    String that carries its own digest (as computed by DigestTree), so
+    large contents that have been digested before aren't hashed again
+    """
+    def __new__(cls, value, digest=None):
+        s = str.__new__(cls, value)
+        s.digest = digest if digest is not None else _sha256("s:", value)
+        return s
+
+def _sha256(prefix, data):
+    import hashlib
+    return hashlib.sha256(prefix + data).hexdigest()
+
+def _digest_node(obj):
+    # Nodes are ("h", hexdigest) for plain data subtrees, ("o", object),
+    # ("l", [ nodes ]) or ("d", [ (key digest, node) ]), sorted by key
+    import json
+    if isinstance(obj, DigestTree):
+        return obj.node
+    if isinstance(obj, DigestedStr):
+        return ("h", obj.digest)
+    if isinstance(obj, basestring):
+        return ("h", _sha256("s:", obj.encode("utf-8") if isinstance(obj, unicode) else obj))
+    if obj is None or type(obj) in (bool, int, long, float):
+        return ("h", _sha256("n:", json.dumps(obj)))
+    if type(obj) in (list, tuple):
+        children = [ _digest_node(v) for v in obj ]
+        if all([ c[0] == "h" for c in children ]):
+            return ("h", _sha256("l:", "".join([ c[1] for c in children ])))
+        return ("l", children)
+    if type(obj) == dict:
+        children = [ (_digest_node(k)[1], _digest_node(obj[k])) for k in sorted(obj.keys()) ]
+        if all([ c[0] == "h" for (k, c) in children ]):
+            return ("h", _sha256("d:", "".join([ k + c[1] for (k, c) in children ])))
+        return ("d", children)
+    return ("o", obj)
+
+def _digest_eval(node):
+    (kind, value) = node
+    if kind == "h":
+        return value
+    if kind == "o":
+        return _object_digest(value)
+    if kind == "l":
+        return _sha256("l:", "".join([ _digest_eval(c) for c in value ]))
+    return _sha256("d:", "".join([ k + _digest_eval(c) for (k, c) in value ]))
+
+def _object_digest(obj):
+    # Stack elements and expressions are digested as they're rendered, as
+    # their representation may hold their address in memory. Helper
+    # expressions are only rendered once resolved for a resource, their
+    # representation tells what they are
+    from cloudcast import _expand_template
+    from cloudcast.elements import CloudCastHelperExpr
+    if isinstance(obj, CloudCastHelperExpr):
+        return _sha256("o:", repr(obj))
+    try:
+        data = _expand_template(obj)
+    except (TypeError, ValueError):
+        return _sha256("o:", repr(obj))
+    return _digest_node(data)[1]
+
+def stable_digest(obj):
+    """
+    Returns the Merkle-style digest of a nested data structure, see DigestTree
+    """
+    return DigestTree(obj).hexdigest()
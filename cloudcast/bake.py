@@ -0,0 +1,182 @@
+'''
+Planning of image bakes for the buildable launchables of a stack.
+
+Launchables whose PhasedISCMs start with the same phases share the status
+ids of their first entry points. The entry points of all the launchables
+are merged into a prefix trie, one per base image, where each node is a
+status id. The plan bakes the deepest entry point of each launchable, and
+the intermediate images where the paths of several launchables part ways,
+so the phases they share are only run once:
+
+  ""  --[Config, Base, Web]-->  s2  --[Config, AppA]-->  s3a  (WebA)
+                                    --[Config, AppB]-->  s3b  (WebB)
+
+Images already found in an image registry (see cloudcast.images) are not
+baked again, and bakes start from them when possible.
+
+@author: David Losada Carballo <david@tuxpiper.com>
+'''
+
+# Estimates, in seconds, used when there are no timings available
+DEFAULT_PHASE_DURATION = 120
+IMAGE_OVERHEAD = 300        # Launching the builder instance and creating the image
+
+class _TrieNode(object):
+    def __init__(self, status_id):
+        self.status_id = status_id
+        self.children = []
+        self.targets = {}       # target status id -> phases to run from this node to get there
+        self.launchables = []   # Launchables whose deepest entry point is this node
+        self.image_id = None    # Image already registered for this node
+
+    def child(self, status_id):
+        for c in self.children:
+            if c.status_id == status_id:
+                return c
+        c = _TrieNode(status_id)
+        self.children.append(c)
+        return c
+
+    def is_pending(self):
+        # There's something to bake in this subtree
+        if self.launchables and self.image_id is None:
+            return True
+        return any([ c.is_pending() for c in self.children ])
+
+    def needs_source(self):
+        # Baking this subtree would start from an image above this node
+        if self.image_id is not None:
+            return False
+        return len(self.launchables) > 0 or any([ c.needs_source() for c in self.children ])
+
+def _base_image_key(launchable, region):
+    """
+    Returns the base image of the launchable in the given region. If it
+    can't be resolved to an image id, its expanded expression (as JSON) is
+    returned, and the second member of the returned tuple is False.
+    """
+    import json
+    from cloudcast import _expand_template
+    try:
+        ami = launchable.resolve_ami(region=region)
+    except (KeyError, AttributeError, TypeError):
+        ami = launchable.get_property("ImageId")
+    if isinstance(ami, basestring):
+        return (ami, True)
+    return (json.dumps(_expand_template(ami), sort_keys=True), False)
+
+def phase_durations_from_report(report, stat="p90"):
+    """
+    Given a latency report of boot timings (see cloudcast.iscm.timing), returns
+    the duration of each phase, as the given statistic of its configset step.
+    The configsets are only timed one by one when the instances are built
+    with time_configsets (see cloudcast.iscm.cfninit.CfnInitISCM)
+    """
+    durations = {}
+    for (step, st) in report.items():
+        if step.startswith("cfninit:"):
+            durations[step[len("cfninit:"):]] = st[stat]
+    return durations
+
+class BakePlan(object):
+    """
+    An ordered list of image bakes. Each step is a dictionary:
+
+      { base_image, source, target, run_phases, launchables, estimated_time }
+
+    where source and target are status ids ("" being the base image), and
+    launchables lists the names of the launchables that boot from the
+    target image. Sources are always baked (or registered) before they are
+    used.
+    """
+    def __init__(self, phase_durations=None, image_overhead=IMAGE_OVERHEAD):
+        self.steps = []
+        self.phase_durations = phase_durations or {}
+        self.image_overhead = image_overhead
+        self.unshared_time = 0  # Time to bake each launchable's image on its own
+
+    def estimate(self, phase_names):
+        return self.image_overhead + sum([ self.phase_durations.get(p, DEFAULT_PHASE_DURATION) for p in phase_names ])
+
+    @property
+    def estimated_time(self):
+        return sum([ s["estimated_time"] for s in self.steps ])
+
+    def add_step(self, base_image, source, target, run_phases, launchables):
+        phase_names = [ p.phase_name for p in run_phases ]
+        self.steps.append(dict(base_image=base_image, source=source, target=target,
+                               run_phases=phase_names, launchables=launchables,
+                               estimated_time=self.estimate(phase_names)))
+
+    def format(self):
+        """
+        Returns the plan as text, one line per bake
+        """
+        lines = []
+        for (k, s) in enumerate(self.steps):
+            lines.append("%2d. %s %s -> %s [%s] %.0fs %s" % (k + 1, s["base_image"],
+                s["source"][:12] or "(base)", s["target"][:12], ", ".join(s["run_phases"]),
+                s["estimated_time"], " ".join(s["launchables"])))
+        lines.append("estimated time: %.0fs (%.0fs without sharing images)" % (self.estimated_time, self.unshared_time))
+        return "\n".join(lines)
+
+def plan_bakes(stack, region=None, registry=None, phase_durations=None, image_overhead=IMAGE_OVERHEAD):
+    """
+    Returns the BakePlan for the buildable launchables of the given stack.
+    The base images are resolved for the given region (the registry's
+    region by default). phase_durations maps phase names to their expected
+    duration in seconds.
+    """
+    from cloudcast.iscm.phased import PURPOSE_BUILD
+    if registry is not None and region is None:
+        region = registry.region
+    plan = BakePlan(phase_durations, image_overhead)
+    roots = []
+    #
+    # Build the tries
+    for launchable in stack.get_launchable_resources():
+        if not launchable.is_buildable():
+            continue
+        stages = launchable.iscm.get_possible_builds(purpose=PURPOSE_BUILD)
+        if not stages[0]["status_id"]:
+            continue    # No entry point to bake
+        (base_image, resolved) = _base_image_key(launchable, region)
+        root = None
+        for r in roots:
+            if r.base_image == base_image:
+                root = r
+        if root is None:
+            root = _TrieNode("")
+            root.base_image = base_image
+            root.resolved = resolved
+            roots.append(root)
+        # Stages come deepest first
+        node = root
+        for stage in reversed(stages):
+            if stage["status_id"]:
+                node = node.child(stage["status_id"])
+            for t in stage["targets"]:
+                node.targets[t["target_id"]] = t["run_phases"]
+        node.launchables.append(launchable.ref_name)
+        plan.unshared_time += plan.estimate([ p.phase_name for p in root.targets[node.status_id] ])
+    #
+    # Walk them, baking the targets and the nodes where paths part ways
+    def walk(root, node, source):
+        if node.image_id is not None:
+            source = node
+        elif node is not root and (node.launchables or len(filter(lambda c: c.needs_source(), node.children)) > 1):
+            plan.add_step(root.base_image, source.status_id, node.status_id,
+                          source.targets[node.status_id], node.launchables)
+            source = node
+        for c in node.children:
+            if c.is_pending():
+                walk(root, c, source)
+    def lookup(root, node):
+        for c in node.children:
+            c.image_id = registry.lookup(c.status_id, root.base_image if root.resolved else None)
+            lookup(root, c)
+    for root in roots:
+        if registry is not None:
+            lookup(root, root)
+        walk(root, root, root)
+    return plan
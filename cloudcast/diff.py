@@ -0,0 +1,341 @@
+'''
+Offline classification of the impact of updating a stack, by comparing a
+new render of its template with the previous one.
+
+Each resource that changes is classified by the most disruptive of its
+changes, going by how CloudFormation updates each property of the
+resource type (see UPDATE_BEHAVIOURS):
+
+  update     updated in place, without interruption (i.e. only the
+             metadata changed, which is what cfn-hup picks up)
+  interrupt  updated in place, with some interruption (i.e. the instance
+             is stopped and started again)
+  replace    a new resource is created, and the old one deleted
+
+Properties missing from the table are taken to require replacement, and
+are marked as assumed. Resources whose properties refer to a resource
+being replaced (its physical id, or attributes, will change), or to a
+parameter or mapping that changed, are classified as if those properties
+had changed.
+
+  changes = diff_stack(stack, "previous.json")
+  if changes.is_empty:
+      ... skip the update call
+  print changes.format()
+
+@author: David Losada Carballo <david@tuxpiper.com>
+'''
+
+import json
+
+NO_CHANGE = "none"
+UPDATE = "update"
+INTERRUPT = "interrupt"
+REPLACE = "replace"
+ADD = "add"
+REMOVE = "remove"
+
+# From least to most disruptive
+_impact_order = [ NO_CHANGE, UPDATE, INTERRUPT, REPLACE ]
+
+# Order of the resources in change sets
+_listing_order = [ REPLACE, REMOVE, ADD, INTERRUPT, UPDATE ]
+
+# Resource attributes that don't affect the physical resource
+_update_only_attributes = [ "Metadata", "DependsOn", "DeletionPolicy", "UpdatePolicy", "CreationPolicy", "Condition" ]
+
+# How changes to each property are applied, per resource type. Types whose
+# properties all behave the same can use "*"
+UPDATE_BEHAVIOURS = {
+    "AWS::EC2::Instance": {
+        "AvailabilityZone": REPLACE,
+        "BlockDeviceMappings": REPLACE,
+        "DisableApiTermination": UPDATE,
+        "EbsOptimized": INTERRUPT,
+        "IamInstanceProfile": REPLACE,
+        "ImageId": REPLACE,
+        "InstanceInitiatedShutdownBehavior": UPDATE,
+        "InstanceType": INTERRUPT,
+        "KernelId": INTERRUPT,
+        "KeyName": REPLACE,
+        "Monitoring": UPDATE,
+        "NetworkInterfaces": REPLACE,
+        "PlacementGroupName": REPLACE,
+        "PrivateIpAddress": REPLACE,
+        "RamdiskId": INTERRUPT,
+        "SecurityGroupIds": UPDATE,
+        "SecurityGroups": REPLACE,
+        "SourceDestCheck": UPDATE,
+        "SubnetId": REPLACE,
+        "Tags": UPDATE,
+        "Tenancy": REPLACE,
+        # The ISCM boot sequence only runs when the instance is launched
+        "UserData": REPLACE,
+        "Volumes": UPDATE,
+    },
+    "AWS::AutoScaling::LaunchConfiguration": {
+        "*": REPLACE,
+    },
+    "AWS::AutoScaling::AutoScalingGroup": {
+        "AvailabilityZones": UPDATE,
+        "Cooldown": UPDATE,
+        "DesiredCapacity": UPDATE,
+        "HealthCheckGracePeriod": UPDATE,
+        "HealthCheckType": UPDATE,
+        "InstanceId": REPLACE,
+        "LaunchConfigurationName": UPDATE,
+        "LoadBalancerNames": REPLACE,
+        "MaxSize": UPDATE,
+        "MetricsCollection": UPDATE,
+        "MinSize": UPDATE,
+        "NotificationConfiguration": UPDATE,
+        "Tags": UPDATE,
+        "TerminationPolicies": UPDATE,
+        "VPCZoneIdentifier": UPDATE,
+    },
+    "AWS::CloudFormation::WaitCondition": {
+        "*": REPLACE,
+    },
+    "AWS::CloudFormation::WaitConditionHandle": {
+        "*": REPLACE,
+    },
+    "AWS::EC2::EIP": {
+        "Domain": REPLACE,
+        "InstanceId": UPDATE,
+    },
+    "AWS::EC2::SecurityGroup": {
+        "GroupDescription": REPLACE,
+        "SecurityGroupEgress": UPDATE,
+        "SecurityGroupIngress": UPDATE,
+        "Tags": UPDATE,
+        "VpcId": REPLACE,
+    },
+    "AWS::ElasticLoadBalancing::LoadBalancer": {
+        "AccessLoggingPolicy": UPDATE,
+        "AppCookieStickinessPolicy": UPDATE,
+        "AvailabilityZones": UPDATE,
+        "ConnectionDrainingPolicy": UPDATE,
+        "CrossZone": UPDATE,
+        "HealthCheck": UPDATE,
+        "Instances": UPDATE,
+        "LBCookieStickinessPolicy": UPDATE,
+        "Listeners": UPDATE,
+        "LoadBalancerName": REPLACE,
+        "Policies": UPDATE,
+        "Scheme": REPLACE,
+        "SecurityGroups": UPDATE,
+        "Subnets": UPDATE,
+        "Tags": UPDATE,
+    },
+    "AWS::IAM::AccessKey": {
+        "Serial": REPLACE,
+        "Status": UPDATE,
+        "UserName": REPLACE,
+    },
+    "AWS::IAM::User": {
+        "*": UPDATE,
+    },
+    "AWS::SQS::Queue": {
+        "DelaySeconds": UPDATE,
+        "MaximumMessageSize": UPDATE,
+        "MessageRetentionPeriod": UPDATE,
+        "QueueName": REPLACE,
+        "ReceiveMessageWaitTimeSeconds": UPDATE,
+        "RedrivePolicy": UPDATE,
+        "VisibilityTimeout": UPDATE,
+    },
+}
+
+def _more_disruptive(a, b):
+    return a if _impact_order.index(a) >= _impact_order.index(b) else b
+
+def _property_behaviour(behaviours, res_type, prop):
+    """
+    Returns (behaviour, assumed) for changes to the given property
+    """
+    table = behaviours.get(res_type, {})
+    if table.has_key(prop):
+        return (table[prop], False)
+    if table.has_key("*"):
+        return (table["*"], False)
+    return (REPLACE, True)
+
+def _references(obj):
+    """
+    Returns the names referred to by Ref, Fn::GetAtt and Fn::FindInMap
+    expressions inside the given (expanded) object
+    """
+    names = set()
+    if type(obj) == dict:
+        if len(obj) == 1:
+            (fn, arg) = obj.items()[0]
+            if fn == "Ref" and isinstance(arg, basestring):
+                names.add(arg)
+            elif fn == "Fn::GetAtt" and type(arg) == list and arg:
+                names.add(arg[0])
+            elif fn == "Fn::FindInMap" and type(arg) == list and arg and isinstance(arg[0], basestring):
+                names.add(arg[0])
+        for v in obj.values():
+            names.update(_references(v))
+    elif type(obj) == list:
+        for v in obj:
+            names.update(_references(v))
+    return names
+
+class ChangeSet(object):
+    """
+    The differences between two renders. resources lists a dictionary for
+    each resource that changes:
+
+      { name, type, action, impact, properties }
+
+    where action is add, remove or modify. The impact of added and removed
+    resources is their action. For modified resources, properties lists a
+    dictionary for each property (or resource attribute) that changes, or
+    refers to something that changes:
+
+      { name, behaviour, assumed, cause }
+
+    cause being "changed", or the name of the changed element referred to.
+    others lists the paths of the changes outside of the resources (i.e.
+    "Outputs/QueueUrl").
+    """
+    def __init__(self, identical):
+        self.identical = identical
+        self.resources = []
+        self.others = []
+
+    @property
+    def is_empty(self):
+        """
+        True if there's nothing to update
+        """
+        return self.identical
+
+    def by_impact(self, impact):
+        return [ r["name"] for r in self.resources if r["impact"] == impact ]
+
+    def format(self):
+        """
+        Returns the changes as text, one line per resource followed by
+        its changed properties
+        """
+        if self.is_empty:
+            return "no changes"
+        lines = []
+        for r in self.resources:
+            lines.append("%-9s %-7s %s (%s)" % (r["impact"], r["action"], r["name"], r["type"]))
+            for p in r["properties"]:
+                lines.append("            %-9s %s%s%s" % (p["behaviour"], p["name"],
+                    "" if p["cause"] == "changed" else " [refers to %s]" % p["cause"],
+                    " [assumed]" if p["assumed"] else ""))
+        for path in self.others:
+            lines.append("%-9s %-7s %s" % ("", "modify", path))
+        return "\n".join(lines)
+
+def diff_templates(old, new, behaviours=None):
+    """
+    Compares two expanded templates (as decoded from their JSON) and
+    returns the ChangeSet. behaviours extends or overrides UPDATE_BEHAVIOURS.
+    """
+    table = dict(UPDATE_BEHAVIOURS)
+    if behaviours is not None:
+        table.update(behaviours)
+    changes = ChangeSet(identical=(old == new))
+    if changes.identical:
+        return changes
+    #
+    # Changes outside of the resources
+    changed_names = set()
+    for key in sorted(set(old.keys() + new.keys())):
+        if key == "Resources":
+            continue
+        (o, n) = (old.get(key), new.get(key))
+        if type(o) == dict and type(n) == dict:
+            for name in sorted(set(o.keys() + n.keys())):
+                if o.get(name) != n.get(name):
+                    changes.others.append("%s/%s" % (key, name))
+                    if key in [ "Parameters", "Mappings" ]:
+                        changed_names.add(name)
+        elif o != n:
+            changes.others.append(key)
+    #
+    old_res = old.get("Resources", {})
+    new_res = new.get("Resources", {})
+    modified = {}
+    for name in sorted(set(old_res.keys() + new_res.keys())):
+        if not new_res.has_key(name):
+            changes.resources.append(dict(name=name, type=old_res[name].get("Type"), action=REMOVE,
+                                          impact=REMOVE, properties=[]))
+        elif not old_res.has_key(name):
+            changes.resources.append(dict(name=name, type=new_res[name].get("Type"), action=ADD,
+                                          impact=ADD, properties=[]))
+        else:
+            modified[name] = dict(name=name, type=new_res[name].get("Type"), action="modify",
+                                  impact=NO_CHANGE, properties=[])
+    # Direct changes
+    for (name, r) in modified.items():
+        (o, n) = (old_res[name], new_res[name])
+        if o.get("Type") != n.get("Type"):
+            r["properties"].append(dict(name="Type", behaviour=REPLACE, assumed=False, cause="changed"))
+        (op, np) = (o.get("Properties", {}), n.get("Properties", {}))
+        for prop in sorted(set(op.keys() + np.keys())):
+            if op.get(prop) != np.get(prop):
+                (behaviour, assumed) = _property_behaviour(table, r["type"], prop)
+                r["properties"].append(dict(name=prop, behaviour=behaviour, assumed=assumed, cause="changed"))
+        for attr in _update_only_attributes:
+            if o.get(attr) != n.get(attr):
+                r["properties"].append(dict(name=attr, behaviour=UPDATE, assumed=False, cause="changed"))
+    # Changes through references, until no more replacements are found
+    replaced = set(changed_names)
+    for r in changes.resources:
+        if r["action"] == REMOVE:
+            replaced.add(r["name"])
+    pending = True
+    while pending:
+        pending = False
+        for (name, r) in modified.items():
+            for p in r["properties"]:
+                r["impact"] = _more_disruptive(r["impact"], p["behaviour"])
+            if r["impact"] == REPLACE and name not in replaced:
+                replaced.add(name)
+                pending = True
+        for (name, r) in modified.items():
+            np = new_res[name].get("Properties", {})
+            listed = [ p["name"] for p in r["properties"] ]
+            for prop in sorted(np.keys()):
+                if prop in listed:
+                    continue
+                refs = sorted(_references(np[prop]) & replaced)
+                if refs:
+                    (behaviour, assumed) = _property_behaviour(table, r["type"], prop)
+                    r["properties"].append(dict(name=prop, behaviour=behaviour, assumed=assumed, cause=refs[0]))
+                    pending = True
+            for attr in _update_only_attributes:
+                refs = sorted(_references(new_res[name].get(attr)) & replaced)
+                if attr not in listed and refs:
+                    r["properties"].append(dict(name=attr, behaviour=UPDATE, assumed=False, cause=refs[0]))
+    #
+    changes.resources += [ r for r in modified.values() if r["properties"] ]
+    changes.resources.sort(key=lambda r: (_listing_order.index(r["impact"]), r["name"]))
+    return changes
+
+def load_template(path):
+    with open(path, "r") as f:
+        return json.load(f)
+
+def rendered_template(stack):
+    """
+    Returns the template of the given stack, as it would be decoded from
+    its JSON
+    """
+    return json.loads(stack.dump_json(pretty=False))
+
+def diff_stack(stack, previous, behaviours=None):
+    """
+    Compares the render of the given stack with a previous render, given
+    as the path of its JSON file or as the decoded template
+    """
+    if isinstance(previous, basestring):
+        previous = load_template(previous)
+    return diff_templates(previous, rendered_template(stack), behaviours)
@@ -105,6 +105,21 @@ class ThisResourceExpr(CloudCastHelperExpr):
     def __repr__(self):
         return "<ThisResourceExpr>"
 
+def fresh_helper_exprs(obj):
+    """
+    Returns a copy of the given object where helper expressions are
+    replaced by copies of their own, so they can be resolved for a
+    different resource. Dictionaries, lists and tuples are copied along the
+    way. Everything else is shared with the original object.
+    """
+    if isinstance(obj, CloudCastHelperExpr):
+        return copy.copy(obj)
+    if type(obj) == dict:
+        return dict([ (k, fresh_helper_exprs(v)) for (k, v) in obj.iteritems() ])
+    if type(obj) in [ list, tuple ]:
+        return type(obj)([ fresh_helper_exprs(v) for v in obj ])
+    return obj
+
 class StackElement(object):
     """
     Class for elements that appear in the stack definition, this includes
@@ -252,11 +267,18 @@ class Resource(StackElement):
             return default
         return self.el_attrs['Metadata'][key]
         
-    def contents(self, stack):
-        # Find and resolve helper expressions before dumping the contents
+    def resolve_helper_exprs(self, stack, obj):
+        """
+        Resolves the helper expressions found in the given object, in the
+        context of this resource
+        """
         from cloudcast._utils import walk_values
-        for value in walk_values(self.el_attrs):
+        for value in walk_values(obj):
             if isinstance(value, CloudCastHelperExpr): value.resolve(stack, self)
+
+    def contents(self, stack):
+        # Find and resolve helper expressions before dumping the contents
+        self.resolve_helper_exprs(stack, self.el_attrs)
         #
         # Dump the contents
         return (self.ref_name, self.el_attrs)
@@ -275,10 +297,14 @@ class Resource(StackElement):
 class LaunchableResource(Resource):
     def __init__(self, restype, **kwargs):
         self.iscm = None
+        self.selected_image = None  # Baked image picked from the stack's image registry
+        self.iscm_applied = False
         if kwargs.has_key("iscm"):
             # If an SCM spec is given, build it
-            from cloudcast.iscm import ISCM
-            if isinstance(kwargs["iscm"], ISCM):
+            from cloudcast.iscm import ISCM, ISCMPrototype
+            if isinstance(kwargs["iscm"], ISCMPrototype):
+                self.iscm = kwargs["iscm"].bind()
+            elif isinstance(kwargs["iscm"], ISCM):
                 self.iscm = kwargs["iscm"]
             else:
                 self.iscm = ISCM(kwargs["iscm"])
@@ -286,9 +312,19 @@ class LaunchableResource(Resource):
         Resource.__init__(self, restype, **kwargs)
     
     def contents(self, stack):
-        # Before "spilling the beans", let the iscm update this element
-        if self.iscm is not None:
-            self.iscm.apply_to(self)
+        # Before "spilling the beans", let the iscm update this element.
+        # That's when the iscm is deployed, and it's only done once
+        if self.iscm is not None and not self.iscm_applied:
+            # Boot from the deepest baked image available, if the stack has
+            # an image registry
+            from cloudcast import tracing
+            registry = getattr(stack, "image_registry", None)
+            if registry is not None and self.is_buildable():
+                with tracing.span("select_image", self):
+                    self.selected_image = registry.apply_to(self)
+            with tracing.span("iscm_apply", self):
+                self.iscm.apply_to(self)
+            self.iscm_applied = True
         # Proceed with dumping the contents
         return Resource.contents(self, stack)
 
@@ -0,0 +1,168 @@
+'''
+Registry of baked images.
+
+Images baked from a PhasedISCM are recorded against the status id of the
+entry point they were baked up to (see PhasedISCM.get_possible_builds), the
+region where they live and the base image they were baked from.
+
+When a stack is given an image registry, each buildable launchable is
+rendered from the registered image that covers the most phases: its ImageId
+is replaced with the baked image, and only the remaining phases are run on
+boot.
+
+The registry backends in this module are local stand-ins, keeping the
+records in a JSON file or a sqlite database. Other backends (i.e. one
+querying image tags) only need to implement _find and _store.
+
+@author: David Losada Carballo <david@tuxpiper.com>
+'''
+
+class ImageRegistry(object):
+    """
+    Base class for image registries. Each registry instance serves the
+    images of one region. With prune_baked, launchables booting from baked
+    images don't carry the configuration of the phases already baked (see
+    PhasedISCM.set_entry_point)
+    """
+    def __init__(self, region=None, prune_baked=True):
+        self.region = region
+        self.prune_baked = prune_baked
+
+    def _find(self, status_id):
+        """
+        Returns the records registered for the given status id in this
+        registry's region
+        """
+        raise NotImplementedError("This is for subclasses to sort out")
+
+    def _store(self, record):
+        raise NotImplementedError("This is for subclasses to sort out")
+
+    def register(self, status_id, image_id, base_image=None):
+        """
+        Records an image that has been baked up to the given status id
+        """
+        import time
+        if not status_id:
+            raise RuntimeError("Base images can't be registered, they have no status id")
+        self._store(dict(region=self.region or "", status_id=status_id,
+                         base_image=base_image or "", image_id=image_id,
+                         created=time.time()))
+
+    def lookup(self, status_id, base_image=None):
+        """
+        Returns the latest image registered for the given status id, or None.
+        If a base image is given, images baked from other base images are
+        ignored.
+        """
+        records = [ r for r in self._find(status_id)
+                    if not base_image or not r["base_image"] or r["base_image"] == base_image ]
+        if not records:
+            return None
+        return max(records, key=lambda r: r["created"])["image_id"]
+
+    def select(self, launchable):
+        """
+        Returns the deepest entry point of the launchable's ISCM that has an
+        image registered, as a dictionary:
+
+          { status_id, image_id, run_phases }
+
+        or None if there is no such image.
+        """
+        if not launchable.is_buildable():
+            return None
+        try:
+            base_image = launchable.resolve_ami(region=self.region)
+        except (KeyError, AttributeError, TypeError):
+            base_image = None
+        if not isinstance(base_image, basestring):
+            base_image = None
+        for build in launchable.iscm.get_possible_builds():
+            if not build["status_id"]:
+                break
+            image_id = self.lookup(build["status_id"], base_image)
+            if image_id is not None:
+                return dict(status_id=build["status_id"], image_id=image_id,
+                            run_phases=build["run_phases"])
+        return None
+
+    def apply_to(self, launchable):
+        """
+        Makes the launchable boot from the deepest registered image, running
+        only the phases that weren't baked into it. Returns the selection
+        made, if any.
+        """
+        selected = self.select(launchable)
+        if selected is not None:
+            launchable.add_property("ImageId", selected["image_id"])
+            launchable.iscm.set_entry_point(selected["status_id"], self.prune_baked)
+        return selected
+
+class JSONImageRegistry(ImageRegistry):
+    """
+    Image registry kept in a JSON file
+    """
+    def __init__(self, path, region=None, prune_baked=True):
+        ImageRegistry.__init__(self, region, prune_baked)
+        self.path = path
+
+    def _load(self):
+        import json, os.path
+        if not os.path.exists(self.path):
+            return []
+        with open(self.path, "r") as f:
+            return json.load(f)["images"]
+
+    def _find(self, status_id):
+        return [ r for r in self._load()
+                 if r["status_id"] == status_id and r["region"] == (self.region or "") ]
+
+    def _store(self, record):
+        import json, os
+        records = self._load() + [ record ]
+        # Write then rename, so readers never see a partial file
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(dict(images=records), f, indent=2, sort_keys=True)
+        os.rename(tmp_path, self.path)
+
+class SqliteImageRegistry(ImageRegistry):
+    """
+    Image registry kept in a sqlite database
+    """
+    _columns = [ "region", "status_id", "base_image", "image_id", "created" ]
+
+    def __init__(self, path, region=None, prune_baked=True):
+        ImageRegistry.__init__(self, region, prune_baked)
+        self.path = path
+        conn = self._connect()
+        try:
+            with conn:
+                conn.execute("CREATE TABLE IF NOT EXISTS images ("
+                             "region TEXT, status_id TEXT, base_image TEXT, image_id TEXT, created REAL)")
+                conn.execute("CREATE INDEX IF NOT EXISTS images_status ON images (region, status_id)")
+        finally:
+            conn.close()
+
+    def _connect(self):
+        import sqlite3
+        return sqlite3.connect(self.path)
+
+    def _find(self, status_id):
+        conn = self._connect()
+        try:
+            rows = conn.execute("SELECT %s FROM images WHERE region = ? AND status_id = ?" %
+                                ", ".join(self._columns), (self.region or "", status_id)).fetchall()
+        finally:
+            conn.close()
+        return [ dict(zip(self._columns, row)) for row in rows ]
+
+    def _store(self, record):
+        conn = self._connect()
+        try:
+            with conn:
+                conn.execute("INSERT INTO images (%s) VALUES (?, ?, ?, ?, ?)" % ", ".join(self._columns),
+                             [ record[c] for c in self._columns ])
+        finally:
+            conn.close()
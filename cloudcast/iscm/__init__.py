@@ -1,7 +1,40 @@
 #!/usr/bin/python
 
 import string
+from collections import Mapping
 from cloudcast.template import join as cfnjoin
+from cloudcast.elements import fresh_helper_exprs
+from cloudcast import tracing
+from cloudcast.iscm.timing import timing_sh
+
+# Version of the minimal userdata emitted in bootstrap stub mode. Bump it
+# whenever the stub itself changes, as that forces instance replacement
+BOOTSTRAP_STUB_VERSION = 7
+# Metadata key holding the boot payload, when in bootstrap stub mode
+BOOTSTRAP_PAYLOAD_MD_KEY = "CloudCast::ISCM"
+
+_userdata_header = "\n".join([
+    r'#!/bin/bash',
+    # Fatal errors are signaled right away, when there's a wait condition
+    # handle, otherwise the stack would wait for the signal until it times out
+    r'FATAL() { code=$1; shift; echo "[FATAL] $*" >&2; iscm_cfn_signal $code; exit $code; }',
+    r'ERROR() { echo "[ERROR] $*" >&2 ; }',
+    r'WARN()  { echo "[WARNING] $*" >&2 ; }',
+    r'INFO()  { echo "[INFO] $*" >&2 ; }',
+    timing_sh,
+    # Retries a command with exponential backoff and full jitter, within the
+    # retry budget, to survive CloudFormation API throttling at scale-out
+    r'iscm_retry() {',
+    r'  local budget=${ISCM_API_RETRIES:-5} base=${ISCM_API_BACKOFF:-2} n=1',
+    r'  until "$@"; do',
+    r'    [ $n -ge $budget ] && { WARN "$1 failed $n times, giving up" ; return 1 ; }',
+    r'    [ $base -gt 0 ] && sleep $(( RANDOM % (base << (n < 6 ? n : 6)) + 1 ))',
+    r'    n=$((n + 1))',
+    r'  done',
+    r'}',
+    r'iscm_cfn_signal() { [ -n "$ISCM_WCHANDLE_URL" ] && [ -n "$(which cfn-signal)" ] && iscm_retry cfn-signal -e $1 -d "$(iscm_timing_summary)" $ISCM_WCHANDLE_URL ; }',
+    "",
+])
 
 class ISCM(object):
     """
@@ -14,7 +47,8 @@ class ISCM(object):
     limited to the scope of what can be done solely within
     CloudFormation.
     """
-    def __init__(self, context=None, processors=None, modules=None):
+    def __init__(self, context=None, processors=None, modules=None, bootstrap_stub=False):
+        self.bootstrap_elems = []
         self.userdata_elems = []
         self.metadata = {}
         # Flags and heap are temporary storage for the ISCM extensions,
@@ -23,30 +57,59 @@ class ISCM(object):
         self.heap = {}      # any value, None by default
         # Notify this waitconditionhandle when the ISCM finishes executing:
         self.wc_handle = None
+        # In bootstrap stub mode, userdata only contains the code required
+        # to fetch and run the rest of the boot sequence from the metadata
+        self.bootstrap_stub = bootstrap_stub
         # Load the context
         if context is None: context = {}
+        if isinstance(context, Mapping) and not isinstance(context, IscmContext):
+            context = IscmContext(context)
         self.context = context
-        # Install the processors
         if processors is None: processors = []
         self.processors = processors
-        for proc in self.processors:
-            proc.install(self)
-        # Install the specified modules 
         if modules is None: modules = []
-        for mod in modules:
-            mod.install(self)
-        # Deploy each module into this iscm, so necessary changes to the
-        # processors are performed
-        for mod in modules:
-            mod.deploy(self)
-        # Deploy each processor, in reverse order so changes trickle down
-        # to the base later processor
-        for proc in reversed(self.processors):
-            proc.deploy(self)
+        self.modules = modules
+        # Installing and deploying the processors and modules is left for
+        # when it's needed (see _ensure_deployed), so stacks can be loaded
+        # cheaply, and launchables that aren't dumped cost nothing
+        self.deployed = False
+        self._deploying = False
+
+    def _ensure_deployed(self):
+        """
+        Installs and deploys the processors and modules, the first time it's
+        called. The results stay in this ISCM for later calls.
+        """
+        if self.deployed or self._deploying:
+            return
+        self._deploying = True
+        with tracing.span("iscm_deploy", self):
+            # Install the processors
+            for proc in list(self.processors):
+                with tracing.span("install", proc):
+                    proc.install(self)
+            # Install the specified modules 
+            for mod in self.modules:
+                with tracing.span("install", mod):
+                    mod.install(self)
+            # Deploy each module into this iscm, so necessary changes to the
+            # processors are performed
+            for mod in self.modules:
+                with tracing.span("deploy", mod):
+                    mod.deploy(self)
+            # Deploy each processor, in reverse order so changes trickle down
+            # to the base later processor
+            for proc in reversed(self.processors):
+                with tracing.span("deploy", proc):
+                    proc.deploy(self)
+        self._deploying = False
+        self.deployed = True
 
     def add_processor(self, proc):
         self.processors.append(proc)
-        proc.install(self)
+        # Before deployment, it's installed along with the rest
+        if self.deployed or self._deploying:
+            proc.install(self)
 
     def is_buildable(self):
         return False
@@ -73,6 +136,14 @@ class ISCM(object):
         """
         self.userdata_elems += list(userdata)
 
+    def iscm_ud_bootstrap_append(self, *userdata):
+        """
+        Append elements to the bootstrap section of userdata. This section
+        runs first, and it is in charge of making the instance metadata
+        reachable from the instance
+        """
+        self.bootstrap_elems += list(userdata)
+
     def iscm_md_get(self, keypath):
         current = self.metadata
         for k in string.split(keypath, "."):
@@ -81,6 +152,21 @@ class ISCM(object):
             current = current[k]
         return current
 
+    def iscm_md_delete(self, keypath):
+        """
+        Delete a metadata entry, and the dictionaries containing it that
+        are left empty
+        """
+        path = string.split(keypath, ".")
+        while path:
+            parent = self.iscm_md_get(".".join(path[:-1])) if len(path) > 1 else self.metadata
+            if type(parent) != dict or not parent.has_key(path[-1]):
+                return
+            del parent[path[-1]]
+            if parent:
+                return
+            path.pop()
+
     def iscm_md_update_dict(self, keypath, data):
         """
         Update a metadata dictionary entry
@@ -118,53 +204,51 @@ class ISCM(object):
     def context_lookup(self, vars):
         """
         Lookup the variables in the provided dictionary, resolve with entries
-        in the context
+        in the context. Returns a new dictionary, the given one is left as is
         """
-        while isinstance(vars, IscmExpr):
-            vars = vars.resolve(self.context)
-        #
-        for (k,v) in vars.items():
-            if isinstance(v, IscmExpr):
-                vars[k] = v.resolve(self.context)
-        return vars
+        vars = resolve_value(vars, self.context)
+        return dict([ (k, resolve_value(v, self.context)) for (k, v) in vars.items() ])
 
     def apply_to(self, launchable):
         """
         Apply this ISCM configuration into a launchable resource, such as
         an EC2 instance or an AutoScalingGroup LaunchConfig.
         """
+        self._ensure_deployed()
         # Update user data
         if launchable.get_property("UserData") is not None:
             raise NotImplementedError("It's not yet supported to append SCM to existing userdata")
+        # Processors may render the userdata in their own way (i.e. for
+        # cloud-init), by setting a "userdata_renderer" function that takes
+        # the iscm and the launchable, and returns the userdata elements
+        renderer = self.iscm_get_var("userdata_renderer")
+        if renderer is not None:
+            if self.bootstrap_stub:
+                raise RuntimeError("ISCM bootstrap stub mode is not supported with a custom userdata renderer")
+            user_data_elems = renderer(self, launchable)
+        elif self.bootstrap_stub:
+            user_data_elems = self._get_stub_userdata()
+        else:
+            user_data_elems = [ _userdata_header ] + self._get_wc_handle_userdata() + [
+                "\n".join([
+                    r'{',
+                    r'INFO "CloudCast ISCM booting on $(date)"',
+                    r'iscm_boot_t0=$(iscm_now)',
+                    "\n\n"
+                ])
+            ] + self.bootstrap_elems + self.userdata_elems + [
+                "\n".join([ "",
+                    r'iscm_result=$?',
+                    r'iscm_record boot $iscm_boot_t0 $(iscm_now) $iscm_result',
+                    r'iscm_cfn_signal $iscm_result',
+                    '\nINFO "CloudCast ISCM successfully completed on $(date)"',
+                    '} 2>&1 | tee -a /iscm.log\n'
+                ])
+            ]
         user_data = {
             "Fn::Base64" : {
-                "Fn::Join" : ["", [
-                    "\n".join([
-                        r'#!/bin/bash',
-                        r'FATAL() { code=$1; shift; echo "[FATAL] $*" >&2; exit $code; }',
-                        r'ERROR() { echo "[ERROR] $*" >&2 ; }',
-                        r'WARN()  { echo "[WARNING] $*" >&2 ; }',
-                        r'INFO()  { echo "[INFO] $*" >&2 ; }', "",
-                    ])
-                ] + (self.wc_handle is not None and [
-                    cfnjoin("",
-                        r'ISCM_WCHANDLE_URL="', self.wc_handle, '"\n'
-                    )
-                ] or []) + [
-                    "\n".join([
-                        r'{',
-                        r'INFO "CloudCast ISCM booting on $(date)"',
-                        "\n\n"
-                    ])
-                ] + self.userdata_elems + [
-                    "\n".join([ "",
-                        r'iscm_result=$?',
-                        r'[ -n "$ISCM_WCHANDLE_URL" ] && [ -n "$(which cfn-signal)" ] && cfn-signal -e $iscm_result $ISCM_WCHANDLE_URL',
-                        '\nINFO "CloudCast ISCM successfully completed on $(date)"',
-                        '} 2>&1 | tee -a /iscm.log\n'
-                    ])
-                ]
-            ]} 
+                "Fn::Join" : ["", user_data_elems ]
+            }
         }
         launchable.add_property("UserData", user_data)
 
@@ -174,6 +258,56 @@ class ISCM(object):
                 raise NotImplementedError("It's not yet supported to append to existing metadata keys")
             launchable.add_metadata_key(k, self.metadata[k])
 
+    def _get_wc_handle_userdata(self):
+        if self.wc_handle is None:
+            return []
+        return [ cfnjoin("", r'ISCM_WCHANDLE_URL="', self.wc_handle, '"\n') ]
+
+    def _get_stub_userdata(self):
+        """
+        Returns the userdata elements for bootstrap stub mode. The stub
+        only contains the bootstrap section. It then reads the payload
+        (the rest of the boot sequence) from the metadata snapshot and runs
+        it. Thus, changes to the payload become metadata updates, which
+        don't require replacing instances.
+        The wait condition is signaled by the stub, with the exit status of
+        the payload, or as soon as the stub itself fails.
+        """
+        if not self.iscm_get_flag("cfninit_installed"):
+            raise RuntimeError("ISCM bootstrap stub mode requires a cfn-init processor to access the metadata")
+        payload = [ _userdata_header ] + self.userdata_elems + [
+            "\n".join([ "",
+                r'iscm_result=$?',
+                r'iscm_record boot $ISCM_BOOT_T0 $(iscm_now) $iscm_result',
+                r'exit $iscm_result', ""
+            ])
+        ]
+        self.iscm_md_update_dict(BOOTSTRAP_PAYLOAD_MD_KEY, {
+            "version": BOOTSTRAP_STUB_VERSION,
+            "boot": { "Fn::Join": [ "", payload ] }
+        })
+        #
+        return [ _userdata_header ] + self._get_wc_handle_userdata() + [
+            "\n".join([
+                r'# CloudCast ISCM bootstrap stub v%d' % BOOTSTRAP_STUB_VERSION,
+                r'{',
+                r'INFO "CloudCast ISCM bootstrap stub booting on $(date)"',
+                r'export ISCM_BOOT_T0=$(iscm_now)',
+                "\n\n"
+            ])
+        ] + self.bootstrap_elems + [
+            "\n".join([ "",
+                r'ISCM_PAYLOAD=/var/lib/cloudcast/iscm-boot.sh',
+                r'mkdir -p /var/lib/cloudcast',
+                '[ -s "$ISCM_METADATA_CACHE" ] && python -c \'import json,sys; sys.stdout.write(json.load(open(sys.argv[1]))["%s"]["boot"].encode("utf-8"))\' \\' % BOOTSTRAP_PAYLOAD_MD_KEY,
+                '  $ISCM_METADATA_CACHE > $ISCM_PAYLOAD || FATAL 1 "Unable to read the ISCM payload from the metadata"',
+                r'bash $ISCM_PAYLOAD || FATAL $? "The ISCM payload failed"',
+                r'iscm_cfn_signal 0',
+                '\nINFO "CloudCast ISCM successfully completed on $(date)"',
+                '} 2>&1 | tee -a /iscm.log\n'
+            ])
+        ]
+
     @classmethod
     def parse_context(cls, context_def, context):
         # Examine each entry in context_def
@@ -191,22 +325,245 @@ class ISCM(object):
         return context
 
 
+class ISCMPrototype(object):
+    """
+    An ISCM shared by many launchables. Pass it as the iscm of each
+    launchable, and each one gets its own binding (see ISCMBinding).
+
+    The ISCM is deployed only once, on behalf of the first binding that
+    needs it, and it shouldn't be modified after that. Bindings copy the
+    deployed userdata and metadata, and the parts that are particular to
+    each resource (i.e. Resource.ThisName()) are resolved on those copies.
+    The files and playbooks that the modules embed are shared, not read
+    or compressed again.
+
+    All the launchables of a prototype boot from the same entry point:
+    selecting different baked images for them is an error.
+    """
+    def __init__(self, iscm):
+        if not isinstance(iscm, ISCM):
+            raise RuntimeError("ISCM prototypes are made from ISCM objects")
+        self.iscm = iscm
+        self.entry_point = None     # Status id the bindings boot from, once decided
+
+    def bind(self):
+        return ISCMBinding(self)
+
+    def is_buildable(self):
+        return self.iscm.is_buildable()
+
+    def set_entry_point(self, status_id, prune_baked=True):
+        if self.entry_point is None:
+            self.entry_point = status_id
+            if status_id:
+                self.iscm.set_entry_point(status_id, prune_baked)
+        elif self.entry_point != status_id:
+            raise RuntimeError("Launchables sharing an ISCM prototype must boot from the same entry point")
+
+class ISCMBinding(ISCM):
+    """
+    The ISCM of a launchable, as stamped from a prototype. It only holds
+    its own wait condition handle, and copies of the prototype's deployed
+    userdata and metadata.
+    """
+    def __init__(self, prototype):
+        self.prototype = prototype
+        self.wc_handle = None
+        self.deployed = False
+        self.entry_point = ""       # Booting from the base image, unless told otherwise
+
+    def _ensure_deployed(self):
+        if self.deployed:
+            return
+        source = self.prototype.iscm
+        source._ensure_deployed()
+        with tracing.span("iscm_bind", source):
+            self.context = source.context
+            self.processors = source.processors
+            self.modules = source.modules
+            self.bootstrap_stub = source.bootstrap_stub
+            self.flags = dict(source.flags)
+            self.heap = dict(source.heap)
+            self.metadata = fresh_helper_exprs(source.metadata)
+            self.bootstrap_elems = fresh_helper_exprs(source.bootstrap_elems)
+            self.userdata_elems = fresh_helper_exprs(source.userdata_elems)
+        if self.wc_handle is None:
+            self.wc_handle = source.wc_handle
+        self.deployed = True
+
+    def add_processor(self, proc):
+        raise RuntimeError("Processors can't be added to an ISCM binding, add them to the prototype")
+
+    def is_buildable(self):
+        return self.prototype.is_buildable()
+
+    def get_possible_builds(self, *args, **kwargs):
+        return self.prototype.iscm.get_possible_builds(*args, **kwargs)
+
+    def set_entry_point(self, status_id, prune_baked=True):
+        self.prototype.set_entry_point(status_id, prune_baked)
+        self.entry_point = status_id
+
+    def apply_to(self, launchable):
+        self.prototype.set_entry_point(self.entry_point)
+        ISCM.apply_to(self, launchable)
+
+# Longest chain of expressions resolving into expressions that is followed
+# before giving up, as a resolution that never settles
+MAX_RESOLVE_DEPTH = 64
+
+class IscmContext(dict):
+    """
+    The context of an ISCM. It's a dictionary that keeps a version number,
+    bumped whenever one of its entries is set or removed. The results of
+    the expressions resolved against the context are memoized per version.
+
+    Changes made inside the values of the entries (i.e. context["a"]["b"] = 1)
+    are not noticed, set the top entry again in order to invalidate the
+    memoized results.
+    """
+    def __init__(self, *args, **kwargs):
+        dict.__init__(self, *args, **kwargs)
+        self.version = 0
+        self._memo = {}         # expression key -> (expression, result)
+        self._resolving = []    # keys of the expressions being resolved
+        self._globals = None    # copy of the context for evaluating python expressions
+
+    def _changed(self):
+        self.version += 1
+        self._memo = {}
+        self._globals = None
+
+    def __setitem__(self, key, value):
+        dict.__setitem__(self, key, value)
+        self._changed()
+    def __delitem__(self, key):
+        dict.__delitem__(self, key)
+        self._changed()
+    def update(self, *args, **kwargs):
+        dict.update(self, *args, **kwargs)
+        self._changed()
+    def setdefault(self, key, default=None):
+        if not self.has_key(key):
+            self[key] = default
+        return self[key]
+    def pop(self, *args):
+        value = dict.pop(self, *args)
+        self._changed()
+        return value
+    def popitem(self):
+        item = dict.popitem(self)
+        self._changed()
+        return item
+    def clear(self):
+        dict.clear(self)
+        self._changed()
+
+    def eval_globals(self):
+        """
+        Returns the globals for evaluating python expressions, so evaluation
+        doesn't add __builtins__ to the context
+        """
+        if self._globals is None:
+            self._globals = dict(self)
+        return self._globals
+
+def resolve_value(value, context):
+    """
+    Resolves the given value against the context, for as long as it resolves
+    into other expressions. Values that aren't expressions are returned as
+    they are.
+    """
+    seen = []
+    while isinstance(value, IscmExpr):
+        key = value.cache_key()
+        if key in seen:
+            raise RuntimeError("Cyclic ISCM context expression: %r" % value)
+        if len(seen) == MAX_RESOLVE_DEPTH:
+            raise RuntimeError("ISCM context expression doesn't settle after %d resolutions: %r" % (MAX_RESOLVE_DEPTH, value))
+        seen.append(key)
+        value = value.resolve(context)
+    return value
+
 class IscmExpr(object):
     """
     Expressions are used while defining module variables. This allows us to
     perform substitutions based on the context passed to the main ISCM obj.
+
+    Subclasses implement evaluate(). When resolving against an IscmContext,
+    results are memoized for the context version, keyed by cache_key(), so
+    equal expressions used by several modules are only evaluated once.
+    Expressions that depend on their own result are reported as errors.
     """
-    def resolve(self, context):
+    def cache_key(self):
+        return ("id", id(self))
+
+    def evaluate(self, context):
         raise NotImplementedError("Abstract class")
 
+    def resolve(self, context):
+        if not isinstance(context, IscmContext):
+            return self.evaluate(context)
+        key = self.cache_key()
+        if context._memo.has_key(key):
+            return _fresh(context._memo[key][1])
+        if key in context._resolving:
+            raise RuntimeError("Cyclic ISCM context expression: %r" % self)
+        version = context.version
+        context._resolving.append(key)
+        try:
+            result = self.evaluate(context)
+        finally:
+            context._resolving.pop()
+        if context.version == version:
+            # The expression is kept along, so its key can't be reused
+            context._memo[key] = (self, result)
+        return _fresh(result)
+
+    def __repr__(self):
+        return "<%s %r>" % (self.__class__.__name__, self.cache_key()[1:])
+
+def _fresh(result):
+    # Memoized containers are shared, callers get their own copy
+    if type(result) in [ dict, list ]:
+        return type(result)(result)
+    return result
+
+_keying = []   # expressions whose key is being computed
+
+def _member_key(m):
+    if isinstance(m, IscmExpr):
+        if m in _keying:
+            # Contains itself, resolving it will be reported as cyclic
+            return ("id", id(m))
+        _keying.append(m)
+        try:
+            return m.cache_key()
+        finally:
+            _keying.pop()
+    if isinstance(m, (basestring, int, long, float, bool)) or m is None:
+        return ("value", m)
+    return ("id", id(m))
+
+# Compiled code of python expressions and dq queries, by source text
+_compiled_exprs = {}
+_compiled_queries = {}
+
 class IscmPythonExpr(IscmExpr):
     """
     Evaluates a python expression, with the context as global dictionary
     """
     def __init__(self, expr):
         self.expr = expr
-    def resolve(self, context):
-        return eval(self.expr, context)
+        if not _compiled_exprs.has_key(expr):
+            _compiled_exprs[expr] = compile(expr, "<iscm expr>", "eval")
+        self.code = _compiled_exprs[expr]
+    def cache_key(self):
+        return ("expr", self.expr)
+    def evaluate(self, context):
+        if isinstance(context, IscmContext):
+            return eval(self.code, context.eval_globals())
+        return eval(self.code, dict(context))
 
 class IscmQExpr(IscmExpr):
     """
@@ -215,9 +572,13 @@ class IscmQExpr(IscmExpr):
     """
     def __init__(self, q):
         self.q = q
-    def resolve(self, context):
-        from dq import query
-        return query(self.q, context)
+    def cache_key(self):
+        return ("q", self.q)
+    def evaluate(self, context):
+        if not _compiled_queries.has_key(self.q):
+            from dq import compiled
+            _compiled_queries[self.q] = compiled(self.q)
+        return _compiled_queries[self.q](context)
 
 class IscmDictsExpr(IscmExpr):
     """
@@ -225,14 +586,16 @@ class IscmDictsExpr(IscmExpr):
     """
     def __init__(self, *dicts):
         self.dicts = dicts
-    def resolve(self, context):
-        def _normalize_to_items(dict_expr):
-            d = dict_expr
-            while not isinstance(d, dict):
-                if isinstance(d, IscmExpr):
-                    d = d.resolve(context)
-            return d.items()
-        return dict( reduce(lambda r,x: r + _normalize_to_items(x), self.dicts, []) )            
+    def cache_key(self):
+        return ("dicts",) + tuple([ _member_key(d) for d in self.dicts ])
+    def evaluate(self, context):
+        items = []
+        for dict_expr in self.dicts:
+            d = resolve_value(dict_expr, context)
+            if not isinstance(d, dict):
+                raise RuntimeError("ISCM dicts() member %r resolves to %r, not a dictionary" % (dict_expr, d))
+            items += d.items()
+        return dict(items)
 
 class IscmJoinExpr(IscmExpr):
     """
@@ -242,7 +605,9 @@ class IscmJoinExpr(IscmExpr):
     def __init__(self, token, *members):
         self.token = token
         self.members = members
-    def resolve(self, context):
+    def cache_key(self):
+        return ("join", self.token) + tuple([ _member_key(m) for m in self.members ])
+    def evaluate(self, context):
         members = map(lambda m: isinstance(m,IscmExpr) and m.resolve(context) or m, self.members)
         return cfnjoin(self.token, *members)
 
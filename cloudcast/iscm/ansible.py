@@ -1,13 +1,16 @@
-from cloudcast.iscm.cfninit import CfnEmbedFile
+from cloudcast.iscm import _userdata_header
+from cloudcast.iscm.cfninit import CfnEmbedFile, metadata_snapshot_sh, aws_exports_sh
 from cloudcast.iscm.phased import PhasedISCM, RunAlways, RunOnce, RunOnDeploy
 from cloudcast._utils import caller_folder, search_path
-from cloudcast.template import AWS, Resource
+from cloudcast.template import AWS
+from cloudcast.iscm.timing import timed_command, ANSIBLE_TASK_LOG
 
 from copy import copy
 from os import getcwd
-import os
+import os, re
 
 _ansibleinstall_script = os.path.join(os.path.dirname(__file__), "scripts", "install_ansible.sh")
+_timing_callback_plugin = os.path.join(os.path.dirname(__file__), "scripts", "iscm_timing.py")
 
 """
 Wrapper for the standard pattern of having ansible initialization and boot module.
@@ -17,13 +20,20 @@ Some examples:
 
 """
 class AnsibleISCM(PhasedISCM):
+  iscm_kwargs = [ "bootstrap_stub", "bootstrap_profile", "processor", "reconfigure_on_update" ]
   def __init__(self, **kwargs):
     # valid kwargs
+    #  * bootstrap_stub
+    #  * bootstrap_profile
+    #  * processor
+    #  * reconfigure_on_update
     #  * config
     #  * stack_user_key
     #  * facts
     #  * vars
     #  * playbooks_source / (playbook_sources)
+    #  * playbooks_ignore
+    #  * prune_playbooks
     #  * boot / (runs)
     if not kwargs.has_key("stack_user_key"):
       raise RuntimeError("Required AnsibleISCM argument 'stack_user_key' missing!")
@@ -48,13 +58,23 @@ class AnsibleISCM(PhasedISCM):
       phases.append(RunOnDeploy("Ansible-Boot", [ Ansible('boot') ]))
 
     # Initialize the phased ISCM that we wrap around
-    PhasedISCM.__init__(self, context, phases)
+    iscm_kwargs = dict( filter(lambda (k,v): k in AnsibleISCM.iscm_kwargs, kwargs.items()) )
+    PhasedISCM.__init__(self, context, phases, **iscm_kwargs)
+    self.config_module = cfg_module
+
+  def playbooks_report(self):
+    """
+    Returns the report of the playbook files embedded, and those excluded
+    (see format_playbooks_report)
+    """
+    self._ensure_deployed()
+    return self.config_module.pb_sources.report
 
 """
 ISCM module to configure ansible install in the instance
 """
 class AnsibleConfig(object):
-  init_kwargs = [ "config", "facts", "playbooks_source", "boot", "runs", "_basepath" ]
+  init_kwargs = [ "config", "facts", "playbooks_source", "playbooks_ignore", "prune_playbooks", "boot", "runs", "_basepath" ]
   def __init__(self, **kwargs):
     # Get the basepath from which playbook files can be searched locally
     if kwargs.has_key('_basepath'):
@@ -66,7 +86,8 @@ class AnsibleConfig(object):
     if kwargs.has_key("config"): self.config = kwargs["config"]
     self._check_config()
     #
-    self.pb_sources = _AnsiblePlaybookSources(config=self.config, basepath=self.basepath)
+    self.pb_sources = _AnsiblePlaybookSources(config=self.config, basepath=self.basepath,
+      ignore=kwargs.get('playbooks_ignore'), prune=kwargs.get('prune_playbooks', True))
     if kwargs.has_key('playbooks_source'):
       self.pb_sources.add_folder(kwargs['playbooks_source'])
     #
@@ -80,7 +101,7 @@ class AnsibleConfig(object):
 
   def _check_config(self):
     for k in self.config.keys():
-      if k not in [ 'ansible_home', 'ansible_version', 'sudo', 'tags', 'skip_tags', 'inst_home', 'inst_playbook_dir', 'inst_user', 'inst_group' ]:
+      if k not in [ 'ansible_home', 'ansible_version', 'ansible_wheelhouse', 'ansible_cfg', 'sudo', 'tags', 'skip_tags', 'inst_home', 'inst_playbook_dir', 'inst_user', 'inst_group' ]:
         raise RuntimeError("Unknown AnsibleConfig directive %s" % k)
     #
     if not self.config.has_key('inst_home') or \
@@ -102,6 +123,70 @@ class AnsibleConfig(object):
     if not isabs(inst_pb_dest_path):
       raise RuntimeError("Can't interpolate absolute path in the instance for playbooks to be!")
     self.config['_inst_playbook_path'] = inst_pb_dest_path
+    self.config['_ansible_cfg_path'] = "%s/etc/ansible.cfg" % self.config['ansible_home']
+
+  def _get_ansible_cfg(self):
+    # Settings for ansible.cfg. The 'ansible_cfg' directive is a dictionary
+    # of sections, with options that override these (or remove them, when
+    # set to None)
+    ans_home = self.config['ansible_home']
+    settings = {
+      "defaults": {
+        "hostfile": "%s/etc/hosts" % ans_home,
+        "forks": 10,
+        # Facts are gathered by the first run, the rest of the runs in the
+        # same boot take them from the cache
+        "gathering": "smart",
+        "fact_caching": "jsonfile",
+        "fact_caching_connection": "%s/var/fact_cache" % ans_home,
+        "fact_caching_timeout": 86400,
+        "callback_plugins": "%s/share/callback_plugins" % ans_home,
+        "callback_whitelist": "iscm_timing",
+        "host_key_checking": False,
+        "retry_files_enabled": False,
+      },
+      "ssh_connection": {
+        "pipelining": True,
+      },
+    }
+    for (section, options) in self.config.get('ansible_cfg', {}).items():
+      settings.setdefault(section, {}).update(options)
+    lines = []
+    for (section, options) in sorted(settings.items()):
+      lines.append("[%s]" % section)
+      lines += [ "%s = %s" % (k, v) for (k, v) in sorted(options.items()) if v is not None ]
+      lines.append("")
+    return "\n".join(lines)
+
+  def _get_ansible_config_cfninit(self, iscm):
+    ans_home = self.config['ansible_home']
+    owner = "%s:%s" % (self.config['inst_user'], self.config['inst_group'])
+    fact_cache = "%s/var/fact_cache" % ans_home
+    with open(_timing_callback_plugin, "r") as f:
+      plugin = f.read()
+    return dict(
+      files= {
+        self.config['_ansible_cfg_path'] : dict(
+          content= self._get_ansible_cfg(),
+          owner= 'root',
+          group= 'root',
+          mode= "000644"
+          ),
+        "%s/share/callback_plugins/iscm_timing.py" % ans_home : dict(
+          content= plugin,
+          owner= 'root',
+          group= 'root',
+          mode= "000644"
+          )
+        },
+      commands= dict(
+        # Facts cached in a baked image are not the facts of this instance
+        ansible_reset_fact_cache= dict(
+          command= "rm -rf %s && mkdir -p %s && chown %s %s && touch %s && chown %s %s" % (
+            fact_cache, fact_cache, owner, fact_cache, ANSIBLE_TASK_LOG, owner, ANSIBLE_TASK_LOG)
+          )
+        )
+      )
 
   def _get_ansible_install_inventory(self, iscm):
     ans_home = self.config['ansible_home']
@@ -122,22 +207,32 @@ class AnsibleConfig(object):
   def _get_ansible_install_facts_cfninit(self, iscm):
     stack_user_key = iscm.iscm_cfninit_get_stack_user_key()
     ans_home = self.config['ansible_home']
+    facts_script = "%s/libexec/iscm-facts.sh" % ans_home
     return dict(
-      commands= dict(
-        ansible_get_facts= dict(
-          command= {
+      files= {
+        # Facts are read from the boot metadata snapshot, which is only
+        # fetched here if it's missing, in the same way as on boot. The
+        # script holds the stack user secret key, only root reads it
+        facts_script : dict(
+          content= {
            "Fn::Join" : ["", [
-            '[ ! -d %s/etc/host_vars ] && mkdir -p %s/etc/host_vars ; ' % (ans_home, ans_home),
-            'cfn-get-metadata --access-key ', stack_user_key,
-            ' --secret-key ', stack_user_key["SecretAccessKey"],
-            ' --region ', AWS.Region,
-            ' --stack ', AWS.StackName,
-            ' --resource ', Resource.ThisName(),
-            ' --k _ansible_facts ',
+            _userdata_header ] + aws_exports_sh(stack_user_key) + [
+            metadata_snapshot_sh + "\n",
+            'iscm_snapshot_metadata || FATAL 1 "Unable to fetch the instance metadata"\n',
+            'mkdir -p %s/etc/host_vars\n' % ans_home,
 #            " | ( . %s/bin/activate ; python -c 'import json, yaml, sys ; print yaml.safe_dump(json.load(sys.stdin), default_flow_style=False, explicit_start=True, indent=2, allow_unicode=True)' ; ) " % ans_home,
-            ' > %s/etc/host_vars/localhost.json' % ans_home
+            'python -c \'import json, sys ; json.dump(json.load(open(sys.argv[1]))["_ansible_facts"], sys.stdout)\' $ISCM_METADATA_CACHE',
+            ' > %s/etc/host_vars/localhost.json\n' % ans_home
             ] ]
-          }
+          },
+          owner= 'root',
+          group= 'root',
+          mode= "000700"
+          )
+      },
+      commands= dict(
+        ansible_get_facts= dict(
+          command= facts_script
         )
       )
     )
@@ -170,20 +265,25 @@ class AnsibleConfig(object):
     iscm.iscm_md_update_dict(facts_md_entry, self.facts)
     # Make sure ansible is installed
     CfnEmbedFile(src_file=_ansibleinstall_script, dest_path="/root/install-ansible.sh", owner="root", group="root", mode="000700").deploy(iscm)
+    install_env = {
+      "ANSIBLE_HOME": self.config['ansible_home'],
+      "ANSIBLE_VERSION": self.config['ansible_version']
+      }
+    if self.config.has_key('ansible_wheelhouse'):
+      install_env["ANSIBLE_WHEELHOUSE"] = self.config['ansible_wheelhouse']
     iscm.iscm_cfninit_add_config({
         "commands": {
           "ansible_install": {
-            "command": "/root/install-ansible.sh",
-            "env": {
-              "ANSIBLE_HOME": self.config['ansible_home'],
-              "ANSIBLE_VERSION": self.config['ansible_version']
-              }
+            "command": timed_command("bootstrap:ansible-install", "/root/install-ansible.sh"),
+            "env": install_env
             }
           }
         },
         "_ansible_install")
     # Add inventory file
     iscm.iscm_cfninit_add_config(self._get_ansible_install_inventory(iscm), "_ansible_install_inventory")
+    # Add ansible.cfg and the task timing plugin
+    iscm.iscm_cfninit_add_config(self._get_ansible_config_cfninit(iscm), "_ansible_install_config")
     # Install facts
     iscm.iscm_cfninit_add_config(self._get_ansible_install_facts_cfninit(iscm), "_ansible_install_facts")
     # Embed the playbook sources
@@ -191,8 +291,207 @@ class AnsibleConfig(object):
     # Deploy the script that wraps the ansible runs as specified
     self.run_manager.deploy(iscm)
 
+def _read_playbook_file(path):
+  # Returns the contents of the file, base64 encoded if it's binary, and
+  # the encoding
+  from base64 import b64encode
+  from cloudcast._utils import DigestedStr
+  encoding= None
+  with open(path, "rb") as f:
+    contents= f.read()
+  try:
+    contents.decode('utf-8')
+  except UnicodeDecodeError:
+    encoding= "base64"
+    contents= b64encode(contents)
+  return (DigestedStr(contents), encoding)
+
+# Patterns of the files that are never embedded along with the playbooks.
+# They're matched against each part of the path, and the whole path
+_default_playbooks_ignore = [ ".git", ".svn", ".hg", "*.retry", "*.pyc", "*~", ".*.swp", ".DS_Store" ]
+
+# Folders that ansible reads by itself, or where it looks for the files
+# that tasks refer to, when found next to a playbook
+_playbook_adjacent_dirs = [ "group_vars", "host_vars", "files", "templates", "library", "module_utils",
+  "action_plugins", "callback_plugins", "filter_plugins", "lookup_plugins", "vars_plugins" ]
+
+# Keys whose values name other files or roles, and the keys inside them
+# that do (i.e. include_role: { name: x })
+_reference_keys = [ "include", "include_tasks", "import_tasks", "import_playbook", "include_playbook",
+  "include_vars", "include_role", "import_role", "roles", "dependencies", "vars_files", "role" ]
+_reference_subkeys = [ "file", "dir", "name", "role", "_raw_params" ]
+
+_key_line = re.compile(r"^(\s*)(-\s+)?([\w.-]+)\s*:(?:\s+(.*))?$")
+_item_line = re.compile(r"^(\s*)-(?:\s+(.*))?$")
+_jinja = re.compile(r"\{\{.*?\}\}|\{%.*?%\}")
+_token_separators = re.compile(r"[\s'\"=,\[\]{}]+|:(?=\s|$)")
+_templated_file = re.compile(r"(\{\{.*?\}\}|\{%.*?%\})[^\s'\"=,]*\.(yml|yaml|json)\b")
+# Loops over files, whose items are paths or globs
+_file_loop_keys = [ "with_file", "with_fileglob", "with_filetree", "with_first_found" ]
+# Jinja that reads files (lookups), or that holds a quoted path
+_jinja_file_use = re.compile(r"""\b(lookup|query|q)\s*\(|(["'])[^"']*/[^"']*\2""")
+
+def _read_playbook_references(path):
+  """
+  Returns the references to other files found in a playbook, task list or
+  role file, line by line, without parsing the YAML:
+    ("reference", name)  value of an include, import, role or vars file
+    ("dynamic", value)   the same, when it depends on variables, or a file
+                         used by a lookup or a file loop
+    ("token", word)      any other word, it's followed if there's a file
+                         (or role) with that name
+  Reading them this way errs on the side of including too much, and it
+  saves loading a YAML parser on every render.
+  """
+  with open(path, "rb") as f:
+    text = f.read()
+  refs = []
+  seen = set()    # words already listed
+  parents = []    # (indentation, key) of the keys enclosing the line
+  for line in text.splitlines():
+    if not line.strip() or line.lstrip().startswith("#"):
+      continue
+    m = _key_line.match(line)
+    if m:
+      indent = len(m.group(1)) + len(m.group(2) or "")
+      (key, value) = (m.group(3), m.group(4) or "")
+      while parents and parents[-1][0] >= indent: parents.pop()
+    else:
+      m = _item_line.match(line)
+      indent = len(line) - len(line.lstrip())
+      (key, value) = (None, (m.group(2) or "") if m else line.strip())
+      while parents and parents[-1][0] > indent: parents.pop()
+    parent = parents[-1][1] if parents else None
+    in_reference = key in _reference_keys or \
+      (parent in _reference_keys and (key is None or key in _reference_subkeys))
+    jinja = _jinja.findall(value)
+    if jinja and (in_reference or _templated_file.search(value)) or \
+       [ j for j in jinja if _jinja_file_use.search(j) ] or \
+       value and [ k for k in [ key ] + [ p[1] for p in parents ] if k in _file_loop_keys ]:
+      refs.append(("dynamic", value.strip().strip("'\"")))
+    elif in_reference and value and value[0] not in "[{|>":
+      # Without the parameters that may follow (i.e. "tasks.yml x=1")
+      refs.append(("reference", _token_separators.split(value.strip())[0] or value.split()[0]))
+    for token in _token_separators.split(_jinja.sub(" ", value)):
+      if token and token not in seen:
+        seen.add(token)
+        refs.append(("token", token))
+    if m and key is not None:
+      parents.append((indent, key))
+  return refs
+
+class _PlaybookScanner(object):
+  """
+  Finds the files that the given playbooks need, following their
+  references. Roles are taken whole. References that depend on variables,
+  and files read by lookups or looped over (dynamic), mean that the files
+  needed can't be known until the playbooks run.
+  """
+  def __init__(self, files, syspath):
+    import posixpath
+    self.files = files          # paths of the files available, relative to the playbooks root
+    self.dirs = set()
+    for f in files:
+      d = posixpath.dirname(f)
+      while d and d not in self.dirs:
+        self.dirs.add(d)
+        d = posixpath.dirname(d)
+    # Names of the files and folders, most words can be discarded by them
+    self.names = set([ posixpath.basename(p) for p in self.files | self.dirs ])
+    self.syspath = syspath      # returns the path in the system of one of the files
+    self.needed = set()
+    self.roles = set()
+    self.playbook_dirs = []
+    self.unresolved = []        # (file, reference) that can't be found among the files
+    self.dynamic = []           # (file, reference) that can't be followed
+
+  def _resolve(self, ref, candidate_dirs):
+    # A file, then a role, then a folder
+    import posixpath
+    paths = []
+    for d in candidate_dirs:
+      paths += [ posixpath.normpath(posixpath.join(d, ref)), posixpath.normpath(posixpath.join(d, "roles", ref)) ]
+    for p in paths[0::2]:
+      if p in self.files:
+        return p
+    for p in paths[1::2] + paths[0::2]:
+      if p in self.dirs:
+        return p
+    return None
+
+  def _candidate_dirs(self, source):
+    import posixpath
+    dirs = [ posixpath.dirname(source) ]
+    return dirs + [ d for d in self.playbook_dirs if d not in dirs ]
+
+  def add_playbook(self, path):
+    import posixpath
+    path = posixpath.normpath(path)
+    if path not in self.files:
+      return False
+    d = posixpath.dirname(path)
+    if d not in self.playbook_dirs:
+      self.playbook_dirs.append(d)
+      for adjacent in _playbook_adjacent_dirs:
+        self.add_path(posixpath.join(d, adjacent))
+    self.add_path(path)
+    return True
+
+  def add_path(self, path):
+    if path in self.files:
+      if path in self.needed:
+        return
+      self.needed.add(path)
+      if path.split(".")[-1] in [ "yml", "yaml", "json" ] or "." not in path.split("/")[-1]:
+        self._scan(path)
+    elif path in self.dirs:
+      for f in sorted(self.files):
+        if f.startswith(path + "/"):
+          self.add_path(f)
+
+  def _scan(self, source):
+    from cloudcast._utils import stat_cached
+    for (kind, ref) in stat_cached(self.syspath(source), _read_playbook_references, "ansible-references"):
+      if kind == "dynamic":
+        self.dynamic.append((source, ref))
+        continue
+      if ref.rstrip("/").split("/")[-1] not in self.names:
+        path = None
+      else:
+        path = self._resolve(ref, self._candidate_dirs(source))
+      if path is not None:
+        self.add_path(path)
+      elif kind == "reference":
+        self.unresolved.append((source, ref))
+
+def _ignore_matcher(patterns):
+  # Returns a function that tells if a path matches any of the patterns
+  from fnmatch import translate
+  regex = re.compile("|".join([ "(?:%s)" % translate(p) for p in patterns ]))
+  def is_ignored(path):
+    return regex.match(path) is not None or [ part for part in path.split("/") if regex.match(part) ] != []
+  return is_ignored
+
+def format_playbooks_report(report):
+  """
+  Returns the report of the playbook files embedded by an AnsibleISCM (see
+  AnsibleISCM.playbooks_report) as text
+  """
+  lines = [ "%d files embedded, %d excluded" % (len(report["embedded"]), len(report["excluded"])) ]
+  if report["not_pruned"]:
+    lines.append("Not pruned: %s" % report["not_pruned"])
+  for e in report["excluded"]:
+    lines.append("  excluded (%s): %s" % (e["reason"], e["path"]))
+  for u in report["unresolved"]:
+    lines.append("  unresolved reference in %s: %s" % (u["source"], u["reference"]))
+  return "\n".join(lines)
+
 """
-This class handles the playbook sources to be installed into the instance
+This class handles the playbook sources to be installed into the instance.
+
+Only the files that the playbooks of the runs need are embedded (see
+_PlaybookScanner), unless prune is False, or they can't be told apart.
+Files matching the ignore patterns are never embedded.
 """
 from fs.multifs import MultiFS
 from fs.osfs import OSFS
@@ -201,6 +500,9 @@ class _AnsiblePlaybookSources(object):
     self.fs = MultiFS()
     self.config = kwargs['config']
     self.basepath = kwargs['basepath']
+    self.ignore = _default_playbooks_ignore + list(kwargs.get('ignore') or [])
+    self.prune = kwargs.get('prune', True)
+    self.report = None
 
   def add_folder(self, folder_path, dest=""):
     real_path = search_path(folder_path, self.basepath, getcwd())
@@ -212,41 +514,76 @@ class _AnsiblePlaybookSources(object):
   # def add_git(self, **kwargs):
   # def add_file_url(self, url):
 
+  def _list_files(self):
+    # Paths of the files in the sources, relative to their root, in order
+    from os.path import join
+    files = []
+    for (fs_dir, fs_dirfiles) in sorted(self.fs.walk()):
+      if fs_dir[0] == '/': fs_dir = fs_dir[1:]
+      files += [ join(fs_dir, f) for f in sorted(fs_dirfiles) ]
+    return files
+
+  def _select_files(self, playbooks):
+    # Returns the files to embed, and leaves the report of the selection
+    files = self._list_files()
+    is_ignored = _ignore_matcher(self.ignore)
+    excluded = [ dict(path=f, reason="ignored") for f in files if is_ignored(f) ]
+    files = [ f for f in files if not is_ignored(f) ]
+    # Looking up the real path of a file in the sources takes a lock, do it once per file
+    self.syspaths = dict([ (f, self.fs.getsyspath(f)) for f in files ])
+    unresolved = []
+    not_pruned = None
+    if self.prune:
+      scanner = _PlaybookScanner(set(files), self.syspaths.get)
+      missing = [ p for p in playbooks if not scanner.add_playbook(p) ]
+      unresolved = [ dict(source=s, reference=r) for (s, r) in scanner.unresolved ]
+      if missing:
+        not_pruned = "playbooks not found in the sources: %s" % ", ".join(missing)
+      elif scanner.dynamic:
+        not_pruned = "references that depend on variables, lookups or file loops: %s" % ", ".join(
+          [ "%s (in %s)" % (r, s) for (s, r) in scanner.dynamic ])
+      else:
+        excluded += [ dict(path=f, reason="unreferenced") for f in files if f not in scanner.needed ]
+        files = [ f for f in files if f in scanner.needed ]
+    else:
+      not_pruned = "pruning disabled"
+    self.report = dict(
+      embedded= files,
+      excluded= sorted(excluded, key=lambda e: e["path"]),
+      unresolved= unresolved,
+      not_pruned= not_pruned
+      )
+    return files
+
   # Plain method to embed the playbook contents into the cloudformation template
-  def _fs_to_cfninit_plain(self):
-    from base64 import b64encode
+  def _fs_to_cfninit_plain(self, playbooks=()):
+    from cloudcast._utils import stat_cached
     # Create a metadata object that, when executed by cfn-init, will result in the files
     # being created in the instance
     from os.path import join
     files_obj = {}
     target = self.config['_inst_playbook_path']
-    for (fs_dir, fs_dirfiles) in self.fs.walk():
-      # TODO: more deterministic order of walking through the files
-      if fs_dir[0] == '/': fs_dir = fs_dir[1:]
-      t = join(target, fs_dir)
-      for f in fs_dirfiles:
-        src = join(fs_dir, f)
-        dest = join(t, f)
-        encoding= None
-        try:
-          contents= self.fs.getcontents(src, mode='rb')
-          contents.decode('utf-8')
-        except UnicodeDecodeError:
-          encoding= "base64"
-          contents= b64encode(contents)
-
-        files_obj[dest] = dict(
-          content= contents,
-          owner= self.config['inst_user'],
-          group= self.config['inst_group'],
-          mode= "000640"
-          )
-        files_obj[dest].update( {"encoding": encoding} if encoding else {} )
+    # In order, so the files are always read in the same sequence
+    for src in self._select_files(playbooks):
+      dest = join(target, src)
+      # Files are only read and digested again if they change
+      (contents, encoding) = stat_cached(self.syspaths[src], _read_playbook_file, "ansible-playbook")
+      files_obj[dest] = dict(
+        content= contents,
+        owner= self.config['inst_user'],
+        group= self.config['inst_group'],
+        mode= "000640"
+        )
+      files_obj[dest].update( {"encoding": encoding} if encoding else {} )
     return files_obj
 
   def deploy(self, iscm):
-    # Create cfn-init stanzas for creating the added files
-    iscm.iscm_cfninit_add_config({ "files": self._fs_to_cfninit_plain() }, "_ansible_playbooks_install")
+    from cloudcast._utils import stable_digest
+    # Create cfn-init stanzas for creating the added files, those needed by the runs
+    playbooks = sorted(set([ spec['playbook'] for spec in iscm.iscm_get_var("ansible_run_specs").values() ]))
+    files = self._fs_to_cfninit_plain(playbooks)
+    iscm.iscm_cfninit_add_config({ "files": files }, "_ansible_playbooks_install")
+    iscm.iscm_set_var("ansible_playbooks_digest", stable_digest(files))
 
 """
 Specification of an ansible run.
@@ -291,7 +628,7 @@ class _AnsibleRun(object):
     if self.run_spec.has_key('sudo_user'):
       command += "-U " % self.run_spec['sudo_user']
     if self.run_spec.has_key('extra_vars'):
-      command += "-e '" + json_dumps(self.run_spec['extra_vars']) + "' "
+      command += "-e '" + json_dumps(self.run_spec['extra_vars'], sort_keys=True) + "' "
     if self.run_spec.has_key('tags'):
       command += "-t '" + ','.join(self.run_spec['tags']) + "' "
     if self.run_spec.has_key('skip_tags'):
@@ -323,7 +660,8 @@ class _AnsibleRunManager(object):
       "  ;;"
 
   def install(self, iscm):
-    iscm.iscm_set_var("ansible_runs", self.runs.keys())
+    iscm.iscm_set_var("ansible_runs", sorted(self.runs.keys()))
+    iscm.iscm_set_var("ansible_run_specs", dict([ (k, r.run_spec) for (k, r) in self.runs.items() ]))
 
   def deploy(self, iscm):
     ansi_home = self.ansible_config['ansible_home']
@@ -336,9 +674,10 @@ class _AnsibleRunManager(object):
           "#!/bin/bash\n\n" + \
           ". %s/bin/activate\n\n" % ansi_home + \
           "ANSIBLE_INVENTORY=%s/etc/hosts\n" % ansi_home + \
+          "export ANSIBLE_CONFIG=%s ISCM_ANSIBLE_RUN=\"$1\" ISCM_ANSIBLE_TASK_LOG=%s\n" % (self.ansible_config['_ansible_cfg_path'], ANSIBLE_TASK_LOG) + \
           "cd %s\n" % pb_home + \
           "case \"$1\" in \n" + \
-          reduce(lambda x,y: x + self._get_runner_clause(y), self.runs.keys(), "") + \
+          reduce(lambda x,y: x + self._get_runner_clause(y), sorted(self.runs.keys()), "") + \
           " *)\n" + \
           "  echo \"Invalid ansible run name $1\" && exit 1\n" + \
           "  ;;\n" + \
@@ -369,11 +708,15 @@ class Ansible(object):
     # Create execution clause for the playbook
     ansi_user = iscm.iscm_get_var("ansible_inst_user")
     ansi_script = iscm.iscm_get_var("ansible_run_script")
-    iscm.iscm_cfninit_add_config({
-      "commands": {
-        "ansible-run": dict(
-          command="sudo -u %s /bin/bash %s %s 2>&1 | tee -a /iscm-ansible-%s.log" % (ansi_user, ansi_script, self.run_name, self.run_name)
-          )
-        }
-      },
-      "_ansible_execute_run_%s" % self.run_name);
+    run = dict(
+      command=timed_command("ansible:%s" % self.run_name,
+        "sudo -u %s /bin/bash %s %s" % (ansi_user, ansi_script, self.run_name), log="/iscm-ansible-%s.log" % self.run_name)
+      )
+    if iscm.iscm_get_flag("cfninit_reconfigure"):
+      # The playbooks are installed by another configset, the digest makes
+      # the hash of this one change along with them, so the run is
+      # repeated when the playbooks (or the run itself) are updated
+      from cloudcast._utils import stable_digest
+      run["env"] = { "ISCM_PLAYBOOKS_DIGEST": stable_digest([
+        iscm.iscm_get_var("ansible_playbooks_digest"), iscm.iscm_get_var("ansible_run_specs")[self.run_name] ]) }
+    iscm.iscm_cfninit_add_config({ "commands": { "ansible-run": run } }, "_ansible_execute_run_%s" % self.run_name);
@@ -1,11 +1,212 @@
 #!/usr/bin/env python
 import copy, types
+from os.path import dirname
 
 _default_get_pip_url = "https://bootstrap.pypa.io/get-pip.py"
 _default_aws_cfn_bootstrap_url = "https://s3.amazonaws.com/cloudformation-examples/aws-cfn-bootstrap-1.3.16.tar.gz"
 
-from cloudcast.iscm import IscmExpr
+# The instance metadata is fetched once per boot into this file, and all the
+# ISCM modules read it from there
+METADATA_CACHE = "/var/lib/cloudcast/metadata.json"
+
+# Shell code that fetches the metadata snapshot, unless it's already there.
+# It expects the AWS__* variables exported by the bootstrap section. The
+# snapshot is taken from ISCM_METADATA_URL (i.e. a pre-staged copy in S3)
+# if given, and from the CloudFormation API otherwise.
+metadata_snapshot_sh = "\n".join([
+    r'export ISCM_METADATA_CACHE=${ISCM_METADATA_CACHE:-%s}' % METADATA_CACHE,
+    r'iscm_get_metadata_url() { curl -fsS --max-time 30 "$ISCM_METADATA_URL" > $ISCM_METADATA_CACHE.$$ ; }',
+    r'iscm_get_metadata_api() {',
+    '  ${CFN_GETMETA_PATH:-cfn-get-metadata} -s "$AWS__STACK_NAME" -r "$AWS__STACKEL_NAME" --region "$AWS__REGION" \\',
+    r'    --access-key "$AWS__BOOTSTRAP_KEY_ID" --secret-key "$AWS__BOOTSTRAP_SECRET_KEY" > $ISCM_METADATA_CACHE.$$',
+    r'}',
+    # The snapshot holds the resolved stack user secret key, only root reads it
+    r'iscm_fetch_metadata() (',
+    r'  umask 077',
+    r'  mkdir -p $(dirname $ISCM_METADATA_CACHE)',
+    r'  { [ -n "$ISCM_METADATA_URL" ] && iscm_retry iscm_get_metadata_url ; } || iscm_retry iscm_get_metadata_api || { rm -f $ISCM_METADATA_CACHE.$$ ; exit 1 ; }',
+    r'  mv -f $ISCM_METADATA_CACHE.$$ $ISCM_METADATA_CACHE',
+    r')',
+    r'iscm_snapshot_metadata() { [ -s "$ISCM_METADATA_CACHE" ] || iscm_fetch_metadata ; }',
+])
+
+# With reconfigure_on_update, the content hash of each configset is kept in
+# this metadata key, along with the configsets run at boot. The instance
+# records the hashes of the configsets it has applied in CONFIGSET_HASHES
+CONFIGSETS_MD_KEY = "CloudCast::Configsets"
+CONFIGSET_HASHES = "/var/lib/cloudcast/configset-hashes.json"
+RECONFIGURE_CONFIGSET = "_iscm_reconfigure"
+RECONFIGURE_SCRIPT = "/usr/local/sbin/iscm-reconfigure"
+CONFIGSET_HASHES_TOOL = "/usr/local/sbin/iscm-configset-hashes"
+
+# Compares the configset hashes in the metadata snapshot with the recorded
+# ones. "changed" prints the configsets to run whose hash is not the
+# recorded one, "record [configset ...]" records the hashes of the given
+# configsets (all the configsets to run, if none given)
+configset_hashes_py = "\n".join([
+    r'#!/usr/bin/env python',
+    r'import json, os, sys',
+    r'cache = os.environ.get("ISCM_METADATA_CACHE", "%s")' % METADATA_CACHE,
+    r'state = os.environ.get("ISCM_CONFIGSET_HASHES", "%s")' % CONFIGSET_HASHES,
+    r'metadata = json.load(open(cache))["%s"]' % CONFIGSETS_MD_KEY,
+    r'try:',
+    r'    recorded = json.load(open(state))',
+    r'except (IOError, ValueError):',
+    r'    recorded = {}',
+    r'if sys.argv[1] == "changed":',
+    r'    print(" ".join([ cs for cs in metadata["run"] if recorded.get(cs) != metadata["hashes"].get(cs) ]))',
+    r'elif sys.argv[1] == "record":',
+    r'    for cs in sys.argv[2:] or metadata["run"]:',
+    r'        recorded[cs] = metadata["hashes"][cs]',
+    r'    if not os.path.isdir(os.path.dirname(state)):',
+    r'        os.makedirs(os.path.dirname(state))',
+    r'    with open(state + ".tmp", "w") as f:',
+    r'        json.dump(recorded, f, sort_keys=True)',
+    r'    os.rename(state + ".tmp", state)',
+    r'else:',
+    r'    sys.exit("Unknown command %s" % sys.argv[1])',
+    r'',
+])
+
+# Shell code that runs a group of configset branches concurrently. Waiting
+# for the first branch to finish takes bash 4.3 or later (wait -n), with
+# earlier versions the branches are run one after another
+parallel_sh = "\n".join([
+    r'ISCM_PARALLEL_LOGS=/var/log/iscm-parallel',
+    r'iscm_has_wait_n() { [ $(( BASH_VERSINFO[0] * 100 + BASH_VERSINFO[1] )) -ge 403 ] ; }',
+    r'iscm_run_parallel() {',
+    r'  # Runs "$2 <branch>" in the background for each of the branches that',
+    r'  # follow, timed as "$1<branch>". Each branch logs to its own file. Any',
+    r'  # failing branch makes the rest of them be killed',
+    r'  local prefix=$1 run=$2 branch pid pids="" rc=0 n',
+    r'  shift 2',
+    r'  if ! iscm_has_wait_n; then',
+    r'    WARN "bash $BASH_VERSION lacks wait -n, running the concurrent branches one after another"',
+    r'    for branch in "$@"; do iscm_timed "$prefix$branch" $run "$branch" || return $?; done',
+    r'    return 0',
+    r'  fi',
+    r'  mkdir -p $ISCM_PARALLEL_LOGS',
+    r'  # With job control, each branch gets its own process group',
+    r'  set -m',
+    r'  for branch in "$@"; do',
+    r'    iscm_timed "$prefix$branch" $run "$branch" > $ISCM_PARALLEL_LOGS/$branch.log 2>&1 &',
+    r'    pids="$pids $!"',
+    r'  done',
+    r'  set +m',
+    r'  for n in "$@"; do',
+    r'    wait -n && continue',
+    r'    rc=$?',
+    r'    ERROR "A concurrent branch failed (exit code $rc), stopping the rest of them"',
+    r'    for pid in $pids; do kill -TERM -- -$pid ; done 2>/dev/null',
+    r'    wait',
+    r'    break',
+    r'  done',
+    r'  for branch in "$@"; do INFO "Output of $branch:" ; cat $ISCM_PARALLEL_LOGS/$branch.log ; done',
+    r'  return $rc',
+    r'}',
+])
+
+def configset_plan(configs, parallel_groups):
+    """
+    Splits the list of configs of a configset into segments, that are run
+    one after another. Each segment is a list of branches, lists of configs
+    that are run concurrently. Parallel groups are only honored when all of
+    their configs are found together in the configset.
+    """
+    group_of = {}
+    for group in parallel_groups:
+        for branch in group:
+            for name in branch: group_of[name] = group
+    plan = []
+    i = 0
+    while i < len(configs):
+        group = group_of.get(configs[i]) if isinstance(configs[i], basestring) else None
+        if group is not None:
+            members = sum(group, [])
+            branches = [ list(b) for b in group if b ]
+            if len(branches) > 1 and sorted(configs[i:i + len(members)]) == sorted(members):
+                plan.append(branches)
+                i += len(members)
+                continue
+        if plan and len(plan[-1]) == 1:
+            plan[-1][0].append(configs[i])
+        else:
+            plan.append([ [ configs[i] ] ])
+        i += 1
+    return plan
+
+def check_parallel_groups(configs, parallel_groups):
+    """
+    Package managers hold a lock, so packages can't be installed with the
+    same one from concurrent configs
+    """
+    for group in parallel_groups:
+        managers = {}
+        for branch in group:
+            for m in set(sum([ configs[name].get("packages", {}).keys() for name in branch ], [])):
+                if m in [ "apt", "yum", "rpm" ] and managers.has_key(m):
+                    raise RuntimeError("Concurrent configs %s and %s install %s packages" % (managers[m], branch[0], m))
+                managers[m] = branch[0]
+
+def remove_configs(processor, names):
+    """
+    Removes the given configs from a cfn-init or cloud-init processor, along
+    with the configsets and concurrent branches that are left empty
+    """
+    processor.config_names[:] = [ n for n in processor.config_names if n not in names ]
+    prune_configs(processor.configs, processor.config_sets, names)
+    groups = []
+    for group in processor.parallel_groups:
+        branches = [ b for b in [ [ n for n in b if n not in names ] for b in group ] if b ]
+        if len(branches) > 1:
+            groups.append(branches)
+    processor.parallel_groups[:] = groups
+
+def prune_configs(configs, config_sets, names):
+    """
+    Deletes the given configs from a configs dictionary, and from the
+    configsets. Configsets that only had those configs are deleted too.
+    """
+    for name in names:
+        if configs.has_key(name):
+            del configs[name]
+    emptied = []
+    for (cs, members) in config_sets.items():
+        if not members:
+            continue
+        kept = [ m for m in members if m not in names ]
+        if kept:
+            config_sets[cs] = kept
+        else:
+            emptied.append(cs)
+    for cs in emptied:
+        del config_sets[cs]
+    # References to the deleted configsets go too
+    refs = [ { "ConfigSet": cs } for cs in emptied ]
+    if refs:
+        for (cs, members) in config_sets.items():
+            if [ m for m in members if m in refs ]:
+                config_sets[cs] = [ m for m in members if m not in refs ]
+
+from cloudcast.iscm import IscmExpr, BOOTSTRAP_PAYLOAD_MD_KEY
 from cloudcast.template import AWS, Resource
+from cloudcast.elements import CloudCastHelperExpr
+
+def aws_exports_sh(stack_user_key, metadata_url=None):
+    """
+    Returns the shell code exporting the variables that metadata_snapshot_sh
+    needs in order to read the metadata of the resource
+    """
+    exports = [
+        'export AWS__STACK_NAME="', AWS.StackName ,'" ',
+               'AWS__STACKEL_NAME="', Resource.ThisName() , '" ',
+               'AWS__BOOTSTRAP_KEY_ID="', stack_user_key , '" ',
+               'AWS__BOOTSTRAP_SECRET_KEY="', stack_user_key["SecretAccessKey"] , r'" ',
+               'AWS__REGION="', AWS.Region , '"\n',
+    ]
+    if metadata_url is not None:
+        exports += [ 'export ISCM_METADATA_URL="', metadata_url, '"\n' ]
+    return exports
 
 class CfnAttrAccess(object):
     """
@@ -17,6 +218,46 @@ class CfnAttrAccess(object):
     def cfn_expand(self):
         return self.obj.__getattribute__(self.attr)
 
+def _configset_configs(init, cs, seen=()):
+    # The configs run by a configset, in order, following the references
+    # to other configsets
+    if cs in seen:
+        raise RuntimeError("Configset %s refers to itself" % cs)
+    configs = []
+    for m in init["configSets"].get(cs, []):
+        if type(m) == dict and m.has_key("ConfigSet"):
+            configs += _configset_configs(init, m["ConfigSet"], seen + (cs,))
+        else:
+            configs.append([ m, init.get(m) ])
+    return configs
+
+class ConfigsetHashesExpr(CloudCastHelperExpr):
+    """
+    Resolves to the content hash of each configset, as found in the metadata
+    of the resource where it is contained, and the configsets run at boot.
+    A configset hash covers the configs it runs and the metadata entries
+    other than the cfn-init configs (facts, variables...), so changes to
+    those make every configset run again.
+    """
+    def __init__(self, processor):
+        self.processor = processor
+    def resolve(self, stack=None, element=None, cfn_env=None):
+        from cloudcast import _expand_template
+        from cloudcast._utils import stable_digest
+        metadata = dict([ (k, v) for (k, v) in element.el_attrs.get("Metadata", {}).items() if k != CONFIGSETS_MD_KEY ])
+        element.resolve_helper_exprs(stack, metadata)
+        metadata = _expand_template(metadata)
+        init = metadata.get("AWS::CloudFormation::Init", {})
+        data = stable_digest(dict([ (k, v) for (k, v) in metadata.items()
+                                    if k not in [ "AWS::CloudFormation::Init", BOOTSTRAP_PAYLOAD_MD_KEY ] ]))
+        hashes = {}
+        for cs in init.get("configSets", {}).keys():
+            if cs != RECONFIGURE_CONFIGSET:
+                hashes[cs] = stable_digest([ data, _configset_configs(init, cs) ])
+        self.resolvedTo = dict(run=self.processor.run_config_sets.split(","), hashes=hashes)
+    def __repr__(self):
+        return "<ConfigsetHashesExpr>"
+
 class CfnInit(object):
     """
     Configure an instance using cfn-init
@@ -43,13 +284,56 @@ class CfnInit(object):
             for config in self.configs:
                 iscm.iscm_cfninit_add_config(config)
         elif type(self.configs) == dict:
-            for (name,config) in self.configs.iteritems():
+            # Sorted, so the configs run in the same order every time
+            for (name,config) in sorted(self.configs.iteritems()):
                 iscm.iscm_cfninit_add_config(config, name=name)
         else:
             raise RuntimeError("Unrecognized container for configs")
 
 
 
+class Concurrently(object):
+    """
+    Wraps ISCM modules whose cfn-init configs don't depend on each other, so
+    they are applied concurrently in the instance. Each argument is a
+    branch: a module, or a list of modules that depend on each other and are
+    applied in order. The configs of modules that come after this one are
+    only applied once all the branches are done.
+
+    Packages shouldn't be installed with the same package manager from more
+    than one branch, as they would compete for its lock.
+    """
+    def __init__(self, *branches):
+        self.branches = [ list(b) if type(b) in (list, tuple) else [ b ] for b in branches ]
+
+    def install(self, iscm):
+        for branch in self.branches:
+            for mod in branch:
+                mod.install(iscm)
+        if not hasattr(iscm, "iscm_cfninit_add_parallel_group"):
+            raise RuntimeError("Concurrently requires a cfn-init processor that supports parallel groups")
+
+    def deploy(self, iscm):
+        # Intercept the configs added by the modules in each branch
+        import types
+        add_config = iscm.iscm_cfninit_add_config
+        group = []
+        try:
+            for branch in self.branches:
+                names = []
+                def iscm_cfninit_add_config(self, config, name=None):
+                    name = add_config(config, name)
+                    names.append(name)
+                    return name
+                iscm.iscm_cfninit_add_config = types.MethodType(iscm_cfninit_add_config, iscm)
+                for mod in branch:
+                    mod.deploy(iscm)
+                group.append(names)
+        finally:
+            iscm.iscm_cfninit_add_config = add_config
+        iscm.iscm_cfninit_add_parallel_group(*group)
+
+
 class CfnEmbedFile(object):
     """
     Embed a file into the cfn stack. By default, it gzips and base-64 encodes
@@ -127,6 +411,87 @@ class CfnEmbedFile(object):
                 create_config(gzstr)
 
 
+class BootstrapProfile(object):
+    """
+    Describes how the cfn-init tools get onto the instance at boot. The
+    enabled sources are tried in this order:
+
+      - prebaked: the tools are already in the image. They are used as they
+        are, as long as the version marker left by a previous install
+        matches the expected aws-cfn-bootstrap version
+      - wheelhouse: offline install from a wheelhouse directory (or .tar.gz
+        of it) available in the instance. It should contain the
+        aws-cfn-bootstrap package and its dependencies, and get-pip.py plus
+        the pip wheels if pip is not in the image
+      - network: download get-pip.py and the aws-cfn-bootstrap tarball
+        from their upstream locations, as the last resort
+
+    The time taken by each attempted step is logged.
+    """
+    marker_path = "/etc/cloudcast/aws-cfn-bootstrap.version"
+
+    def __init__(self, prebaked=True, wheelhouse=None, network=True):
+        if not prebaked and wheelhouse is None and not network:
+            raise RuntimeError("At least one bootstrap source must be enabled")
+        self.prebaked = prebaked
+        self.wheelhouse = wheelhouse
+        self.network = network
+
+    def get_install_sh(self, get_pip_url, aws_cfn_bootstrap_url):
+        """
+        Returns the shell code that installs the cfn-init tools and leaves
+        the path to cfn-get-metadata in CFN_GETMETA_PATH
+        """
+        import re
+        from os.path import basename
+        version = re.sub(r'\.(tar\.gz|tgz|zip)$', '', basename(aws_cfn_bootstrap_url))
+        lines = [
+            r'[ -z "`which python`" ] && FATAL 1 "Unable to find python"',
+            r'iscm_find_pip() { PIP_PATH=`which pip`; PIP_PATH=${PIP_PATH:-/usr/local/bin/pip}; [ -x "$PIP_PATH" ] ; }',
+            r'iscm_find_cfn_tools() { CFN_GETMETA_PATH=`which cfn-get-metadata`; CFN_GETMETA_PATH=${CFN_GETMETA_PATH:-/usr/local/bin/cfn-get-metadata}; [ -x "$CFN_GETMETA_PATH" ] ; }',
+            # Version of the aws-cfn-bootstrap package that is installed
+            r'iscm_cfn_tools_version() { python -c "import pkg_resources; print(\"aws-cfn-bootstrap-\" + pkg_resources.get_distribution(\"aws-cfn-bootstrap\").version)" 2>/dev/null ; }',
+        ]
+        sources = []
+        if self.prebaked:
+            lines.append(
+                r'iscm_cfn_tools_prebaked() { [ "$(cat %s 2>/dev/null)" = "%s" ] && iscm_find_cfn_tools ; }' % (self.marker_path, version))
+            sources.append("prebaked")
+        if self.wheelhouse is not None:
+            lines += [
+                r'iscm_cfn_tools_wheelhouse() {',
+                r'  local wh=%s' % self.wheelhouse,
+                r'  [ -e "$wh" ] || return 1',
+                r'  if [ -f "$wh" ]; then mkdir -p /tmp/iscm-wheelhouse && tar -xzf "$wh" -C /tmp/iscm-wheelhouse && wh=/tmp/iscm-wheelhouse; fi',
+                r'  iscm_find_pip || { [ -f "$wh/get-pip.py" ] && python "$wh/get-pip.py" --no-index --find-links="$wh" && iscm_find_pip ; } || return 1',
+                r'  $PIP_PATH install --no-index --find-links="$wh" aws-cfn-bootstrap && iscm_find_cfn_tools',
+                r'}',
+            ]
+            sources.append("wheelhouse")
+        if self.network:
+            lines += [
+                r'iscm_cfn_tools_network() {',
+                r'  iscm_find_pip || { curl -L %s | python; }' % get_pip_url,
+                r'  iscm_find_pip || FATAL 1 "Unable to find/install pip, which is required"',
+                r'  iscm_find_cfn_tools || $PIP_PATH install %s' % aws_cfn_bootstrap_url,
+                r'  iscm_find_cfn_tools',
+                r'}',
+            ]
+            sources.append("network")
+        lines += [
+            " || ".join([ r'iscm_timed bootstrap:%s iscm_cfn_tools_%s' % (src, src) for src in sources ]) + \
+                r' || FATAL 1 "Unable to find cfn-init tools"',
+            # The marker is only left when the expected version is the one
+            # installed, the tools found may be of another version
+            r'if [ "$(iscm_cfn_tools_version)" = "%s" ]; then' % version,
+            r'  mkdir -p %s && echo "%s" > %s' % (dirname(self.marker_path), version, self.marker_path),
+            r'else',
+            r'  WARN "The cfn-init tools installed are not %s, the version marker is not written"' % version,
+            r'fi',
+        ]
+        return "\n".join(lines)
+
+
 class CfnInitISCM(object):
     def __init__(self, stack_user_key, **kwargs):
         self.configs = {}
@@ -134,6 +499,7 @@ class CfnInitISCM(object):
         self.config_sets = {}       # Custom order/set of configs to be run
         self.run_config_sets = "default"   # Config sets to be run
         self.unnamed_config_k = 0   # We use this to name configs with no name
+        self.parallel_groups = []   # Groups of config lists that can run concurrently
         #
         # Take care of some bootstrapping params here
         self.stack_user_key = stack_user_key
@@ -143,6 +509,29 @@ class CfnInitISCM(object):
             self.get_pip_url = kwargs['get_pip_url']
         if kwargs.has_key("aws_cfn_bootstrap_url"):
             self.aws_cfn_bootstrap_url = kwargs["aws_cfn_bootstrap_url"]
+        self.bootstrap_profile = BootstrapProfile()
+        if kwargs.get("bootstrap_profile") is not None:
+            self.bootstrap_profile = kwargs["bootstrap_profile"]
+        #
+        # Avoiding CloudFormation API throttling when many instances boot
+        # at once: random delay (seconds) before the first API call, retry
+        # budget and backoff base (seconds) for each call, and alternate
+        # URL where the metadata can be downloaded from
+        self.boot_jitter = kwargs.get("boot_jitter", 0)
+        self.api_retries = kwargs.get("api_retries", 5)
+        self.api_backoff = kwargs.get("api_backoff", 2)
+        self.metadata_url = kwargs.get("metadata_url")
+        #
+        # In-place updates: cfn-hup watches the metadata of the instance
+        # (every hup_interval minutes), and on updates the configsets whose
+        # content hash changed are run again (see CONFIGSETS_MD_KEY)
+        self.reconfigure_on_update = kwargs.get("reconfigure_on_update", False)
+        self.hup_interval = kwargs.get("hup_interval", 5)
+        #
+        # The configsets to run are given to a single cfn-init call, unless
+        # each one of them is to be timed on its own
+        self.time_configsets = kwargs.get("time_configsets", False)
+        self.init_metadata = None   # AWS::CloudFormation::Init entry, once deployed
 
     def iscm_cfninit_add_config(self, config, name=None):
         if name == "configSets":
@@ -154,6 +543,7 @@ class CfnInitISCM(object):
             raise RuntimeError("cfn-init config with name %s already exists") % name
         self.configs[name] = config
         self.config_names.append(name)
+        return name
 
     def iscm_cfninit_get_stack_user_key(self):
         return self.stack_user_key
@@ -164,13 +554,78 @@ class CfnInitISCM(object):
     def iscm_cfninit_run_configsets(self, *configsets):
         self.run_config_sets = ",".join(configsets)
 
+    def iscm_cfninit_add_parallel_group(self, *branches):
+        """
+        Declares that the given lists of configs (branches) don't depend on
+        each other, so they may be run concurrently
+        """
+        self.parallel_groups.append([ list(b) for b in branches ])
+
+    def iscm_cfninit_remove_configs(self, *names):
+        """
+        Removes configs, i.e. because the image the instance boots from
+        already has them applied. Configsets left empty are removed too.
+        """
+        remove_configs(self, names)
+        if self.init_metadata is not None:
+            # The configsets are taken from this processor when rendered
+            for name in names:
+                self.init_metadata.pop(name, None)
+
+    def _get_parallel_configsets(self):
+        # Splits the configsets that have concurrent configs into segments,
+        # each segment (or branch of a segment) being a configset of its own.
+        # Returns the shell code that runs each split configset, and the
+        # split configsets. They are worked out from the current configsets,
+        # so the configs removed after deployment are left out
+        all_config_sets = { "default": self.config_names }
+        all_config_sets.update(self.config_sets)
+        case = []
+        splits = {}
+        for (cs, configs) in sorted(all_config_sets.items()):
+            plan = configset_plan(list(configs), self.parallel_groups)
+            if all([ len(segment) == 1 for segment in plan ]):
+                continue
+            steps = []
+            for (k, segment) in enumerate(plan):
+                if len(segment) == 1:
+                    splits["%s__%d" % (cs, k + 1)] = segment[0]
+                    steps.append("iscm_cfninit '%s__%d'" % (cs, k + 1))
+                    continue
+                for (j, branch) in enumerate(segment):
+                    splits["%s__%d_%d" % (cs, k + 1, j + 1)] = branch
+                steps.append("iscm_run_parallel cfninit: iscm_cfninit " +
+                    " ".join([ "'%s__%d_%d'" % (cs, k + 1, j + 1) for j in range(len(segment)) ]))
+            case.append("  '%s') %s ;;" % (cs, " && ".join(steps)))
+        return (case, splits)
+
+    @property
+    def all_config_sets(self):
+        """
+        The configSets entry of the metadata, as it's rendered
+        """
+        all_config_sets = { "default": self.config_names }
+        all_config_sets.update(self.config_sets)
+        all_config_sets.update(self._get_parallel_configsets()[1])
+        if self.reconfigure_on_update:
+            # Run after the boot configsets, out of the default configset
+            all_config_sets[RECONFIGURE_CONFIGSET] = [ RECONFIGURE_CONFIGSET ]
+        return all_config_sets
+
+    @property
+    def runner_sh(self):
+        """
+        The shell code that runs the configsets, as it's rendered
+        """
+        return self._get_runner_sh(self._get_parallel_configsets()[0])
+
     def install(self, iscm):
         # Load iscm with our methods so they are available to actions and other processors
         import types
         iscm_cfninit = self
         if not hasattr(iscm, "iscm_cfninit_add_config"):
             def wrapper_1(self, config, name=None):
-                iscm_cfninit.iscm_cfninit_add_config(config, name)
+                return iscm_cfninit.iscm_cfninit_add_config(config, name)
             iscm.iscm_cfninit_add_config = types.MethodType(wrapper_1, iscm)
         if not hasattr(iscm, "iscm_cfninit_get_stack_user_key"):
             def wrapper_2(self):
@@ -184,46 +639,152 @@ class CfnInitISCM(object):
             def wrapper_4(self, *configsets):
                 return iscm_cfninit.iscm_cfninit_run_configsets(*configsets)
             iscm.iscm_cfninit_run_configsets = types.MethodType(wrapper_4, iscm)
+        if not hasattr(iscm, "iscm_cfninit_add_parallel_group"):
+            def wrapper_5(self, *branches):
+                return iscm_cfninit.iscm_cfninit_add_parallel_group(*branches)
+            iscm.iscm_cfninit_add_parallel_group = types.MethodType(wrapper_5, iscm)
+        if not hasattr(iscm, "iscm_cfninit_remove_configs"):
+            def wrapper_6(self, *names):
+                return iscm_cfninit.iscm_cfninit_remove_configs(*names)
+            iscm.iscm_cfninit_remove_configs = types.MethodType(wrapper_6, iscm)
 
         iscm.iscm_set_flag("cfninit_installed")
+        if self.reconfigure_on_update:
+            iscm.iscm_set_flag("cfninit_reconfigure")
+
+    def _get_aws_exports(self):
+        return aws_exports_sh(self.stack_user_key, self.metadata_url)
+
+    def _get_runner_sh(self, parallel_case):
+        # The configsets are run by a single cfn-init call, which carries
+        # them over a config that reboots the instance. With time_configsets,
+        # or when some of them have concurrent configs (run segment by
+        # segment), each configset is a cfn-init run of its own, recorded
+        # as a step of its own, and a reboot only resumes the set it's in
+        run_configset = [ r'iscm_run_configset() { iscm_cfninit "$1" ; }' ]
+        if parallel_case:
+            run_configset = [ parallel_sh, r'iscm_run_configset() {', r'  case "$1" in' ] + parallel_case + \
+                [ r'  *) iscm_cfninit "$1" ;;', r'  esac', r'}' ]
+        run_configsets = [ r'iscm_run_configsets() { iscm_timed "cfninit:$1" iscm_cfninit "$1" ; }' ]
+        if self.time_configsets or parallel_case:
+            run_configsets = [
+                r'iscm_run_configsets() {',
+                r'  local cs',
+                r'  for cs in $(echo "$1" | tr , " "); do iscm_timed "cfninit:$cs" iscm_run_configset "$cs" || return $?; done',
+                r'}',
+            ]
+        return "\n".join([
+            r'iscm_cfninit() {',
+            r'  # cfn-init reads the configs from the metadata snapshot',
+            '  cfn-init -v --region "$AWS__REGION" \\',
+            r'    --access-key "$AWS__BOOTSTRAP_KEY_ID" --secret-key "$AWS__BOOTSTRAP_SECRET_KEY" --configsets "$1" $ISCM_METADATA_CACHE',
+            r'}',
+        ] + run_configset + run_configsets)
+
+    def _get_reconfigure_config(self, runner_sh):
+        """
+        Returns the config that sets up cfn-hup, so that metadata updates
+        run the reconfigure script. The script fetches the updated
+        metadata and runs the configsets whose hash changed, recording
+        their hashes as they succeed.
+        """
+        from cloudcast.iscm import _userdata_header
+        key = self.stack_user_key
+        script = [
+            _userdata_header,
+            r'export PATH=$PATH:/usr/local/bin ISCM_API_RETRIES=%d ISCM_API_BACKOFF=%d' % (self.api_retries, self.api_backoff) + "\n"
+        ] + self._get_aws_exports() + [
+            metadata_snapshot_sh + "\n",
+            runner_sh, "\n",
+            "\n".join([
+                r'exec 9> /var/lock/iscm-reconfigure && flock 9 || FATAL 1 "Unable to lock the reconfiguration"',
+                r'{',
+                r'if [ "$1" = "--record" ]; then',
+                r'  # Hashes of the configsets applied at boot',
+                r'  iscm_snapshot_metadata && %s record' % CONFIGSET_HASHES_TOOL,
+                r'  exit $?',
+                r'fi',
+                r'INFO "CloudCast ISCM reconfiguring on $(date)"',
+                r'rm -f $ISCM_METADATA_CACHE ; iscm_timed reconfigure:metadata iscm_fetch_metadata || FATAL 1 "Unable to fetch the instance metadata"',
+                r'for cs in $(%s changed); do' % CONFIGSET_HASHES_TOOL,
+                r'  iscm_timed "reconfigure:$cs" iscm_run_configset "$cs" || FATAL 1 "Configset $cs failed, it will be run again on the next update"',
+                r'  %s record "$cs"' % CONFIGSET_HASHES_TOOL,
+                r'done',
+                r'INFO "CloudCast ISCM reconfiguration completed on $(date)"',
+                r'} 2>&1 | tee -a /var/log/iscm-reconfigure.log',
+                r'exit ${PIPESTATUS[0]}', ""
+            ])
+        ]
+        def private_file(content, mode="000400"):
+            return dict(content=content, owner="root", group="root", mode=mode)
+        return {
+            "files": {
+                "/etc/cfn/cfn-hup.conf": private_file({ "Fn::Join": [ "", [
+                    "[main]\n",
+                    "stack=", AWS.StackName, "\n",
+                    "region=", AWS.Region, "\n",
+                    "interval=%d\n" % self.hup_interval,
+                    "credential-file=/etc/cfn/cfn-credentials\n"
+                ] ] }),
+                "/etc/cfn/cfn-credentials": private_file({ "Fn::Join": [ "", [
+                    "AWSAccessKeyId=", key, "\n",
+                    "AWSSecretKey=", key["SecretAccessKey"], "\n"
+                ] ] }),
+                "/etc/cfn/hooks.d/cloudcast-reconfigure.conf": private_file({ "Fn::Join": [ "", [
+                    "[cloudcast-reconfigure]\n",
+                    "triggers=post.update\n",
+                    "path=Resources.", Resource.ThisName(), ".Metadata\n",
+                    "action=%s\n" % RECONFIGURE_SCRIPT,
+                    "runas=root\n"
+                ] ] }),
+                RECONFIGURE_SCRIPT: private_file({ "Fn::Join": [ "", script ] }, "000700"),
+                CONFIGSET_HASHES_TOOL: private_file(configset_hashes_py, "000700"),
+            },
+            "commands": {
+                "01-record-hashes": dict(command="%s --record" % RECONFIGURE_SCRIPT),
+                "02-start-cfn-hup": dict(command="pgrep -f bin/cfn-hup > /dev/null || cfn-hup"),
+            }
+        }
 
     def deploy(self, iscm):
         #
         # Load configs into the resource metadata, so cfn-init can find them
         # on runtime and get them done
         cfninit_metadata = self.configs
-        #
-        all_config_sets = { "default": self.config_names }
-        all_config_sets.update(self.config_sets)
+        check_parallel_groups(self.configs, self.parallel_groups)
+        # The configsets, and the runner of those split for concurrency, are
+        # only worked out when the template is printed out, once configs
+        # can't be removed anymore
+        runner_sh = CfnAttrAccess(self, "runner_sh")
+        if self.reconfigure_on_update:
+            cfninit_metadata[RECONFIGURE_CONFIGSET] = self._get_reconfigure_config(runner_sh)
         cfninit_metadata.update({
-            "configSets": all_config_sets
+            "configSets": CfnAttrAccess(self, "all_config_sets")
         })
         iscm.iscm_md_update_dict("AWS::CloudFormation::Init", cfninit_metadata)
+        self.init_metadata = iscm.iscm_md_get("AWS::CloudFormation::Init")
+        if self.reconfigure_on_update:
+            # Taken from the metadata of each launchable, once rendered
+            iscm.metadata[CONFIGSETS_MD_KEY] = ConfigsetHashesExpr(self)
 
-        iscm.iscm_ud_append(
-            "\n".join([
-#                r'PATH=$PATH:/bin:/sbin:/usr/bin:/usr/sbin:/usr/local/bin:/usr/local/sbin:/opt/aws/bin',
-                r'[ -z "`which python`" ] && FATAL 1 "Unable to find python"',
-                r'[ -z "`which pip`" ] && [ ! -x /usr/local/bin/pip ] && { curl -L %s | python; }' % self.get_pip_url,
-                r'PIP_PATH=`which pip`',
-                r'PIP_PATH=${PIP_PATH:-/usr/local/bin/pip}',
-                r'[ ! -x "$PIP_PATH" ] && FATAL 1 "Unable to find/install pip, which is required"',
-                r'[ -z "`which cfn-get-metadata`" ] && [ ! -x /usr/local/bin/cfn-get-metadata ] && $PIP_PATH install %s' % self.aws_cfn_bootstrap_url,
-                r'CFN_GETMETA_PATH=`which cfn-get-metadata`',
-                r'CFN_GETMETA_PATH=${CFN_GETMETA_PATH:-/usr/local/bin/cfn-get-metadata}',
-                r'[ ! -x "$CFN_GETMETA_PATH" ] && FATAL 1 "Unable to find cfn-init tools"',
-            ]),
+        # The tools installation and the credentials go into the bootstrap
+        # section, as they are required in order to read the metadata
+        bootstrap = [
+            r'export ISCM_API_RETRIES=%d ISCM_API_BACKOFF=%d' % (self.api_retries, self.api_backoff) + "\n"
+        ]
+        if self.boot_jitter > 0:
+            bootstrap.append(r'sleep $(( RANDOM %% %d ))' % self.boot_jitter + "\n")
+        bootstrap += [
+            self.bootstrap_profile.get_install_sh(self.get_pip_url, self.aws_cfn_bootstrap_url),
             "\n",
-            'export AWS__STACK_NAME="', AWS.StackName ,'" ',
-                   'AWS__STACKEL_NAME="', Resource.ThisName() , '" ',
-                   'AWS__BOOTSTRAP_KEY_ID="', self.stack_user_key , '" ',
-                   'AWS__BOOTSTRAP_SECRET_KEY="', self.stack_user_key["SecretAccessKey"] , r'" ',
-                   'AWS__REGION="', AWS.Region , '"\n',
-            r'cfn-init -v',
-            r' -s "$AWS__STACK_NAME"',
-            r' -r "$AWS__STACKEL_NAME"',
-            r' --region "$AWS__REGION"',
-            r' --access-key "$AWS__BOOTSTRAP_KEY_ID"',
-            r' --secret-key "$AWS__BOOTSTRAP_SECRET_KEY"',
-            r' --configsets ', CfnAttrAccess(self, "run_config_sets")
-        )
+        ] + self._get_aws_exports() + [
+            # Take a fresh snapshot of the metadata on every boot
+            metadata_snapshot_sh + "\n",
+            r'rm -f $ISCM_METADATA_CACHE ; iscm_timed bootstrap:metadata iscm_fetch_metadata || FATAL 1 "Unable to fetch the instance metadata"',
+            "\n"
+        ]
+        iscm.iscm_ud_bootstrap_append(*bootstrap)
+        run = [ r'iscm_run_configsets "', CfnAttrAccess(self, "run_config_sets"), '"' ]
+        if self.reconfigure_on_update:
+            run.append(r' && iscm_timed cfninit:%s iscm_cfninit %s' % (RECONFIGURE_CONFIGSET, RECONFIGURE_CONFIGSET))
+        iscm.iscm_ud_append(runner_sh, "\n", *run)
@@ -0,0 +1,425 @@
+#!/usr/bin/env python
+'''
+Cloud-init backend for the ISCM. It's an alternative to the cfn-init
+processor, that offers the same iscm_cfninit_* interface to the ISCM modules
+(CfnInit, Shell, CfnEmbedFile, phases...), but doesn't need python, pip or
+aws-cfn-bootstrap in the instance before the configs can be applied.
+
+The configs that are to be run are rendered into multipart user data, with
+a shell script part. As with cfn-init, the script takes a snapshot of the
+metadata on boot, from ISCM_METADATA_URL if given, and from the
+CloudFormation API otherwise. The python that cloud-init runs on is used in
+order to call the API, no cfn tools are needed. The snapshot holds the
+values of the configs (file contents, commands and their environment),
+which are staged into files and applied from there. For each config, its
+packages are installed, the staged files moved into place, and its
+commands run, as cfn-init would do. Thus the user data keeps small, it holds
+no secrets other than the stack user key (as with cfn-init), and changes to
+the configs are metadata updates.
+
+Only the packages (apt, yum, python), files and commands sections of the
+configs are supported.
+
+@author: David Losada Carballo <david@tuxpiper.com>
+'''
+
+import types
+from cloudcast import _expand_template
+from cloudcast.elements import fresh_helper_exprs, CloudCastHelperExpr
+from cloudcast.iscm import _userdata_header
+from cloudcast.iscm.cfninit import metadata_snapshot_sh, aws_exports_sh, parallel_sh, configset_plan, \
+    check_parallel_groups, remove_configs
+
+# Where the values of the configs are staged before being put in place
+STAGING_DIR = "/var/lib/cloudcast/cloudinit"
+# Metadata key holding the values of the configs, in staging order
+VALUES_MD_KEY = "CloudCast::CloudInit"
+# CloudFormation limits the size of the user data, before base64 encoding
+USERDATA_LIMIT = 16384
+
+_mime_boundary = "==CloudCastISCM=="
+_intrinsic_fns = [ "Ref", "Fn::GetAtt", "Fn::Join", "Fn::Base64", "Fn::FindInMap",
+                   "Fn::Select", "Fn::GetAZs", "Fn::If", "Fn::Sub", "Fn::ImportValue" ]
+_supported_config_keys = [ "packages", "files", "commands" ]
+
+# Python code that prints the metadata of the resource, read through the
+# CloudFormation API. It runs on python 2 and 3, with the standard library
+# only. ISCM_CFN_ENDPOINT overrides the endpoint (i.e. a VPC endpoint)
+_get_metadata_py = "\n".join([
+    r'import datetime, hashlib, hmac, json, os, sys',
+    r'try:',
+    r'    from urllib.parse import quote',
+    r'    from urllib.request import Request, urlopen',
+    r'except ImportError:',
+    r'    from urllib import quote',
+    r'    from urllib2 import Request, urlopen',
+    r'env = os.environ',
+    r'region = env["AWS__REGION"]',
+    r'host = "cloudformation.%s.amazonaws.com%s" % (region, ".cn" if region.startswith("cn-") else "")',
+    r'params = { "Action": "DescribeStackResource", "Version": "2010-05-15", "ContentType": "JSON",',
+    r'           "StackName": env["AWS__STACK_NAME"], "LogicalResourceId": env["AWS__STACKEL_NAME"] }',
+    r'query = "&".join([ "%s=%s" % (quote(k, safe="-_.~"), quote(v, safe="-_.~")) for (k, v) in sorted(params.items()) ])',
+    r'# Signature version 4 of the request',
+    r'now = datetime.datetime.utcnow()',
+    r'(amz_date, date) = (now.strftime("%Y%m%dT%H%M%SZ"), now.strftime("%Y%m%d"))',
+    r'scope = "%s/%s/cloudformation/aws4_request" % (date, region)',
+    r'sha256 = lambda s: hashlib.sha256(s.encode("utf-8")).hexdigest()',
+    r'canonical = "\n".join([ "GET", "/", query, "host:" + host, "x-amz-date:" + amz_date, "", "host;x-amz-date", sha256("") ])',
+    r'key = ("AWS4" + env["AWS__BOOTSTRAP_SECRET_KEY"]).encode("utf-8")',
+    r'for part in [ date, region, "cloudformation", "aws4_request" ]:',
+    r'    key = hmac.new(key, part.encode("utf-8"), hashlib.sha256).digest()',
+    r'signature = hmac.new(key, "\n".join([ "AWS4-HMAC-SHA256", amz_date, scope, sha256(canonical) ]).encode("utf-8"), hashlib.sha256).hexdigest()',
+    r'request = Request(env.get("ISCM_CFN_ENDPOINT", "https://" + host) + "/?" + query, headers={',
+    r'    "Host": host, "X-Amz-Date": amz_date,',
+    r'    "Authorization": "AWS4-HMAC-SHA256 Credential=%s/%s, SignedHeaders=host;x-amz-date, Signature=%s" % (env["AWS__BOOTSTRAP_KEY_ID"], scope, signature) })',
+    r'response = json.loads(urlopen(request, timeout=30).read().decode("utf-8"))',
+    r'metadata = response["DescribeStackResourceResponse"]["DescribeStackResourceResult"]["StackResourceDetail"]["Metadata"]',
+    r'getattr(sys.stdout, "buffer", sys.stdout).write(metadata.encode("utf-8"))',
+])
+
+# Python code that writes each of the values of the configs, as found in the
+# metadata snapshot, to its own file in the staging folder
+_stage_values_py = "\n".join([
+    r'import json, sys',
+    r'for (n, v) in enumerate(json.load(open(sys.argv[1]))["%s"]):' % VALUES_MD_KEY,
+    r'    if not isinstance(v, type(u"")):',
+    r'        v = json.dumps(v, sort_keys=True)',
+    r'    with open("%s/%03d" % (sys.argv[2], n), "wb") as f:',
+    r'        f.write(v.encode("utf-8"))',
+])
+
+# Shell code that applies the configs in the instance
+_runner_sh = "\n".join([
+    r'ISCM_PYTHON=${ISCM_PYTHON:-$(command -v python3 || command -v python)}',
+    metadata_snapshot_sh,
+    # The API is called from python, instead of cfn-get-metadata
+    r'iscm_get_metadata_api() {',
+    r"  $ISCM_PYTHON - > $ISCM_METADATA_CACHE.$$ <<'ISCM_PYTHON'",
+    _get_metadata_py,
+    r'ISCM_PYTHON',
+    r'}',
+    r'iscm_ci_stage() (',
+    r'  umask 077',
+    r'  rm -rf %s && mkdir -p %s || exit 1' % (STAGING_DIR, STAGING_DIR),
+    r"  $ISCM_PYTHON - $ISCM_METADATA_CACHE %s <<'ISCM_PYTHON'" % STAGING_DIR,
+    _stage_values_py,
+    r'ISCM_PYTHON',
+    r')',
+    r'iscm_ci_file() {',
+    r'  # The content is the staged value $1, base64 encoded if $6 is "base64"',
+    r'  if [ "$6" = "base64" ]; then base64 -d "$1" > "$1.bin" && mv -f "$1.bin" "$1" || return 1; fi',
+    r'  mkdir -p "$(dirname "$2")" && install -m "$3" -o "$4" -g "$5" "$1" "$2"',
+    r'}',
+    r'iscm_ci_command() {',
+    r'  # The command, its working directory and its test are staged values',
+    r'  local name=$1 cmd=$(cat "$2") cwd= ignore=$4 test=',
+    r'  [ -z "$3" ] || cwd=$(cat "$3")',
+    r'  [ -z "$5" ] || test=$(cat "$5")',
+    r'  (',
+    r'    [ -z "$cwd" ] || cd "$cwd" || exit 1',
+    r'    if [ -n "$test" ] && ! sh -c "$test" < /dev/null; then INFO "Skipping command $name, its test failed"; exit 0; fi',
+    r'    sh -c "$cmd" < /dev/null',
+    r'  ) && return 0',
+    r'  [ "$ignore" = "true" ] && { WARN "Command $name failed, ignoring" ; return 0 ; }',
+    r'  ERROR "Command $name failed" ; return 1',
+    r'}',
+    r'iscm_signal() {',
+    r'  local status=SUCCESS id',
+    r'  [ "$1" = "0" ] || status=FAILURE',
+    r'  id=$(curl -fsS --max-time 2 http://169.254.169.254/latest/meta-data/instance-id 2>/dev/null || hostname)',
+    '  curl -fsS --max-time 30 -X PUT -H "Content-Type:" \\',
+    '    --data-binary "{\\"Status\\": \\"$status\\", \\"Reason\\": \\"CloudCast ISCM exit code $1\\", \\"UniqueId\\": \\"$id\\", \\"Data\\": \\"$2\\"}" \\',
+    r'    "$ISCM_WCHANDLE_URL"',
+    r'}',
+    # Fatal errors are signaled through the wait condition handle
+    r'iscm_cfn_signal() { [ -n "$ISCM_WCHANDLE_URL" ] && iscm_retry iscm_signal $1 "$(iscm_timing_summary)" ; }',
+    r'iscm_run_configsets() {',
+    r'  local cs',
+    r'  for cs in $(echo "$1" | tr , " "); do iscm_timed "cloudinit:$cs" iscm_run_configset "$cs" || return $?; done',
+    r'}',
+])
+
+def _is_intrinsic(obj):
+    return type(obj) == dict and len(obj) == 1 and obj.keys()[0] in _intrinsic_fns
+
+def _text_parts(obj):
+    """
+    Returns the pieces (literal strings and CloudFormation expressions)
+    that make up the text a (expanded) value evaluates to
+    """
+    if _is_intrinsic(obj) and obj.has_key("Fn::Join"):
+        (token, members) = obj["Fn::Join"]
+        parts = []
+        for (i, m) in enumerate(members):
+            if i > 0 and token: parts.append(token)
+            parts += _text_parts(m)
+        return parts
+    return [ obj ]
+
+def _sh_quoted(text):
+    """
+    Quotes the literal text as a shell single quoted word
+    """
+    return "'%s'" % text.replace("'", "'\\''")
+
+def _merged(parts):
+    """
+    Joins the adjacent literal strings in a list of pieces
+    """
+    merged = []
+    for p in parts:
+        if isinstance(p, basestring) and merged and isinstance(merged[-1], basestring):
+            merged[-1] += p
+        else:
+            merged.append(p)
+    return merged
+
+class _ConfigsRendering(object):
+    """
+    The shell code that applies the configs to be run, and the values of the
+    configs (file contents, commands...) that it reads from the metadata
+    snapshot. Expression values are only resolved by CloudFormation, in the
+    metadata, so they are never quoted in the shell code
+    """
+    def __init__(self, processor, stack, element):
+        self.processor = processor
+        # Helper expressions are resolved in the context of the launchable,
+        # as the resource does with those in its own attributes
+        # The configs may be shared by several launchables (see ISCMPrototype),
+        # so they are resolved on a copy
+        configs = fresh_helper_exprs(processor.configs)
+        element.resolve_helper_exprs(stack, configs)
+        configs = _expand_template(configs)
+        check_parallel_groups(configs, processor.parallel_groups)
+        config_sets = dict(default=processor.config_names)
+        config_sets.update(_expand_template(processor.config_sets))
+        self.values = []
+        self.sh = self._configs_sh(configs, config_sets)
+
+    def _staged(self, value):
+        # Adds a value to be staged, returns the path of its file
+        self.values.append(value)
+        return "%s/%03d" % (STAGING_DIR, len(self.values) - 1)
+
+    def _configs_to_run(self, configs, config_sets):
+        # Returns the configs in each of the configsets to be run, in order
+        def members(cs):
+            names = []
+            for m in config_sets[cs]:
+                if type(m) == dict and m.has_key("ConfigSet"):
+                    names += members(m["ConfigSet"])
+                else:
+                    names.append(m)
+            return names
+        to_run = []
+        for cs in self.processor.run_config_sets.split(","):
+            if not config_sets.has_key(cs):
+                raise RuntimeError("Unknown cfn-init configset %s" % cs)
+            to_run.append((cs, members(cs)))
+        return to_run
+
+    def _config_sh(self, name, config):
+        # Returns the shell code that applies the config
+        for k in config.keys():
+            if k not in _supported_config_keys:
+                raise RuntimeError("cfn-init config section '%s' (in %s) is not supported by the cloud-init ISCM" % (k, name))
+        sh = []
+        for (manager, packages) in sorted(config.get("packages", {}).items()):
+            pkgs = []
+            for (pkg, versions) in sorted(packages.items()):
+                version = versions[0] if type(versions) == list and versions else None
+                if manager == "apt":
+                    pkgs.append(pkg + ("=" + version if version else ""))
+                elif manager == "yum":
+                    pkgs.append(pkg + ("-" + version if version else ""))
+                elif manager == "python":
+                    pkgs.append(pkg + ("==" + version if version else ""))
+                else:
+                    raise RuntimeError("Package manager %s (in %s) is not supported by the cloud-init ISCM" % (manager, name))
+            install = {
+                "apt": "DEBIAN_FRONTEND=noninteractive apt-get install -y",
+                "yum": "yum install -y",
+                "python": "pip install"
+            }[manager]
+            sh.append("  %s %s || return 1\n" % (install, " ".join([ _sh_quoted(p) for p in pkgs ])))
+        for (path, f) in sorted(config.get("files", {}).items()):
+            if f.has_key("source") or not f.has_key("content"):
+                raise RuntimeError("Only files with content are supported by the cloud-init ISCM (%s in %s)" % (path, name))
+            if f.get("mode", "").startswith("120"):
+                raise RuntimeError("Symlinks are not supported by the cloud-init ISCM (%s in %s)" % (path, name))
+            sh.append("  iscm_ci_file %s %s %s || return 1\n" % (self._staged(f["content"]), _sh_quoted(path), " ".join([
+                _sh_quoted(f.get(k, default)) for (k, default) in [ ("mode", "000644"), ("owner", "root"), ("group", "root"), ("encoding", "plain") ] ])))
+        # cfn-init runs commands in alphabetical order of their names
+        for (cname, c) in sorted(config.get("commands", {}).items()):
+            command = c["command"] if not type(c["command"]) == list else \
+                " ".join([ "'%s'" % a.replace("'", "'\\''") for a in c["command"] ])
+            call = "iscm_ci_command %s %s %s %s %s" % (_sh_quoted(cname), self._staged(command),
+                self._staged(c["cwd"]) if c.has_key("cwd") else "''",
+                "true" if str(c.get("ignoreErrors", "false")).lower() == "true" else "false",
+                self._staged(c["test"]) if c.has_key("test") else "''")
+            if c.get("env"):
+                exports = [ 'export %s="$(cat %s)" ; ' % (k, self._staged(v)) for (k, v) in sorted(c["env"].items()) ]
+                sh.append("  ( %s%s ) || return 1\n" % ("".join(exports), call))
+            else:
+                sh.append("  %s || return 1\n" % call)
+        return sh
+
+    def _configs_sh(self, configs, config_sets):
+        run_sh = []
+        configsets_sh = [ "iscm_run_configset() {\n  case \"$1\" in\n" ]
+        branches_sh = [ "iscm_run_branch() {\n  case \"$1\" in\n" ]
+        functions = {}      # config name -> shell function that applies it
+        for (cs, names) in self._configs_to_run(configs, config_sets):
+            for name in names:
+                if functions.has_key(name):
+                    continue
+                functions[name] = "iscm_config_%d" % (len(functions) + 1)
+                run_sh += [ "%s() {\n" % functions[name] ] + self._config_sh(name, configs[name]) + [ "  :\n}\n" ]
+            # Concurrent configs are run in branches
+            steps = []
+            for (k, segment) in enumerate(configset_plan(names, self.processor.parallel_groups)):
+                if len(segment) == 1:
+                    steps += [ functions[n] for n in segment[0] ]
+                    continue
+                branches = []
+                for (j, branch) in enumerate(segment):
+                    branches.append("%s__%d_%d" % (cs, k + 1, j + 1))
+                    branches_sh.append("  '%s') %s ;;\n" % (branches[-1], " && ".join([ functions[n] for n in branch ])))
+                steps.append("iscm_run_parallel cloudinit: iscm_run_branch " + " ".join([ "'%s'" % b for b in branches ]))
+            configsets_sh.append("  '%s') %s ;;\n" % (cs, " && ".join(steps or [ ":" ])))
+        configsets_sh.append("  *) ERROR \"Unknown configset $1\" ; return 1 ;;\n  esac\n}\n")
+        if len(branches_sh) > 1:
+            configsets_sh += [ parallel_sh, "\n" ] + branches_sh + [ "  esac\n}\n" ]
+        return run_sh + configsets_sh
+
+class _CloudInitValues(CloudCastHelperExpr):
+    """
+    Resolves to the values of the configs that are staged on boot, for the
+    resource where it is contained
+    """
+    def __init__(self, processor):
+        self.processor = processor
+    def resolve(self, stack=None, element=None, cfn_env=None):
+        self.resolvedTo = _ConfigsRendering(self.processor, stack, element).values
+    def __repr__(self):
+        return "<_CloudInitValues>"
+
+class _CloudInitUserData(CloudCastHelperExpr):
+    """
+    Resolves to the multipart user data, for the resource where it is
+    contained
+    """
+    def __init__(self, processor, iscm):
+        self.processor = processor
+        self.iscm = iscm
+
+    def resolve(self, stack=None, element=None, cfn_env=None):
+        processor = self.processor
+        configs_sh = _ConfigsRendering(processor, stack, element).sh
+        bootstrap = [
+            r'export ISCM_API_RETRIES=%d ISCM_API_BACKOFF=%d' % (processor.api_retries, processor.api_backoff) + "\n"
+        ] + aws_exports_sh(processor.stack_user_key, processor.metadata_url) + [
+            "\n".join([
+                r'rm -f $ISCM_METADATA_CACHE ; iscm_timed bootstrap:metadata iscm_fetch_metadata || FATAL 1 "Unable to fetch the instance metadata"',
+                r'iscm_ci_stage || FATAL 1 "Unable to stage the values of the configs"',
+                "\n"
+            ])
+        ]
+        element.resolve_helper_exprs(stack, [ bootstrap, self.iscm.bootstrap_elems, self.iscm.userdata_elems ])
+        script = [ _userdata_header ] + _expand_template(self.iscm._get_wc_handle_userdata()) + [
+            "\n".join([
+                r'{',
+                r'INFO "CloudCast ISCM booting on $(date), with cloud-init"',
+                r'iscm_boot_t0=$(iscm_now)',
+                _runner_sh,
+                "\n"
+            ])
+        ] + _expand_template(bootstrap + self.iscm.bootstrap_elems + self.iscm.userdata_elems) + [ "\n" ] + \
+            configs_sh + [
+            r'iscm_run_configsets ', _sh_quoted(processor.run_config_sets),
+            "\n".join([ "",
+                r'iscm_result=$?',
+                r'iscm_record boot $iscm_boot_t0 $(iscm_now) $iscm_result',
+                r'iscm_cfn_signal $iscm_result',
+                '\nINFO "CloudCast ISCM successfully completed on $(date)"',
+                '} 2>&1 | tee -a /iscm.log\n'
+            ])
+        ]
+        parts = _merged(
+            [ 'Content-Type: multipart/mixed; boundary="%s"\nMIME-Version: 1.0\n\n' % _mime_boundary ] +
+            [ '--%s\nContent-Type: text/x-shellscript; charset="utf-8"\nMIME-Version: 1.0\n\n' % _mime_boundary ] +
+            sum([ _text_parts(e) for e in script ], []) +
+            [ '--%s--\n' % _mime_boundary ])
+        #
+        static_size = sum([ len(p) for p in parts if isinstance(p, basestring) ])
+        if static_size > USERDATA_LIMIT:
+            raise RuntimeError("The cloud-init user data takes at least %d bytes, over the %d bytes limit" % (static_size, USERDATA_LIMIT))
+        self.resolvedTo = { "Fn::Join": [ "", parts ] }
+
+    def __repr__(self):
+        return "<_CloudInitUserData>"
+
+class CloudInitISCM(object):
+    """
+    ISCM processor that applies the cfn-init configs through cloud-init,
+    see the module documentation
+    """
+    def __init__(self, stack_user_key, **kwargs):
+        self.configs = {}
+        self.config_names = []      # Keeps runtime order of configs
+        self.config_sets = {}       # Custom order/set of configs to be run
+        self.run_config_sets = "default"   # Config sets to be run
+        self.unnamed_config_k = 0   # We use this to name configs with no name
+        self.parallel_groups = []   # Groups of config lists that can run concurrently
+        # The key is used to read the metadata, and the modules may use it
+        # to access the stack too
+        self.stack_user_key = stack_user_key
+        # Retry budget (attempts) and backoff base (seconds) for the API calls
+        self.api_retries = kwargs.get("api_retries", 5)
+        self.api_backoff = kwargs.get("api_backoff", 2)
+        # The metadata snapshot is taken from this URL if given
+        self.metadata_url = kwargs.get("metadata_url")
+
+    def iscm_cfninit_add_config(self, config, name=None):
+        if name is None:
+            name = "cfninit_%03d" % self.unnamed_config_k
+            self.unnamed_config_k += 1
+        if self.configs.has_key(name):
+            raise RuntimeError("cfn-init config with name %s already exists" % name)
+        self.configs[name] = config
+        self.config_names.append(name)
+        return name
+
+    def iscm_cfninit_get_stack_user_key(self):
+        return self.stack_user_key
+
+    def iscm_cfninit_add_configset(self, name, *configs):
+        self.config_sets[name] = configs
+
+    def iscm_cfninit_run_configsets(self, *configsets):
+        self.run_config_sets = ",".join(configsets)
+
+    def iscm_cfninit_add_parallel_group(self, *branches):
+        self.parallel_groups.append([ list(b) for b in branches ])
+
+    def iscm_cfninit_remove_configs(self, *names):
+        remove_configs(self, names)
+
+    def install(self, iscm):
+        # Provide the same methods as the cfn-init processor, so the modules
+        # that depend on it can work on top of this one
+        def delegate(method):
+            def wrapper(self, *args, **kwargs):
+                return getattr(processor, method)(*args, **kwargs)
+            return wrapper
+        processor = self
+        for method in [ "iscm_cfninit_add_config", "iscm_cfninit_get_stack_user_key",
+                        "iscm_cfninit_add_configset", "iscm_cfninit_run_configsets",
+                        "iscm_cfninit_add_parallel_group", "iscm_cfninit_remove_configs" ]:
+            if not hasattr(iscm, method):
+                setattr(iscm, method, types.MethodType(delegate(method), iscm))
+        iscm.iscm_set_flag("cfninit_installed")
+
+    def deploy(self, iscm):
+        iscm.metadata[VALUES_MD_KEY] = _CloudInitValues(self)
+        iscm.iscm_set_var("userdata_renderer", lambda iscm, launchable: [ _CloudInitUserData(self, iscm) ])
@@ -1,21 +1,26 @@
 from cloudcast.iscm import ISCM
 from cloudcast.iscm.cfninit import CfnInit, CfnInitISCM
+from cloudcast._utils import DigestTree
+from cloudcast import tracing
 
 from cloudcast.template import *
 
-def _dict_to_stable_str(dic):
-    # Get a stable representation of a nested data structure into string
-    from pprint import pformat
-    return pformat(dic, width=2**16)
-
 PURPOSE_BUILD = "build"
 PURPOSE_RUN = "run"
 
 class PhasedISCM(ISCM):
-    def __init__(self, context=None, phases=None, **kwargs):
+    def __init__(self, context=None, phases=None, bootstrap_profile=None, processor=None, reconfigure_on_update=False,
+                 time_configsets=False, **kwargs):
         self.phases = phases
         self.phase_names = [ p.phase_name for p in phases ]
-        self.cfn_init = CfnInitISCM(context["_iscm"]["cfninit_key"])
+        # The phases are run by cfn-init, unless an alternative processor
+        # with the same interface is given (i.e. CloudInitISCM)
+        if processor is None:
+            processor = CfnInitISCM(context["_iscm"]["cfninit_key"], bootstrap_profile=bootstrap_profile,
+                                    reconfigure_on_update=reconfigure_on_update, time_configsets=time_configsets)
+        elif reconfigure_on_update or time_configsets:
+            raise RuntimeError("reconfigure_on_update and time_configsets are options of the default cfn-init processor")
+        self.cfn_init = processor
         #
         ISCM.__init__(self, context, [self.cfn_init], phases, **kwargs)
         #
@@ -24,10 +29,51 @@ class PhasedISCM(ISCM):
         return True
 
     def set_phases_to_run(self, phases):
+        self._ensure_deployed()
         configsets = []
         for p in phases: configsets.append(p.phase_name)
         self.iscm_cfninit_run_configsets(*configsets)
-        
+
+    def set_entry_point(self, status_id, prune_baked=True):
+        """
+        Boot from an image that was baked up to the given entry point (see
+        get_possible_builds), so only the phases pending from there are run.
+        With prune_baked, the configs, configsets and metadata entries that
+        belong only to the phases already in the image are dropped from the
+        template.
+        """
+        for build in self.get_possible_builds():
+            if build["status_id"] == status_id:
+                break
+        else:
+            raise RuntimeError("%s is not an entry point of this ISCM" % status_id)
+        self.set_phases_to_run(build["run_phases"])
+        if prune_baked:
+            self._prune_phases([ p for p in self.phases if p not in build["run_phases"] ])
+
+    def _prune_phases(self, baked):
+        kept = [ p for p in self.phases if p not in baked ]
+        configs = []
+        for p in baked:
+            configs += p.cfn_configs
+        self.iscm_cfninit_remove_configs(*configs)
+        # Metadata entries are kept if a pending phase sets them too
+        for p in baked:
+            for (keypath, updates) in p.actions["dict_updates"].items():
+                entry = self.iscm_md_get(keypath)
+                if type(entry) != dict:
+                    continue
+                kept_keys = set()
+                for k in kept:
+                    for data in k.actions["dict_updates"].get(keypath, []):
+                        kept_keys.update(data.keys())
+                for data in updates:
+                    for key in data.keys():
+                        if key not in kept_keys and entry.has_key(key):
+                            del entry[key]
+                if not entry:
+                    self.iscm_md_delete(keypath)
+
     def get_possible_builds(self, purpose=PURPOSE_RUN):
         """
         Returns a list of possible status ids that are valid entry points
@@ -44,6 +90,11 @@ class PhasedISCM(ISCM):
         the array is sorted in such a way that entries with the least pending
         phases are found first.
 
+        The status id after running phases 1..N is the hex sha256 of the
+        concatenated phase digests d1 + d2 + ... + dN, where each phase digest
+        is the Merkle-style digest (see cloudcast._utils.DigestTree) of the
+        phase dictionary representation (see Phase.get_dict_repr).
+
         When purpose = PURPOSE_BUILD, each runnable path contains a list of the
         buildable targets and the phases that need to be run to achieve them:
 
@@ -63,9 +114,15 @@ class PhasedISCM(ISCM):
          ]}
         ]
         """
+        # The phase digests are taken as the phases are deployed
+        self._ensure_deployed()
+        with tracing.span("get_possible_builds", purpose=purpose):
+            return self._get_possible_builds(purpose)
+
+    def _get_possible_builds(self, purpose):
         import hashlib
         from copy import copy
-        
+        #
         phases = self.phases
         pending_list = copy(phases)
         must_run_list = []
@@ -74,7 +131,7 @@ class PhasedISCM(ISCM):
         status_id_after = {}    # after phase_name
         #
         for p in copy(pending_list):
-            hashsum.update(_dict_to_stable_str(p.get_dict_repr()))
+            hashsum.update(p.get_digest())
             status_id_after[p.phase_name] = hashsum.hexdigest()
             pending_list = pending_list[1:]
             if p.phase_type == RUN_EVERY_TIME:
@@ -131,6 +188,11 @@ class Phase(object):
             dict_updates = {},
             cfninit_configs = {}
         )
+        # Digests of the actions, taken as they are recorded
+        self.action_digests = dict(
+            dict_updates = {},
+            cfninit_configs = {}
+        )
 
     def get_dict_repr(self):
         """
@@ -144,14 +206,29 @@ class Phase(object):
             actions = self.actions
             )
 
+    def get_digest(self):
+        """
+        Return the digest of the dictionary representation of this phase,
+        combining the digests of the actions that were recorded
+        """
+        return DigestTree(dict(
+            phase_name = self.phase_name,
+            phase_type = self.phase_type,
+            actions = self.action_digests
+            )).hexdigest()
+
     def install(self, iscm):
-        for mod in self.modules:
-            mod.install(iscm)
+        # Modules may add configs as they are installed too
+        with self._hijacked_iscm_calls(iscm):
+            for mod in self.modules:
+                with tracing.span("install", mod):
+                    mod.install(iscm)
 
     def deploy(self, iscm):
         with self._hijacked_iscm_calls(iscm):
             for mod in self.modules:
-                mod.deploy(iscm)
+                with tracing.span("deploy", mod):
+                    mod.deploy(iscm)
 
     def __repr__(self):
         return "<%s('%s')>" % (self.__class__.__name__, self.phase_name)
@@ -174,7 +251,9 @@ class Phase(object):
             # This is used for variable setting mostly...
             if not phase.actions['dict_updates'].has_key(keypath):
                 phase.actions['dict_updates'][keypath] = []
+                phase.action_digests['dict_updates'][keypath] = []
             phase.actions['dict_updates'][keypath].append(data)
+            phase.action_digests['dict_updates'][keypath].append(DigestTree(data))
             # Invoke hijacked method
             return self._hijacked["iscm_md_update_dict"](keypath, data)
         def iscm_cfninit_add_config(self, config, name=None):
@@ -182,6 +261,7 @@ class Phase(object):
             if name is None:
                 name = "%s-%03d" % (phase.phase_name, len(phase.actions['cfninit_configs']) + 1)
             phase.actions['cfninit_configs'][name] = config
+            phase.action_digests['cfninit_configs'][name] = DigestTree(config)
             phase.cfn_configs.append(name)
             # Invoke hijacked method
             return self._hijacked["iscm_cfninit_add_config"](config, name)
@@ -9,10 +9,41 @@ INFO()  { echo "[INFO] $*" >&2 ; }
 get_instance_id() { wget -q -O - http://169.254.169.254/latest/meta-data/instance-id ; }
 export AWS__INSTANCE_ID=$(get_instance_id)
 
+# Retries a command with exponential backoff and jitter, within the budget
+retry() {
+    local budget=${ISCM_API_RETRIES:-5} base=${ISCM_API_BACKOFF:-2} n=1
+    until "$@"; do
+        [ $n -ge $budget ] && return 1
+        [ $base -gt 0 ] && sleep $(( RANDOM % (base << (n < 6 ? n : 6)) + 1 ))
+        n=$((n + 1))
+    done
+}
+
+# The metadata is read from the snapshot taken on boot. It's only fetched
+# when the snapshot is missing, from ISCM_METADATA_URL if given, and from
+# the stack otherwise
+get_metadata_url() { curl -fsS --max-time 30 "$ISCM_METADATA_URL" > $ISCM_METADATA_CACHE.$$ ; }
+get_metadata_api() {
+    cfn-get-metadata -s $AWS__STACK_NAME -r $AWS__STACKEL_NAME \
+        --access-key $AWS__BOOTSTRAP_KEY_ID \
+        --secret-key $AWS__BOOTSTRAP_SECRET_KEY \
+        --region $AWS__REGION > $ISCM_METADATA_CACHE.$$
+}
+# The snapshot holds the stack user secret key, only root should read it
+snapshot_metadata() {
+    [ -s "${ISCM_METADATA_CACHE:?}" ] && return 0
+    ( umask 077
+      mkdir -p $(dirname $ISCM_METADATA_CACHE)
+      { { [ -n "$ISCM_METADATA_URL" ] && retry get_metadata_url ; } || retry get_metadata_api ; } && \
+          mv -f $ISCM_METADATA_CACHE.$$ $ISCM_METADATA_CACHE || { rm -f $ISCM_METADATA_CACHE.$$ ; exit 1 ; } )
+}
+
 load_shell_vars() {
     local decode_vars_py=$(cat <<"EOF"
 import json, sys
-doc = json.load(sys.stdin, encoding="latin-1")
+doc = json.load(open(sys.argv[1]), encoding="latin-1")
+for k in sys.argv[2].split("."):
+    doc = doc[k]
 for (k,v) in doc.iteritems():
     if not isinstance(v,str) and not isinstance(v,unicode):
         continue
@@ -22,11 +53,8 @@ for (k,v) in doc.iteritems():
 EOF
 )
     local stack_vars_file=$(mktemp)
-    { cfn-get-metadata -s $AWS__STACK_NAME -r $AWS__STACKEL_NAME \
-        --access-key $AWS__BOOTSTRAP_KEY_ID \
-        --secret-key $AWS__BOOTSTRAP_SECRET_KEY \
-        --region $AWS__REGION -k ${SHELL_ISCM_METADATA_VARS_KEY} | \
-        python -c "$decode_vars_py" > $stack_vars_file ; } || \
+    { snapshot_metadata && \
+        python -c "$decode_vars_py" $ISCM_METADATA_CACHE ${SHELL_ISCM_METADATA_VARS_KEY} > $stack_vars_file ; } || \
         FATAL 1 "Unable to load stack variables"
     source $stack_vars_file
     rm $stack_vars_file
@@ -4,7 +4,32 @@ set -e
 
 : ${ANSIBLE_HOME:?} ${ANSIBLE_VERSION:?}
 
-{ if [ -z "$(which virtualenv)" ]; then pip install virtualenv==12.0.4 ; else true ; fi } && \
+# When ANSIBLE_WHEELHOUSE points to a directory (or .tar.gz of it) in the
+# instance, packages are installed from it, without reaching the network
+INFO()  { echo "[INFO] $*" >&2 ; }
+iscm_now() { cut -d" " -f1 /proc/uptime ; }
+iscm_timed() {
+  local step=$1 t0=$(iscm_now) rc; shift
+  "$@" && rc=0 || rc=$?
+  echo "{\"step\": \"$step\", \"start\": $t0, \"end\": $(iscm_now), \"rc\": $rc}" >> ${ISCM_TIMING_LOG:-/var/log/iscm-timing.jsonl}
+  INFO "$step took $(awk -v t0=$t0 -v t1=$(iscm_now) "BEGIN { printf \"%.2f\", t1 - t0 }")s (exit code $rc)"
+  return $rc
+}
+
+if [ -n "$ANSIBLE_WHEELHOUSE" ] && [ -f "$ANSIBLE_WHEELHOUSE" ]; then
+  mkdir -p /tmp/ansible-wheelhouse
+  tar -xzf "$ANSIBLE_WHEELHOUSE" -C /tmp/ansible-wheelhouse
+  ANSIBLE_WHEELHOUSE=/tmp/ansible-wheelhouse
+fi
+pip_install() {
+  if [ -n "$ANSIBLE_WHEELHOUSE" ] && [ -d "$ANSIBLE_WHEELHOUSE" ]; then
+    pip install --no-index --find-links="$ANSIBLE_WHEELHOUSE" "$@"
+  else
+    pip install "$@"
+  fi
+}
+
+{ if [ -z "$(which virtualenv)" ]; then iscm_timed bootstrap:virtualenv pip_install virtualenv==12.0.4 ; else true ; fi } && \
   { if [ ! -f $ANSIBLE_HOME/bin/activate ]; then virtualenv --system-site-packages $ANSIBLE_HOME ; else true ; fi }
 
 . $ANSIBLE_HOME/bin/activate
@@ -19,7 +44,8 @@ ver_check() {
       [[ ( ! -z "${v[2]}" ) && ( ${v[2]} -ge ${w[2]} ) ]]
 }
 
-ver_check ansible $ANSIBLE_VERSION && exit 0
+# Pre-baked ansible of the right version is used as it is
+ver_check ansible $ANSIBLE_VERSION && { INFO "bootstrap:ansible pre-baked ansible found" ; exit 0 ; }
 
 eval `lsb_release -irs | awk 'NR == 1 { printf "export LSB_DISTRO=%s\n", $1 } NR == 2 { printf "export LSB_VERSION=%s\n", $1 }'`
 
@@ -38,6 +64,5 @@ case "$LSB_DISTRO" in
     ;;
 esac
 
-pip install boto==2.38.0
-pip install ansible==${ANSIBLE_VERSION}
-
+iscm_timed bootstrap:boto pip_install boto==2.38.0
+iscm_timed bootstrap:ansible pip_install ansible==${ANSIBLE_VERSION}
@@ -0,0 +1,77 @@
+# Ansible callback plugin that records how long each task takes, in the
+# format of the ISCM timing log (one JSON record per line, with monotonic
+# timestamps in seconds since the instance booted):
+#
+#   {"step": "ansible-task:boot:install packages", "start": 52.1, "end": 80.3, "rc": 0}
+#
+# The slowest tasks are listed at the end of each run.
+#
+# Written against the callback interface of ansible 1.x, which later
+# versions still forward to.
+
+import json
+import os
+
+try:
+    from ansible.plugins.callback import CallbackBase
+except ImportError:
+    CallbackBase = object
+
+TASK_LOG = os.environ.get("ISCM_ANSIBLE_TASK_LOG", "/var/log/iscm-ansible-tasks.jsonl")
+SLOWEST = 10
+
+
+def _now():
+    with open("/proc/uptime") as f:
+        return float(f.read().split()[0])
+
+
+class CallbackModule(CallbackBase):
+    CALLBACK_VERSION = 2.0
+    CALLBACK_TYPE = "aggregate"
+    CALLBACK_NAME = "iscm_timing"
+
+    def __init__(self, *args, **kwargs):
+        if CallbackBase is not object:
+            CallbackBase.__init__(self, *args, **kwargs)
+        self.run = os.environ.get("ISCM_ANSIBLE_RUN", "ansible")
+        self.current = None     # (task name, start)
+        self.failed = False
+        self.records = []
+
+    def _task_done(self):
+        if self.current is None:
+            return
+        (name, start) = self.current
+        record = dict(step="ansible-task:%s:%s" % (self.run, name), start=start, end=_now(),
+                      rc=1 if self.failed else 0)
+        self.records.append(record)
+        try:
+            with open(TASK_LOG, "a") as f:
+                f.write(json.dumps(record) + "\n")
+        except IOError:
+            pass
+        self.current = None
+
+    def playbook_on_task_start(self, name, is_conditional):
+        self._task_done()
+        self.current = (name, _now())
+        self.failed = False
+
+    def playbook_on_handler_task_start(self, name):
+        self.playbook_on_task_start(name, False)
+
+    def runner_on_failed(self, host, res, ignore_errors=False):
+        if not ignore_errors:
+            self.failed = True
+
+    def runner_on_unreachable(self, host, res):
+        self.failed = True
+
+    def playbook_on_stats(self, stats):
+        self._task_done()
+        slowest = sorted(self.records, key=lambda r: r["start"] - r["end"])[:SLOWEST]
+        if slowest:
+            print("[INFO] Slowest tasks of the %s run:" % self.run)
+            for r in slowest:
+                print("[INFO] %9.2fs  %s" % (r["end"] - r["start"], r["step"]))
@@ -1,11 +1,141 @@
 #!/usr/bin/env python
 
-import os.path
-from cloudcast._utils import caller_folder, search_file
+import os.path, re
+from cloudcast._utils import caller_folder, search_file, stat_cached, stable_digest
 from cloudcast.template import AWS, Resource
+from cloudcast.iscm.timing import timed_command
+from cloudcast.iscm.cfninit import METADATA_CACHE
 
 _shellinit_file = os.path.join(os.path.dirname(__file__), "scripts", "init.sh")
 
+# Where the scripts are written in the instance
+SHELL_ISCM_DIR = "/root/shell-iscm"
+
+# Start of a here-document (<<WORD, <<-WORD, <<"WORD" or <<'WORD'), matched
+# after a << that isn't part of <<<
+_heredoc_start = re.compile(r"""<<(-?)[ \t]*(["']?)([A-Za-z_]\w*)\2""")
+
+def _sh_line_state(line, nesting):
+    """
+    Follows the quoting of a line of shell code. The nesting is the tuple
+    of quotes and command substitutions open at the start of the line
+    (empty if none). Returns the nesting at the end of the line, the part
+    of the line that is code (that is, without a trailing comment), and the
+    (delimiter, tabs stripped) of the here-documents started in the line
+    """
+    nesting = list(nesting)
+    heredocs = []
+    i = 0
+    while i < len(line):
+        c = line[i]
+        top = nesting[-1] if nesting else None
+        if top in (None, "$(", "("):
+            # Code, at the top level or inside a command substitution
+            if c == "\\":
+                i += 1
+            elif c == "#" and (i == 0 or line[i-1] in " \t;&|("):
+                if top is None:
+                    return ((), line[:i], heredocs)
+                break
+            elif c == "$" and line[i+1:i+2] == "'":
+                nesting.append("$'")
+                i += 1
+            elif c == "$" and line[i+1:i+2] == "(":
+                nesting.append("$(")
+                i += 1
+            elif c == "(" and top is not None:
+                nesting.append("(")
+            elif c == ")" and top is not None:
+                nesting.pop()
+            elif c in "'\"`":
+                nesting.append(c)
+            elif line.startswith("<<", i) and not line.startswith("<<<", i) and line[i-1:i] != "<":
+                m = _heredoc_start.match(line, i)
+                if m is not None:
+                    heredocs.append((m.group(3), bool(m.group(1))))
+                    i = m.end() - 1
+                else:
+                    i += 1
+        elif top == "'":
+            if c == "'": nesting.pop()
+        elif top == '"':
+            if c == "\\":
+                i += 1
+            elif c == '"':
+                nesting.pop()
+            elif c == "$" and line[i+1:i+2] == "(":
+                nesting.append("$(")
+                i += 1
+            elif c == "`":
+                nesting.append(c)
+        else:
+            # Backquotes and $'...' strings
+            if c == "\\":
+                i += 1
+            elif c == top[-1]:
+                nesting.pop()
+        i += 1
+    return (tuple(nesting), line, heredocs)
+
+def minify_sh(script, keep_shebang=True):
+    """
+    Removes the comment lines, blank lines and indentation of a shell
+    script. Only what is certainly not part of a string or here-document
+    is removed: lines that start inside a quoted string or a command
+    substitution, here-document bodies and lines continued from the
+    previous one are left as they are. The shebang line is kept, unless
+    keep_shebang is False.
+    """
+    out = []
+    nesting = ()        # quotes and substitutions open at the end of the previous line
+    heredocs = []       # (delimiter, tabs stripped) of the pending here-documents
+    continued = False   # previous line ended with a backslash
+    lines = script.split("\n")
+    for (n, line) in enumerate(lines):
+        if heredocs:
+            out.append(line)
+            (delimiter, dash) = heredocs[0]
+            if (line.lstrip("\t") if dash else line) == delimiter:
+                heredocs.pop(0)
+            continue
+        if nesting or continued:
+            (nesting, code, started) = _sh_line_state(line, nesting)
+            out.append(line)
+        else:
+            stripped = line.strip()
+            if n == 0 and keep_shebang and stripped.startswith("#!"):
+                out.append(line)
+                continue
+            if not stripped or stripped.startswith("#"):
+                continue
+            (nesting, code, started) = _sh_line_state(stripped, ())
+            out.append(stripped)
+        heredocs += started
+        continued = not nesting and code.endswith("\\") and not code.endswith("\\\\")
+    return "".join([ l + "\n" for l in out ]) if script.endswith("\n") else "\n".join(out)
+
+def _read_script(path):
+    with open(path, "r") as f:
+        data = f.read()
+    # Ensure trailing new line
+    if data and data[-1] != "\n": data += "\n"
+    return data
+
+def _read_script_minified(path):
+    # Scripts are concatenated after the shebang of the bundle, or sourced
+    return minify_sh(_read_script(path), keep_shebang=False)
+
+def _gzipped_file(path, contents, attrs):
+    # cfn-init files and commands that write the contents gzipped, and expand
+    # them in place
+    from base64 import b64encode
+    from cloudcast._utils import in_mem_gzip
+    with in_mem_gzip(contents, os.path.basename(path)) as gzstr:
+        encoded = b64encode(gzstr.getvalue())
+    files = { path + ".gz": dict(attrs, content=encoded, encoding="base64") }
+    commands = { "gunzip-%s" % os.path.basename(path): { "command": "gunzip -n -f %s.gz" % path } }
+    return (files, commands)
+
 class Shell(object):
     """
     Configure an instance using shell scripts
@@ -31,12 +161,17 @@ class Shell(object):
         self.scripts = []
         if scripts is not None:
             self.scripts = scripts
+        # Comments, blank lines and indentation can be removed from the
+        # scripts, and they can be embedded gzipped
+        self.minify = kwargs.get("minify", False)
+        self.compress = kwargs.get("compress", False)
 
     def install(self, iscm):
         # This iscm module uses the cfn-init module to deploy and execute
         # its payload. If it's not installed we shall fail
         if not hasattr(iscm, "iscm_cfninit_add_config"):
             raise RuntimeError("The Shell ISCM module depends on the CfnInit module to be installed in the same chain")
+        self.lib_path = self._install_init_lib(iscm)
 
     def _load_scripts(self, script_list, script_content=None):
         # Concatenate scripts contents
@@ -48,16 +183,41 @@ class Shell(object):
                 script_path = search_file(script['path'], *self.script_paths)
                 if script_path is None:
                     raise RuntimeError("Unable to find script in path %s" % script['path'])
-                with open(script_path, "r") as f:
-                    data = f.read()
-                    # Ensure trailing new line
-                    if data[-1] != "\n": data += "\n"
-                    script_content += data
+                # Scripts are only read (and minified) again if they change
+                if self.minify:
+                    script_content += stat_cached(script_path, _read_script_minified, "shell-script-min")
+                else:
+                    script_content += stat_cached(script_path, _read_script, "shell-script")
             else:
                 raise RuntimeError("Unhandled script type: %s" % script['type'])
 
         return script_content
 
+    def _script_files(self, path, contents):
+        # cfn-init files and commands for writing one of the scripts
+        attrs = dict(mode="000700", owner="root", group="root")
+        if self.compress:
+            return _gzipped_file(path, contents, attrs)
+        return ({ path: dict(attrs, content=contents) }, {})
+
+    def _install_init_lib(self, iscm):
+        """
+        The code of the init scripts goes in a library that the init script
+        of each Shell module sources. It's written once per instance, by a
+        config of its own. The config is added as the modules are installed,
+        so it comes before the configs of all the Shell modules, and out of
+        the concurrent ones. Returns the path of the library in the instance.
+        """
+        lib_content = self._load_scripts(self.init_scripts)
+        lib_digest = stable_digest(lib_content)[:12]
+        lib_path = "%s/lib-%s.sh" % (SHELL_ISCM_DIR, lib_digest)
+        libs = iscm.iscm_get_var("shell_iscm::libs") or []
+        if lib_path not in libs:
+            (files, commands) = self._script_files(lib_path, lib_content)
+            iscm.iscm_cfninit_add_config({ "files": files, "commands": commands }, name="shell_lib_%s" % lib_digest)
+            iscm.iscm_set_var("shell_iscm::libs", libs + [ lib_path ])
+        return lib_path
+
     def deploy(self, iscm):
         # If no name has been given for this shell iscm, assign one sequentially
         if self.name is None:
@@ -77,9 +237,9 @@ class Shell(object):
         else:
             shell_vars_md_entry = ""
 
-        # Create script file with all initialization scripts code
-        init_script_path = "/root/shell-iscm/init-%s.sh" % self.name
-        init_script_content = self._load_scripts(self.init_scripts)
+        # Create script file that sets up the environment of this module, and
+        # loads the code shared by all the Shell modules in the instance
+        init_script_path = "%s/init-%s.sh" % (SHELL_ISCM_DIR, self.name)
 
         # Collect all scripts' code, starting with the shebang and processing the init scripts
         script_content = \
@@ -87,40 +247,34 @@ class Shell(object):
             '. %s\n' % init_script_path
 
         script_content = self._load_scripts(self.scripts, script_content)
+        (files, commands) = self._script_files("%s/%s.sh" % (SHELL_ISCM_DIR, self.name), script_content)
         # Add cfn-init config to write and execute the user specified scripts
         stack_user_key = iscm.iscm_cfninit_get_stack_user_key()
-        shell_config = {
-            "files": {
-                init_script_path : {
-                    "content": {
-                        "Fn::Join" : ["", [ 
-                            'export AWS__STACK_NAME="', AWS.StackName ,'" ',
-                            'AWS__STACKEL_NAME="', Resource.ThisName() , '" ',
-                            'AWS__BOOTSTRAP_KEY_ID="', stack_user_key , '" ',
-                            'AWS__BOOTSTRAP_SECRET_KEY="', stack_user_key["SecretAccessKey"] , r'" ',
-                            'AWS__REGION="', AWS.Region , '"\n\n',
-                            'SHELL_ISCM_NAME="%s"\n' % self.name,
-                            'SHELL_ISCM_METADATA_VARS_KEY="%s"\n' % shell_vars_md_entry,
-                            'SHELL_ISCM_INIT_SCRIPT="%s"\n' % init_script_path,
-                            init_script_content
-                        ] ]
-                    },
-                    "mode": "000700",
-                    "owner": "root",
-                    "group": "root"
-                },
-                "/root/shell-iscm/%s.sh" % self.name: {
-                    "content": script_content,
-                    "mode": "000700",
-                    "owner": "root",
-                    "group": "root"
-                }
+        files[init_script_path] = {
+            "content": {
+                "Fn::Join" : ["", [ 
+                    'export AWS__STACK_NAME="', AWS.StackName ,'" ',
+                    'AWS__STACKEL_NAME="', Resource.ThisName() , '" ',
+                    'AWS__BOOTSTRAP_KEY_ID="', stack_user_key , '" ',
+                    'AWS__BOOTSTRAP_SECRET_KEY="', stack_user_key["SecretAccessKey"] , r'" ',
+                    'AWS__REGION="', AWS.Region , '"\n\n',
+                    'SHELL_ISCM_NAME="%s"\n' % self.name,
+                    'SHELL_ISCM_METADATA_VARS_KEY="%s"\n' % shell_vars_md_entry,
+                    'SHELL_ISCM_INIT_SCRIPT="%s"\n' % init_script_path,
+                    'ISCM_METADATA_CACHE="${ISCM_METADATA_CACHE:-%s}"\n' % METADATA_CACHE,
+                    '. %s\n' % self.lib_path
+                ] ]
             },
-            "commands": {
-                "runit": {
-                    "command": "/root/shell-iscm/%s.sh  2>&1 | tee -a /iscm-shell.log" % self.name
-                }
-            }
+            "mode": "000700",
+            "owner": "root",
+            "group": "root"
+        }
+        commands["runit"] = {
+            "command": timed_command("shell:%s" % self.name, "%s/%s.sh" % (SHELL_ISCM_DIR, self.name), log="/iscm-shell.log")
+        }
+        shell_config = {
+            "files": files,
+            "commands": commands
         }
         iscm.iscm_cfninit_add_config(shell_config)
 
@@ -0,0 +1,137 @@
+'''
+Boot timing instrumentation for the ISCM.
+
+Every instrumented step (bootstrap installs, cfn-init configsets / phases,
+shell scripts, ansible runs) appends a JSON record to TIMING_LOG in the
+instance, one per line:
+
+  {"step": "cfninit:Ansible-Build", "start": 31.52, "end": 160.07, "rc": 0}
+
+start and end are monotonic timestamps, in seconds since the instance booted.
+A compact "step=duration" summary of the records is sent back through the
+Data field of the wait condition signal. Ansible runs record the time taken
+by each of their tasks in ANSIBLE_TASK_LOG, in the same format, so they're
+not part of the summary.
+
+The functions in this module turn logs collected from a fleet of instances
+into a per-step latency report.
+
+@author: David Losada Carballo <david@tuxpiper.com>
+'''
+
+TIMING_LOG = "/var/log/iscm-timing.jsonl"
+ANSIBLE_TASK_LOG = "/var/log/iscm-ansible-tasks.jsonl"
+
+# Shell code, for the userdata, that records and summarizes timings
+timing_sh = "\n".join([
+    r'ISCM_TIMING_LOG=%s' % TIMING_LOG,
+    r'iscm_now() { cut -d" " -f1 /proc/uptime ; }',
+    r'iscm_record() { echo "{\"step\": \"$1\", \"start\": $2, \"end\": $3, \"rc\": $4}" >> $ISCM_TIMING_LOG ; }',
+    r'iscm_timed() {',
+    r'  local step=$1 t0=$(iscm_now) t1 rc; shift',
+    r'  "$@"; rc=$?; t1=$(iscm_now)',
+    r'  iscm_record "$step" $t0 $t1 $rc',
+    r'  INFO "$step took $(awk -v t0=$t0 -v t1=$t1 "BEGIN { printf \"%.2f\", t1 - t0 }")s (exit code $rc)"',
+    r'  return $rc',
+    r'}',
+    r'iscm_timing_summary() {',
+    r'  python -c "import json,sys; print(\" \".join(\"%s=%.1f\" % (r[\"step\"], r[\"end\"] - r[\"start\"]) for r in map(json.loads, open(sys.argv[1])))[:4000])" $ISCM_TIMING_LOG 2>/dev/null',
+    r'}',
+])
+
+def timed_command(step, command, log=None):
+    """
+    Wraps a cfn-init command, so its execution time is recorded under the
+    given step name. The command may be a string or a CloudFormation
+    expression that evaluates to a string.
+    If a log file is given, the output of the command is appended to it as
+    well. The exit status recorded (and returned) is the command's, not
+    the one of the tee that writes the log. cfn-init runs commands with
+    /bin/sh, which may not support pipefail.
+    """
+    prefix = 't0=$(cut -d" " -f1 /proc/uptime); ( '
+    suffix = ' ); rc=$?; '
+    if log is not None:
+        prefix = 't0=$(cut -d" " -f1 /proc/uptime); rcf=$(mktemp); { ( '
+        suffix = ' ) 2>&1; echo $? > $rcf; } | tee -a %s; rc=$(cat $rcf); rm -f $rcf; ' % log
+    suffix += 'echo "{\\"step\\": \\"%s\\", \\"start\\": $t0, \\"end\\": $(cut -d" " -f1 /proc/uptime), \\"rc\\": $rc}" >> %s; ' % (step, TIMING_LOG) + \
+        'exit $rc'
+    if isinstance(command, basestring):
+        return prefix + command + suffix
+    return { "Fn::Join": [ "", [ prefix, command, suffix ] ] }
+
+def parse_timing_log(path):
+    """
+    Returns the timing records found in a log file
+    """
+    import json
+    records = []
+    with open(path, "r") as f:
+        for line in f:
+            line = line.strip()
+            if line:
+                records.append(json.loads(line))
+    return records
+
+def parse_signal_data(data):
+    """
+    Returns the timing records found in the summary sent as wait condition
+    signal data. Only durations are known, so records start at 0.
+    """
+    records = []
+    for entry in data.split():
+        if "=" not in entry:
+            continue
+        (step, duration) = entry.rsplit("=", 1)
+        try:
+            records.append(dict(step=step, start=0.0, end=float(duration)))
+        except ValueError:
+            continue
+    return records
+
+def _percentile(sorted_values, pct):
+    k = int(round((len(sorted_values) - 1) * pct / 100.0))
+    return sorted_values[k]
+
+def latency_report(records_per_instance):
+    """
+    Given a list with the timing records of each instance, returns the
+    latency statistics of each step across the fleet:
+
+      { "cfninit:Ansible-Build": { count, failures, min, mean, p50, p90, max } }
+    """
+    durations = {}
+    failures = {}
+    for records in records_per_instance:
+        for r in records:
+            durations.setdefault(r["step"], []).append(r["end"] - r["start"])
+            if r.get("rc", 0) != 0:
+                failures[r["step"]] = failures.get(r["step"], 0) + 1
+    report = {}
+    for (step, values) in durations.items():
+        values = sorted(values)
+        report[step] = dict(
+            count = len(values),
+            failures = failures.get(step, 0),
+            min = values[0],
+            mean = sum(values) / len(values),
+            p50 = _percentile(values, 50),
+            p90 = _percentile(values, 90),
+            max = values[-1]
+        )
+    return report
+
+def format_latency_report(report):
+    """
+    Returns the latency report as a text table, slowest steps (by p90) first
+    """
+    lines = [ "%-40s %6s %5s %9s %9s %9s %9s %9s" % ("step", "count", "fail", "min", "mean", "p50", "p90", "max") ]
+    for (step, st) in sorted(report.items(), key=lambda (k,v): -v["p90"]):
+        lines.append("%-40s %6d %5d %9.2f %9.2f %9.2f %9.2f %9.2f" % (
+            step, st["count"], st["failures"], st["min"], st["mean"], st["p50"], st["p90"], st["max"]))
+    return "\n".join(lines)
+
+if __name__ == "__main__":
+    # Report on the timing logs given in the command line, one per instance
+    import sys
+    print format_latency_report(latency_report(map(parse_timing_log, sys.argv[1:])))
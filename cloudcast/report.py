@@ -0,0 +1,212 @@
+'''
+Attribution of the size of a rendered template to the parts it's made of.
+
+The report has a row for each template section, each element in them, and
+inside resources for each property and metadata key. The cfn-init metadata
+is broken down further into each config (including the _ansible_* configs
+and the configs of each PhasedISCM phase), each file in them (such as the
+files embedded with CfnEmbedFile) and each configset, which adds up the
+configs it runs. Each row has:
+
+  path       i.e. "Resources/WebA/Metadata/AWS::CloudFormation::Init/Base-001"
+  kind       section, element, property, metadata, config, file or configset
+  bytes      size of the part in the compact JSON encoding of the template
+  raw_bytes  size of the strings in the part (keys included), once
+             decoded. Base64 file contents count as their decoded size,
+             gunzipped if the destination path ends in ".gz"
+
+along with its depth in the report and its label (the last part of the
+path). The rows of configsets overlap with the rows of the configs they
+run, so they're not to be added up.
+
+  report = size_report(stack)
+  print report.format(min_bytes=1024)
+  report.save("sizes.json")
+  ...
+  print format_diff(SizeReport.load("sizes.json"), size_report(stack))
+
+@author: David Losada Carballo <david@tuxpiper.com>
+'''
+
+import json
+
+CFN_INIT_KEY = "AWS::CloudFormation::Init"
+
+_sections = [ "Parameters", "Mappings", "Resources", "Outputs" ]
+
+def encoded_size(obj):
+    """
+    Size of the given (expanded) object in the compact JSON encoding
+    """
+    return len(json.dumps(obj, separators=(',', ':')))
+
+def raw_size(obj, name=None):
+    """
+    Size of the strings inside the given (expanded) object, keys included,
+    with base64 file contents decoded. name is the key the object is found under.
+    """
+    if isinstance(obj, basestring):
+        return len(obj.encode("utf-8")) if isinstance(obj, unicode) else len(obj)
+    if type(obj) == dict:
+        if obj.get("encoding") == "base64" and isinstance(obj.get("content"), basestring):
+            return _decoded_size(obj["content"], name)
+        return sum([ raw_size(k) + raw_size(v, k) for (k, v) in obj.items() ])
+    if type(obj) == list:
+        return sum([ raw_size(v) for v in obj ])
+    return 0
+
+def _decoded_size(content, name):
+    from base64 import b64decode
+    try:
+        data = b64decode(content)
+    except TypeError:
+        return len(content)
+    if name is not None and name.endswith(".gz"):
+        import gzip
+        from StringIO import StringIO
+        try:
+            data = gzip.GzipFile(fileobj=StringIO(data)).read()
+        except IOError:
+            pass
+    return len(data)
+
+class SizeReport(object):
+    """
+    The rows of a size report, in template order
+    """
+    def __init__(self, rows=None, total=0):
+        self.rows = rows or []
+        self.total = total
+
+    def add(self, parts, kind, obj, name=None):
+        """
+        Adds a row for the given object, found at the path with the given
+        parts. name is the key the object is found under, if it isn't the
+        last part.
+        """
+        self.add_row(parts, kind, encoded_size(obj), raw_size(obj, name or parts[-1]))
+
+    def add_row(self, parts, kind, bytes, raw_bytes):
+        self.rows.append(dict(path="/".join(parts), depth=len(parts) - 1, label=parts[-1],
+                              kind=kind, bytes=bytes, raw_bytes=raw_bytes))
+
+    def get(self, path):
+        for r in self.rows:
+            if r["path"] == path:
+                return r
+        return None
+
+    def to_dict(self):
+        return dict(total=self.total, rows=self.rows)
+
+    @classmethod
+    def from_dict(cls, d):
+        return cls(d["rows"], d["total"])
+
+    def save(self, path):
+        with open(path, "w") as f:
+            json.dump(self.to_dict(), f, indent=2)
+
+    @classmethod
+    def load(cls, path):
+        with open(path, "r") as f:
+            return cls.from_dict(json.load(f))
+
+    def format(self, min_bytes=0, depth=None):
+        """
+        Returns the report as a table. Rows under min_bytes, or nested
+        deeper than depth, are left out.
+        """
+        lines = [ "%10s %10s %6s  %s" % ("bytes", "raw", "%", "path") ]
+        for r in self.rows:
+            if r["bytes"] < min_bytes or (depth is not None and r["depth"] > depth):
+                continue
+            share = 100.0 * r["bytes"] / self.total if self.total else 0
+            lines.append("%10d %10d %5.1f%%  %s%s" % (r["bytes"], r["raw_bytes"], share,
+                         "  " * r["depth"], r["label"]))
+        lines.append("%10d %10s %6s  (total)" % (self.total, "", ""))
+        return "\n".join(lines)
+
+    def diff(self, other):
+        """
+        Compares this report with a later one. Returns the rows that
+        changed size, as dictionaries with path, kind, before and after
+        (None for rows missing in either report), sorted by the size of
+        the change.
+        """
+        changes = []
+        old_rows = dict([ (r["path"], r) for r in self.rows ])
+        new_rows = dict([ (r["path"], r) for r in other.rows ])
+        paths = [ r["path"] for r in self.rows ] + [ r["path"] for r in other.rows if not old_rows.has_key(r["path"]) ]
+        for path in paths:
+            (old, new) = (old_rows.get(path), new_rows.get(path))
+            before = old["bytes"] if old is not None else None
+            after = new["bytes"] if new is not None else None
+            if before != after:
+                changes.append(dict(path=path, kind=(new or old)["kind"], before=before, after=after))
+        changes.sort(key=lambda c: -abs((c["after"] or 0) - (c["before"] or 0)))
+        return changes
+
+def format_diff(before, after, min_bytes=0):
+    """
+    Returns the differences between two size reports as a table
+    """
+    lines = [ "%10s %10s %10s  %s" % ("before", "after", "delta", "path") ]
+    for c in before.diff(after):
+        delta = (c["after"] or 0) - (c["before"] or 0)
+        if abs(delta) < min_bytes:
+            continue
+        lines.append("%10s %10s %+10d  %s" % ("-" if c["before"] is None else c["before"],
+                     "-" if c["after"] is None else c["after"], delta, c["path"]))
+    lines.append("%10d %10d %+10d  (total)" % (before.total, after.total, after.total - before.total))
+    return "\n".join(lines)
+
+def _report_cfn_init(report, parts, init):
+    config_sets = init.get("configSets", {})
+    if config_sets:
+        report.add(parts + [ "configSets" ], "metadata", config_sets)
+    for (name, config) in sorted(init.items()):
+        if name == "configSets":
+            continue
+        report.add(parts + [ name ], "config", config)
+        if type(config) == dict and type(config.get("files")) == dict:
+            for (file_path, spec) in sorted(config["files"].items()):
+                report.add(parts + [ name, "file:" + file_path ], "file", spec, file_path)
+    for (set_name, members) in sorted(config_sets.items()):
+        configs = [ init[m] for m in members if isinstance(m, basestring) and init.has_key(m) ]
+        report.add_row(parts + [ "configset:" + set_name ], "configset",
+                       sum([ encoded_size(c) for c in configs ]), sum([ raw_size(c) for c in configs ]))
+
+def report_template(t):
+    """
+    Returns the SizeReport of the given expanded template
+    """
+    report = SizeReport(total=encoded_size(t))
+    for section in _sections:
+        if not t.has_key(section):
+            continue
+        report.add([ section ], "section", t[section])
+        for (name, el) in sorted(t[section].items()):
+            report.add([ section, name ], "element", el)
+            if section != "Resources":
+                continue
+            for (prop, value) in sorted(el.get("Properties", {}).items()):
+                report.add([ section, name, "Properties/" + prop ], "property", value, prop)
+            for (key, value) in sorted(el.get("Metadata", {}).items()):
+                report.add([ section, name, "Metadata/" + key ], "metadata", value, key)
+                if key == CFN_INIT_KEY and type(value) == dict:
+                    _report_cfn_init(report, [ section, name, "Metadata/" + key ], value)
+    return report
+
+def size_report(stack, hoist_threshold=None):
+    """
+    Renders the given stack and returns its SizeReport. With
+    hoist_threshold, the sizes are taken after hoisting repeated literals
+    (see Stack.dump_json)
+    """
+    from cloudcast import _expand_template
+    t = _expand_template(stack.template_obj())
+    if hoist_threshold is not None:
+        from cloudcast._hoist import hoist_literals
+        hoist_literals(t, hoist_threshold)
+    return report_template(t)
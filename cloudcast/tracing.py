@@ -0,0 +1,150 @@
+'''
+Tracing of the stages of loading and rendering stacks.
+
+While a tracer is active, the stages (running the template, discovering
+and naming elements, installing and deploying each ISCM module and phase,
+computing builds, dumping each element and encoding the JSON) are recorded
+as nested spans. The spans can be saved in the Chrome trace event format,
+to be loaded in chrome://tracing or https://ui.perfetto.dev:
+
+  from cloudcast import tracing
+  with tracing.traced("render.trace.json"):
+      stack = Stack(resources_file="stack.rsc.py")
+      stack.dump_json()
+
+When no tracer is active, span() hands out a shared do-nothing context
+manager, so the instrumented code only pays for a function call.
+
+@author: David Losada Carballo <david@tuxpiper.com>
+'''
+
+import time, os
+from contextlib import contextmanager
+
+# The active tracer, if any
+_tracer = None
+
+class _NullSpan(object):
+    def __enter__(self):
+        return self
+    def __exit__(self, *exc_info):
+        return False
+
+_null_span = _NullSpan()
+
+def label(obj):
+    """
+    Returns a short description of the given object for span names, i.e.
+    the class name and the name of the element, phase or module
+    """
+    for attr in [ "ref_name", "phase_name", "name" ]:
+        name = getattr(obj, attr, None)
+        if isinstance(name, basestring):
+            return "%s('%s')" % (obj.__class__.__name__, name)
+    return obj.__class__.__name__
+
+class _Span(object):
+    def __init__(self, tracer, name, args):
+        self.tracer = tracer
+        self.name = name
+        self.args = args
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        end = time.time()
+        if exc_type is not None:
+            self.args["error"] = "%s: %s" % (exc_type.__name__, exc_value)
+        self.tracer.add_span(self.name, self.start, end, self.args)
+        return False
+
+class Tracer(object):
+    """
+    Collects spans, as Chrome trace "complete" events. Timestamps are in
+    microseconds since the tracer was created.
+    """
+    def __init__(self):
+        self.origin = time.time()
+        self.events = []
+
+    def span(self, name, target=None, **args):
+        if target is not None:
+            name = "%s %s" % (name, label(target))
+        return _Span(self, name, args)
+
+    def add_span(self, name, start, end, args=None):
+        import thread
+        event = dict(name=name, cat="cloudcast", ph="X", pid=os.getpid(), tid=thread.get_ident(),
+                     ts=(start - self.origin) * 1e6, dur=(end - start) * 1e6)
+        if args:
+            event["args"] = dict([ (k, str(v)) for (k, v) in args.items() ])
+        self.events.append(event)
+
+    def totals(self):
+        """
+        Returns the total time, in seconds, spent in the spans of each
+        name, as a list of (name, count, seconds) sorted by time
+        """
+        totals = {}
+        for e in self.events:
+            (count, dur) = totals.get(e["name"], (0, 0))
+            totals[e["name"]] = (count + 1, dur + e["dur"])
+        return sorted([ (name, count, dur / 1e6) for (name, (count, dur)) in totals.items() ],
+                      key=lambda t: -t[2])
+
+    def to_chrome_trace(self):
+        meta = dict(name="process_name", ph="M", pid=os.getpid(), args=dict(name="cloudcast"))
+        return dict(traceEvents=[ meta ] + sorted(self.events, key=lambda e: (e["ts"], -e["dur"])),
+                    displayTimeUnit="ms")
+
+    def save(self, path):
+        import json
+        with open(path, "w") as f:
+            json.dump(self.to_chrome_trace(), f)
+
+def start():
+    """
+    Starts recording spans into a new tracer, which is returned
+    """
+    global _tracer
+    _tracer = Tracer()
+    return _tracer
+
+def stop():
+    """
+    Stops recording spans, returns the tracer that was active
+    """
+    global _tracer
+    tracer = _tracer
+    _tracer = None
+    return tracer
+
+def active():
+    return _tracer
+
+def span(name, target=None, **args):
+    """
+    Context manager recording a span with the given name, followed by the
+    label of the target object if given, while a tracer is active
+    """
+    if _tracer is None:
+        return _null_span
+    return _tracer.span(name, target, **args)
+
+@contextmanager
+def traced(path=None):
+    """
+    Traces the enclosed code, saving the trace to the given path (if any)
+    when it's done. Yields the tracer.
+    """
+    global _tracer
+    previous = _tracer
+    tracer = start()
+    try:
+        yield tracer
+    finally:
+        _tracer = previous
+        if path is not None:
+            tracer.save(path)
@@ -0,0 +1,67 @@
+'''
+Checks the generated ansible.cfg, and the callback plugin that records the
+time taken by each ansible task.
+
+@author: David Losada Carballo <david@tuxpiper.com>
+'''
+
+import os, imp, json, tempfile
+from cloudcast import Stack
+from cloudcast.template import EC2Instance, Resource
+from cloudcast.iscm.ansible import AnsibleISCM, _timing_callback_plugin
+from cloudcast.iscm.timing import parse_timing_log
+
+def render(**config):
+    stack = Stack(description="ansible config")
+    key = Resource("AWS::IAM::AccessKey", UserName="someone")
+    stack.add_element(key, "Key")
+    config.update(inst_home="/home/ubuntu", inst_user="ubuntu", inst_group="ubuntu", inst_playbook_dir="playbooks")
+    stack.add_element(EC2Instance(ImageId="ami-0b9c9f62", InstanceType="m1.small", iscm=AnsibleISCM(
+        config=config, playbooks_source="ansible", stack_user_key=key,
+        runs=dict(build=dict(playbook="playbook.yaml"), boot=dict(playbook="playbook.yaml"))
+    )), "Web")
+    t = json.loads(stack.dump_json(pretty=False))
+    return t["Resources"]["Web"]["Metadata"]["AWS::CloudFormation::Init"]
+
+init = render()
+config = init["_ansible_install_config"]
+cfg = config["files"]["/opt/cfn-ansible/etc/ansible.cfg"]["content"]
+for line in [ "[defaults]", "gathering = smart", "fact_caching = jsonfile", "forks = 10",
+              "fact_caching_connection = /opt/cfn-ansible/var/fact_cache",
+              "callback_plugins = /opt/cfn-ansible/share/callback_plugins", "[ssh_connection]", "pipelining = True" ]:
+    assert line in cfg.splitlines(), line
+assert config["files"]["/opt/cfn-ansible/share/callback_plugins/iscm_timing.py"]["content"] == open(_timing_callback_plugin).read()
+# The fact cache doesn't survive into the next boot
+assert "rm -rf /opt/cfn-ansible/var/fact_cache" in config["commands"]["ansible_reset_fact_cache"]["command"]
+# Part of the configset that runs every time, before the runs
+assert "_ansible_install_config" in init["configSets"]["AnsibleConfig"]
+runner = init["_ansible_playbooks_runner"]["files"]["/home/ubuntu/cfn-ansible.sh"]["content"]
+assert "export ANSIBLE_CONFIG=/opt/cfn-ansible/etc/ansible.cfg ISCM_ANSIBLE_RUN=\"$1\"" in runner
+
+# Settings can be overridden, added and removed
+init = render(ansible_cfg={ "defaults": { "forks": 2, "gathering": None }, "privilege_escalation": { "become": True } })
+cfg = init["_ansible_install_config"]["files"]["/opt/cfn-ansible/etc/ansible.cfg"]["content"].splitlines()
+assert "forks = 2" in cfg and "forks = 10" not in cfg
+assert [ l for l in cfg if l.startswith("gathering") ] == []
+assert cfg[cfg.index("[privilege_escalation]") + 1] == "become = True"
+
+# Task timings, as recorded by the callback plugin
+log = tempfile.mktemp(suffix=".jsonl")
+os.environ.update(ISCM_ANSIBLE_TASK_LOG=log, ISCM_ANSIBLE_RUN="boot")
+try:
+    plugin = imp.load_source("iscm_timing", _timing_callback_plugin).CallbackModule()
+    plugin.playbook_on_task_start("install packages", False)
+    plugin.playbook_on_task_start("configure", False)
+    plugin.runner_on_failed("localhost", {}, ignore_errors=True)
+    plugin.playbook_on_handler_task_start("restart")
+    plugin.runner_on_failed("localhost", {})
+    plugin.playbook_on_stats(None)
+    records = parse_timing_log(log)
+finally:
+    if os.path.exists(log):
+        os.remove(log)
+assert [ (r["step"], r["rc"]) for r in records ] == [ ("ansible-task:boot:install packages", 0),
+    ("ansible-task:boot:configure", 0), ("ansible-task:boot:restart", 1) ], records
+assert all([ r["start"] <= r["end"] for r in records ])
+
+print "OK"
@@ -0,0 +1,72 @@
+'''
+Checks the bake plan of launchables whose phases share a common prefix:
+shared images are baked once, and registered images are not baked again.
+
+@author: David Losada Carballo <david@tuxpiper.com>
+'''
+
+import os, shutil, tempfile
+from cloudcast import Stack
+from cloudcast.bake import plan_bakes, phase_durations_from_report
+from cloudcast.images import JSONImageRegistry
+
+stack = Stack(description="bakes", resources_file="template5.rsc.py")
+
+def status_after(name, *phase_names):
+    # The status id of the entry point after the given phase
+    iscm = stack.get_element(name).iscm
+    for stage in iscm.get_possible_builds():
+        if stage["run_phases"] and stage["run_phases"][1].phase_name == phase_names[0]:
+            return stage["status_id"]
+    raise RuntimeError("No entry point before %s" % phase_names[0])
+
+durations = phase_durations_from_report({
+    "cfninit:Config": dict(p50=5, p90=10),
+    "cfninit:Base": dict(p50=100, p90=200),
+    "boot": dict(p50=1000, p90=1000)
+})
+assert durations == { "Config": 10, "Base": 200 }
+
+plan = plan_bakes(stack, phase_durations=durations, image_overhead=50)
+steps = [ (s["base_image"], s["run_phases"], s["launchables"]) for s in plan.steps ]
+assert steps == [
+    ("ami-11111111", [ "Config", "Base", "Worker" ], [ "OtherBase" ]),
+    ("ami-0b9c9f62", [ "Config", "Base" ], []),
+    ("ami-0b9c9f62", [ "Config", "Web" ], []),
+    ("ami-0b9c9f62", [ "Config", "AppA" ], [ "WebA", "WebALaunchConfig" ]),
+    ("ami-0b9c9f62", [ "Config", "AppB" ], [ "WebB" ]),
+    ("ami-0b9c9f62", [ "Config", "Worker" ], [ "Worker" ]),
+], plan.format()
+# Each bake starts from the image baked before it
+baked = set([ "" ])
+for s in plan.steps:
+    assert s["source"] in baked
+    baked.add(s["target"])
+assert plan.steps[3]["target"] == status_after("WebA", "Boot")
+assert plan.steps[3]["source"] == plan.steps[2]["target"] == status_after("WebA", "AppA")
+# 6 images, 6 runs of Config, 2 of Base, 5 other phases
+assert plan.estimated_time == 6 * 50 + 6 * 10 + 2 * 200 + 5 * 120, plan.estimated_time
+# Without sharing, Base and Web are run for each launchable
+assert plan.unshared_time == 5 * 50 + 5 * 10 + 5 * 200 + 8 * 120, plan.unshared_time
+
+# With the Web image registered, only the branches are baked
+folder = tempfile.mkdtemp(prefix="cloudcast-bakes-")
+try:
+    registry = JSONImageRegistry(os.path.join(folder, "images.json"))
+    registry.register(status_after("WebA", "AppA"), "ami-web", base_image="ami-0b9c9f62")
+    plan = plan_bakes(stack, registry=registry)
+    steps = [ (s["source"], s["run_phases"]) for s in plan.steps ]
+    assert steps == [
+        ("", [ "Config", "Base", "Worker" ]),
+        (status_after("WebA", "AppA"), [ "Config", "AppA" ]),
+        (status_after("WebB", "AppB"), [ "Config", "AppB" ]),
+        ("", [ "Config", "Base", "Worker" ]),
+    ], plan.format()
+    # Registered targets are not baked at all
+    for s in plan.steps:
+        registry.register(s["target"], "ami-baked", base_image=s["base_image"])
+    assert plan_bakes(stack, registry=registry).steps == []
+finally:
+    shutil.rmtree(folder)
+
+print "OK"
@@ -0,0 +1,70 @@
+'''
+Checks where the ISCM modules look for their files: next to the code that
+creates them, be it the template or a helper module in another folder.
+
+@author: David Losada Carballo <david@tuxpiper.com>
+'''
+
+import json, os, shutil, tempfile
+from cloudcast import Stack
+from cloudcast._utils import caller_folder
+from cloudcast.iscm.shell import Shell
+
+here = os.path.dirname(os.path.abspath(__file__))
+
+def lookup():
+    return caller_folder()
+
+# The folder of the caller's caller
+assert lookup() == here
+assert Shell().script_paths[0] == here
+
+template = """
+from cloudcast.template import *
+from cloudcast.library import stack_user
+from cloudcast.iscm import ISCM
+from cloudcast.iscm.cfninit import CfnInitISCM, CfnEmbedFile
+from cloudcast.iscm.shell import Shell
+from helpers import steps
+
+Instance = EC2Instance(
+    ImageId = "ami-0b9c9f62",
+    InstanceType = "m1.small",
+    iscm = ISCM(
+        context = { "_iscm": { "cfninit_key": stack_user.CloudFormationStackUserKey } },
+        processors = [ CfnInitISCM(stack_user.CloudFormationStackUserKey) ],
+        modules = [ Shell(scripts=[ Shell.runScript("step.sh") ]),
+                    CfnEmbedFile(src_file="data.txt", dest_path="/opt/data.txt") ] + steps()
+    )
+)
+"""
+
+helpers = """
+from cloudcast.iscm.cfninit import CfnEmbedFile
+from cloudcast.iscm.shell import Shell
+
+def steps():
+    return [ Shell(scripts=[ Shell.runScript("helper.sh") ]),
+             CfnEmbedFile(src_file="helper.txt", dest_path="/opt/helper.txt") ]
+"""
+
+# A template, and the helper module it imports from another folder
+folder = tempfile.mkdtemp(prefix="cloudcast-paths-")
+try:
+    lib = os.path.join(folder, "lib")
+    os.mkdir(lib)
+    for (path, content) in [ ("paths.rsc.py", "import sys; sys.path.append(%r)\n" % lib + template),
+                             ("step.sh", "echo template step\n"), ("data.txt", "template data\n"),
+                             ("lib/helpers.py", helpers),
+                             ("lib/helper.sh", "echo helper step\n"), ("lib/helper.txt", "helper data\n") ]:
+        with open(os.path.join(folder, path), "w") as f:
+            f.write(content)
+    stack = Stack(description="paths", resources_file=os.path.join(folder, "paths.rsc.py"))
+    rendered = json.dumps(json.loads(stack.dump_json())["Resources"]["Instance"]["Metadata"])
+    assert "echo template step" in rendered and "echo helper step" in rendered
+    embedded = [ m.src_path for m in stack.get_element("Instance").iscm.modules if hasattr(m, "src_path") ]
+    assert embedded == [ os.path.join(folder, "data.txt"), os.path.join(lib, "helper.txt") ], embedded
+finally:
+    shutil.rmtree(folder)
+
+print "OK"
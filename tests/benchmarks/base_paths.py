@@ -0,0 +1,79 @@
+'''
+Benchmark of the loading of a template with many Shell and CfnEmbedFile
+modules, all of which look up the folder of the template they're created in.
+
+Compares the previous behaviour (inspect.stack() on every lookup) with
+walking the frames up to the caller with sys._getframe.
+
+Usage: python base_paths.py [modules]
+
+@author: David Losada Carballo <david@tuxpiper.com>
+'''
+
+import os, sys, time, shutil, tempfile
+import cloudcast._utils
+from cloudcast import Stack
+
+modules = int(sys.argv[1]) if len(sys.argv) > 1 else 300
+
+template = """
+from cloudcast.template import *
+from cloudcast.library import stack_user
+from cloudcast.iscm import ISCM
+from cloudcast.iscm.cfninit import CfnInitISCM, CfnEmbedFile
+from cloudcast.iscm.shell import Shell
+
+def modules(k):
+    return [ Shell(scripts=[ Shell.runScript("step.sh") ]),
+             CfnEmbedFile(src_file="data.txt", dest_path="/opt/data-%%d.txt" %% k) ]
+
+Instance = EC2Instance(
+    ImageId = "ami-0b9c9f62",
+    InstanceType = "m1.small",
+    iscm = ISCM(
+        context = { "_iscm": { "cfninit_key": stack_user.CloudFormationStackUserKey } },
+        processors = [ CfnInitISCM(stack_user.CloudFormationStackUserKey) ],
+        modules = sum([ modules(k) for k in range(%d) ], [])
+    )
+)
+"""
+
+def legacy_caller_folder():
+    # What looking up the caller's folder looked like before
+    import inspect
+    caller_file = inspect.stack()[2][1]
+    if os.path.exists(caller_file):
+        return os.path.abspath(os.path.dirname(caller_file))
+    else:
+        return os.path.abspath(os.getcwd())
+
+def timed(name, path, caller_folder=None):
+    import cloudcast.iscm.shell
+    saved = cloudcast._utils.caller_folder
+    if caller_folder is not None:
+        cloudcast._utils.caller_folder = cloudcast.iscm.shell.caller_folder = caller_folder
+    try:
+        t0 = time.time()
+        Stack(description="base paths", resources_file=path)
+        elapsed = time.time() - t0
+    finally:
+        cloudcast._utils.caller_folder = cloudcast.iscm.shell.caller_folder = saved
+    print "%-24s %8.3fs" % (name, elapsed)
+    return elapsed
+
+folder = tempfile.mkdtemp(prefix="cloudcast-bench-")
+try:
+    path = os.path.join(folder, "base_paths.rsc.py")
+    with open(path, "w") as f:
+        f.write(template % modules)
+    with open(os.path.join(folder, "step.sh"), "w") as f:
+        f.write("#!/bin/bash\necho step\n")
+    with open(os.path.join(folder, "data.txt"), "w") as f:
+        f.write("data\n")
+    print "%d Shell and %d CfnEmbedFile modules" % (modules, modules)
+    timed("warm up", path)
+    legacy = timed("inspect.stack()", path, legacy_caller_folder)
+    frames = timed("frame walk", path)
+    print "speedup: %.1fx" % (legacy / frames)
+finally:
+    shutil.rmtree(folder)
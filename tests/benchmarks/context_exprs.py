@@ -0,0 +1,78 @@
+'''
+Benchmark of the ISCM context expressions: many modules resolving their
+variables against one large facts context, with expressions they share.
+
+Compares the previous behaviour (python sources and dq queries parsed on
+every resolve), compiled expressions alone (plain dictionary as context),
+and compiled plus memoized expressions (IscmContext).
+
+Usage: python context_exprs.py [modules] [facts]
+
+@author: David Losada Carballo <david@tuxpiper.com>
+'''
+
+import sys, time
+from cloudcast.iscm import ISCM, IscmContext, IscmPythonExpr, IscmQExpr, resolve_value, q, expr, dicts
+
+modules = int(sys.argv[1]) if len(sys.argv) > 1 else 300
+facts = int(sys.argv[2]) if len(sys.argv) > 2 else 2000
+
+def make_context():
+    return dict(
+        env = "production",
+        region = "us-east-1",
+        common = dict([ ("common_%d" % i, i) for i in range(facts / 10) ]),
+        facts = dict([ ("fact_%d" % i, "value %d" % i) for i in range(facts) ]),
+    )
+
+def module_vars(k):
+    # Each module has a few variables of its own, and a few shared ones
+    return {
+        "all": dicts(q(".common"), q(".facts")),
+        "name": expr("'%s-%s' % (env, region)"),
+        "upper_env": expr("env.upper()"),
+        "own": q(".facts.fact_%d" % (k % facts)),
+    }
+
+class VarsModule(object):
+    def __init__(self, k):
+        self.k = k
+    def install(self, iscm):
+        pass
+    def deploy(self, iscm):
+        self.vars = iscm.context_lookup(module_vars(self.k))
+
+def legacy_resolve(value, context):
+    # What resolving looked like before expressions were compiled
+    from dq import query
+    if isinstance(value, IscmPythonExpr):
+        return eval(value.expr, context)
+    if isinstance(value, IscmQExpr):
+        return query(value.q, context)
+    return dict(sum([ legacy_resolve(d, context).items() for d in value.dicts ], []))
+
+def timed(name, f):
+    t0 = time.time()
+    f()
+    elapsed = time.time() - t0
+    print "%-24s %8.3fs" % (name, elapsed)
+    return elapsed
+
+def run_legacy():
+    context = make_context()
+    for k in range(modules):
+        dict([ (n, legacy_resolve(v, context)) for (n, v) in module_vars(k).items() ])
+
+def run_compiled():
+    context = make_context()
+    for k in range(modules):
+        dict([ (n, resolve_value(v, context)) for (n, v) in module_vars(k).items() ])
+
+def run_memoized():
+    ISCM(IscmContext(make_context()), modules=[ VarsModule(k) for k in range(modules) ])
+
+print "%d modules, %d facts" % (modules, facts)
+legacy = timed("legacy", run_legacy)
+compiled = timed("compiled", run_compiled)
+memoized = timed("compiled + memoized", run_memoized)
+print "speedup: %.1fx" % (legacy / memoized)
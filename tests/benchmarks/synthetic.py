@@ -0,0 +1,272 @@
+'''
+Benchmark suite of synthetic stacks, checked against stored baselines.
+
+Each scenario generates the files, playbooks and shell scripts embedded by
+synthetic.rsc.py, and loads a stack of the given size from it. The stages
+of rendering the stack are timed separately:
+
+  load        running the template file (_run_resources_file)
+  discovery   finding the stack elements in the loaded module
+  naming      naming the elements and adding them to the stack
+  deploy      deploying the ISCMs of the launchables
+  contents    building the template object (dump_to_template_obj)
+  encode      encoding the template object as JSON
+
+along with the peak memory taken by the process while doing so (on top of
+the interpreter and the imported modules) and the size of the JSON output.
+
+Each run of a scenario takes place in a fresh process, so caches don't
+carry over. With --repeat, the best time of each stage is kept.
+
+The size of the JSON output is the same on any machine, so it's always
+checked against the baselines file, and the exit code is 1 if it changed.
+An intended change of the output goes along with new baselines, recorded
+with --save, and is told as such in the commit that makes it.
+
+Timings and memory depend on the machine and on its load. They're reported
+along with their ratio to the baselines, and only gated when asked to, on a
+machine comparable to the one that recorded the baselines: with
+--time-threshold, a stage regresses when it takes longer than its baseline
+times the threshold (plus a small slack, so very short stages aren't at the
+mercy of timer noise); --memory-threshold does likewise for memory.
+
+Usage: python synthetic.py [options] [scenario ...]
+
+@author: David Losada Carballo <david@tuxpiper.com>
+'''
+
+import sys, os, json
+
+STAGES = [ "load", "discovery", "naming", "deploy", "contents", "encode" ]
+
+SIZES = [ "resources", "mappings", "launchables", "embedded_files", "playbook_files", "scripts" ]
+
+SCENARIOS = {
+    "small": dict(resources=10, mappings=2, launchables=2, embedded_files=2, playbook_files=2, scripts=2),
+    "medium": dict(resources=100, mappings=10, launchables=10, embedded_files=5, playbook_files=10, scripts=5),
+    "large": dict(resources=2000, mappings=100, launchables=100, embedded_files=10, playbook_files=40, scripts=10),
+}
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+DEFAULT_BASELINES = os.path.join(BENCH_DIR, "synthetic_baselines.json")
+
+def _text(rnd, lines):
+    words = [ "alpha", "bravo", "charlie", "delta", "echo", "foxtrot", "golf", "hotel" ]
+    return "".join([ " ".join([ rnd.choice(words) for w in range(8) ]) + "\n" for l in range(lines) ])
+
+def generate(folder, embedded_files=0, playbook_files=0, scripts=0, **kwargs):
+    """
+    Writes the files embedded by the synthetic template into the given
+    folder. The contents are pseudo-random, but the same on every run.
+    """
+    import random
+    rnd = random.Random(0)
+    for sub in [ "files", "scripts", "ansible", os.path.join("ansible", "tasks") ]:
+        os.makedirs(os.path.join(folder, sub))
+    for k in range(embedded_files):
+        with open(os.path.join(folder, "files", "data%03d.txt" % k), "w") as f:
+            f.write(_text(rnd, 200))
+    for k in range(scripts):
+        with open(os.path.join(folder, "scripts", "step%03d.sh" % k), "w") as f:
+            f.write("#!/bin/bash\n")
+            f.write("".join([ "echo \"$QUEUE0 %s\" >> /var/log/step%03d.log\n" % (l.strip(), k)
+                              for l in _text(rnd, 20).splitlines() ]))
+    # The playbook includes one task file per playbook file
+    with open(os.path.join(folder, "ansible", "playbook.yaml"), "w") as f:
+        f.write("- hosts: all\n  tags: [ build ]\n  tasks:\n")
+        for k in range(max(playbook_files - 1, 0)):
+            f.write("  - include: tasks/t%03d.yml\n" % k)
+        f.write("\n- hosts: all\n  tags: [ boot ]\n  tasks:\n")
+        f.write("  - debug: msg=\"name of the queue is {{queue0}}\"\n")
+    for k in range(max(playbook_files - 1, 0)):
+        with open(os.path.join(folder, "ansible", "tasks", "t%03d.yml" % k), "w") as f:
+            for l in _text(rnd, 10).splitlines():
+                f.write("- name: %s\n  action: shell echo %s >> /tmp/t%03d\n" % (l, l, k))
+
+def _peak_rss_kb():
+    import resource
+    # Kilobytes on Linux, bytes on Mac OS X
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == "darwin":
+        peak /= 1024
+    return peak
+
+def run_stages(sizes):
+    """
+    Loads and renders a synthetic stack of the given sizes, returning the
+    time of each stage, the peak memory taken and the output size
+    """
+    import time, tempfile, shutil
+    from cloudcast import Stack, _run_resources_file, _CustomJSONEncoder
+    # Imported up front, so they don't count towards the load stage
+    import cloudcast.iscm.cfninit, cloudcast.iscm.shell, cloudcast.iscm.ansible
+    #
+    folder = tempfile.mkdtemp(prefix="cloudcast-bench-")
+    try:
+        generate(folder, **sizes)
+        stack = Stack(description="Synthetic stack", env=dict(sizes, data_folder=folder))
+        elements = stack.elements
+        times = {}
+        rss_before = _peak_rss_kb()
+        #
+        t0 = time.time()
+        srcmodule = _run_resources_file(os.path.join(BENCH_DIR, "synthetic.rsc.py"), stack)
+        times["load"] = time.time() - t0
+        #
+        t0 = time.time()
+        found = sorted(elements.find_stack_elements(srcmodule), key=lambda x: x[:-1])
+        times["discovery"] = time.time() - t0
+        #
+        t0 = time.time()
+        for (module_name, el_name, element) in found:
+            elements.name_stack_element(element, elements.generate_cfn_name(module_name, el_name))
+            elements.add_stack_element(element)
+        times["naming"] = time.time() - t0
+        #
+        t0 = time.time()
+        for launchable in stack.get_launchable_resources():
+            if launchable.iscm is not None:
+                launchable.iscm._ensure_deployed()
+        times["deploy"] = time.time() - t0
+        #
+        t0 = time.time()
+        t = { 'AWSTemplateFormatVersion': '2010-09-09', 'Description': stack.description }
+        elements.dump_to_template_obj(stack, t)
+        times["contents"] = time.time() - t0
+        #
+        t0 = time.time()
+        output = _CustomJSONEncoder(indent=2, sort_keys=False).encode(t)
+        times["encode"] = time.time() - t0
+        #
+        return dict(times=times, memory_kb=_peak_rss_kb() - rss_before, output_bytes=len(output))
+    finally:
+        shutil.rmtree(folder)
+
+def run_scenario(sizes, repeat=1):
+    """
+    Runs the scenario the given number of times, each in a fresh process,
+    and keeps the best result of each measure
+    """
+    import subprocess
+    best = None
+    for r in range(repeat):
+        proc = subprocess.Popen([ sys.executable, os.path.abspath(__file__), "--child", json.dumps(sizes) ],
+                                stdout=subprocess.PIPE)
+        (out, err) = proc.communicate()
+        if proc.returncode != 0:
+            raise RuntimeError("Benchmark process failed with exit code %d" % proc.returncode)
+        result = json.loads(out.splitlines()[-1])
+        if best is None:
+            best = result
+            continue
+        for stage in STAGES:
+            best["times"][stage] = min(best["times"][stage], result["times"][stage])
+        best["memory_kb"] = min(best["memory_kb"], result["memory_kb"])
+    best["total"] = sum(best["times"].values())
+    return best
+
+def compare(result, baseline, time_threshold=None, memory_threshold=None,
+            time_slack=0.02, memory_slack_kb=2048):
+    """
+    Returns the list of measures that changed from the baseline (output
+    size) or regressed against it (times and memory, when given their
+    thresholds), as (measure, value, baseline) tuples
+    """
+    changes = []
+    if result["output_bytes"] != baseline["output_bytes"]:
+        changes.append(("output_bytes", result["output_bytes"], baseline["output_bytes"]))
+    if (time_threshold, memory_threshold) != (None, None) and not baseline.has_key("times"):
+        raise RuntimeError("The baselines have no times or memory, record them with --save")
+    if time_threshold is not None:
+        for stage in STAGES + [ "total" ]:
+            if stage == "total":
+                (value, base) = (result["total"], baseline["total"])
+            else:
+                (value, base) = (result["times"][stage], baseline["times"][stage])
+            if value > base * time_threshold + time_slack:
+                changes.append((stage, value, base))
+    if memory_threshold is not None:
+        if result["memory_kb"] > baseline["memory_kb"] * memory_threshold + memory_slack_kb:
+            changes.append(("memory_kb", result["memory_kb"], baseline["memory_kb"]))
+    return changes
+
+def format_result(name, result, baseline=None):
+    def ratio(value, base):
+        if not base:
+            return ""
+        return "(%.2fx)" % (float(value) / base)
+    lines = [ "%s: %s" % (name, ", ".join([ "%s=%d" % (s, result["sizes"][s]) for s in SIZES ])) ]
+    for stage in STAGES + [ "total" ]:
+        value = result["total"] if stage == "total" else result["times"][stage]
+        share = 100.0 * value / result["total"] if result["total"] else 0.0
+        base = None
+        if baseline is not None and baseline.has_key("times"):
+            base = baseline["total"] if stage == "total" else baseline["times"][stage]
+        lines.append("  %-12s %9.3fs %5.1f%% %s" % (stage, value, share, ratio(value, base)))
+    for measure in [ "memory_kb", "output_bytes" ]:
+        lines.append("  %-12s %10d %s" % (measure, result[measure],
+                     ratio(result[measure], baseline and baseline.get(measure))))
+    return "\n".join(lines)
+
+def main(argv):
+    import argparse
+    parser = argparse.ArgumentParser(description="Benchmarks cloudcast on synthetic stacks")
+    parser.add_argument("scenarios", nargs="*", help="scenarios to run (%s)" % ", ".join(sorted(SCENARIOS.keys())))
+    parser.add_argument("--baselines", default=DEFAULT_BASELINES, help="baselines file")
+    parser.add_argument("--save", action="store_true", help="record the results as the new baselines")
+    parser.add_argument("--repeat", type=int, default=3, help="runs of each scenario")
+    parser.add_argument("--time-threshold", type=float, help="fail on times over this ratio to the baselines")
+    parser.add_argument("--memory-threshold", type=float, help="fail on memory over this ratio to the baselines")
+    for size in SIZES:
+        parser.add_argument("--" + size.replace("_", "-"), type=int, dest=size,
+                            help="run a custom scenario with this many %s" % size.replace("_", " "))
+    parser.add_argument("--child", help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+    #
+    if args.child:
+        print json.dumps(run_stages(json.loads(args.child)))
+        return 0
+    #
+    scenarios = {}
+    if any([ getattr(args, s) is not None for s in SIZES ]):
+        # A custom scenario, the missing sizes are taken from the small one
+        sizes = dict(SCENARIOS["small"])
+        sizes.update(dict([ (s, getattr(args, s)) for s in SIZES if getattr(args, s) is not None ]))
+        scenarios["custom"] = sizes
+    for name in args.scenarios or ([] if scenarios else sorted(SCENARIOS.keys())):
+        if not SCENARIOS.has_key(name):
+            parser.error("unknown scenario %s" % name)
+        scenarios[name] = SCENARIOS[name]
+    #
+    baselines = {}
+    if os.path.exists(args.baselines):
+        with open(args.baselines, "r") as f:
+            baselines = json.load(f)
+    #
+    changed = False
+    for name in sorted(scenarios.keys()):
+        result = run_scenario(scenarios[name], args.repeat)
+        result["sizes"] = scenarios[name]
+        baseline = baselines.get(name)
+        if baseline is not None and baseline["sizes"] != result["sizes"]:
+            baseline = None     # Recorded for another scenario size
+        print format_result(name, result, baseline)
+        if args.save:
+            baselines[name] = result
+        elif baseline is not None:
+            changes = compare(result, baseline, args.time_threshold, args.memory_threshold)
+            for (measure, value, base) in changes:
+                print "  %s %s: %s (baseline %s)" % ("CHANGED" if measure == "output_bytes" else "REGRESSION",
+                                                    measure, value, base)
+            changed = changed or len(changes) > 0
+        else:
+            print "  (no baseline)"
+    #
+    if args.save:
+        with open(args.baselines, "w") as f:
+            json.dump(baselines, f, indent=2, sort_keys=True)
+            f.write("\n")
+    return 1 if changed else 0
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,78 @@
+'''
+Synthetic cloudcast template for benchmarks. Its size is given by the
+stack environment (see synthetic.py), and the files it embeds are found
+in the folder given by the "data_folder" environment entry.
+
+@author: David Losada Carballo <david@tuxpiper.com>
+'''
+
+from os import listdir
+from os.path import join as path_join
+from cloudcast.template import *
+from cloudcast.library import stack_user
+from _context import stack
+
+from cloudcast.iscm import ISCM
+from cloudcast.iscm.cfninit import CfnInit, CfnInitISCM, CfnEmbedFile
+from cloudcast.iscm.shell import Shell
+from cloudcast.iscm.ansible import AnsibleISCM
+
+data_folder = stack.env["data_folder"]
+regions = [ "us-east-1", "us-west-1", "us-west-2", "eu-west-1" ]
+
+for k in range(stack.env["mappings"]):
+    globals()["AMIs%03d" % k] = Mapping(dict([
+        (r, { "ebs": "ami-%08x" % (k * 16 + i), "instance": "ami-%08x" % (k * 16 + i + 8) })
+        for (i, r) in enumerate(regions) ]))
+
+for k in range(stack.env["resources"]):
+    globals()["Queue%04d" % k] = Resource("AWS::SQS::Queue",
+        VisibilityTimeout = 30 + k % 60,
+        MessageRetentionPeriod = 345600)
+
+def mapped_ami(k):
+    if stack.env["mappings"] == 0:
+        return "ami-0b9c9f62"
+    return globals()["AMIs%03d" % (k % stack.env["mappings"])].find(AWS.Region, "ebs")
+
+def queue_names(k):
+    # A few queues referenced from each launchable
+    if stack.env["resources"] == 0:
+        return {}
+    return dict([ ("queue%d" % i, globals()["Queue%04d" % ((k + i) % stack.env["resources"])]["QueueName"])
+                  for i in range(3) ])
+
+def shell_iscm(k):
+    return ISCM(
+        context = { "_iscm": { "cfninit_key": stack_user.CloudFormationStackUserKey } },
+        processors = [ CfnInitISCM(stack_user.CloudFormationStackUserKey) ],
+        modules = [ CfnInit(configs=[{ "files": { "/etc/queues.json": {
+                        "content": queue_names(k), "mode": "000644", "owner": "root", "group": "root" } } }]) ] +
+                  [ CfnEmbedFile(src_file=path_join(data_folder, "files", name), dest_path="/opt/data/" + name)
+                    for name in sorted(listdir(path_join(data_folder, "files"))) ] +
+                  [ Shell(shell_vars = dict([ (n.upper(), v) for (n, v) in queue_names(k).items() ]),
+                          scripts = [ Shell.runScript(path_join(data_folder, "scripts", name))
+                                      for name in sorted(listdir(path_join(data_folder, "scripts"))) ]) ]
+    )
+
+def ansible_iscm(k):
+    return AnsibleISCM(
+        config = dict(inst_home = "/home/ubuntu", inst_user = "ubuntu", inst_group = "ubuntu",
+                      inst_playbook_dir = "playbooks"),
+        facts = dict(queue_names(k), environment = "production"),
+        playbooks_source = path_join(data_folder, "ansible"),
+        stack_user_key = stack_user.CloudFormationStackUserKey,
+        runs = dict(
+            build = dict(playbook = "playbook.yaml", sudo = True, tags = [ "build" ]),
+            boot = dict(playbook = "playbook.yaml", sudo = True, tags = [ "boot" ])
+        )
+    )
+
+for k in range(stack.env["launchables"]):
+    # When there are playbooks, every other launchable is set up by ansible
+    use_ansible = stack.env["playbook_files"] > 0 and k % 2 == 1
+    globals()["Instance%03d" % k] = EC2Instance(
+        ImageId = mapped_ami(k),
+        InstanceType = "m1.small",
+        iscm = ansible_iscm(k) if use_ansible else shell_iscm(k)
+    )
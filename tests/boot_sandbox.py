@@ -0,0 +1,207 @@
+'''
+Helpers for running the boot sequence of a rendered launchable on the local
+machine. The cfn tools are replaced by stubs:
+
+  - cfn-get-metadata prints the rendered metadata, and counts its invocations.
+    It can be made to fail as if throttled
+  - cfn-init applies files and commands from the metadata file it's given,
+    and records the configsets it's asked to run
+  - cfn-signal records its arguments
+  - the CloudFormation API (as called by the cloud-init ISCM) serves the
+    metadata, and records the signed requests
+
+Absolute paths used by the ISCM are relocated into the sandbox folder.
+
+@author: David Losada Carballo <david@tuxpiper.com>
+'''
+
+import json, os, re, stat, subprocess, sys, tempfile, threading
+from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+
+# Also the defaults of shell variables, as in ${VAR:-/var/lib/cloudcast/...}
+_relocated_paths = re.compile(r'(?:(?<![\w./-])|(?<=:-))(/var/lib/cloudcast|/var/log/|/etc/cloudcast|/root/|/iscm)')
+
+_cfn_init_stub = r'''#!%(python)s
+import json, os, subprocess, sys, base64
+args = sys.argv[1:]
+configsets = args[args.index("--configsets") + 1].split(",")
+with open("%(sandbox)s/cfn-init.calls", "a") as f:
+    f.write(",".join(configsets) + "\n")
+init = json.load(open(args[-1]))["AWS::CloudFormation::Init"]
+def run_config(config):
+    for (path, f) in sorted(config.get("files", {}).items()):
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        content = f["content"]
+        if not isinstance(content, basestring):
+            content = json.dumps(content)
+        elif f.get("encoding") == "base64":
+            content = base64.b64decode(content)
+        with open(path, "wb") as out:
+            out.write(content.encode("utf-8") if isinstance(content, unicode) else content)
+        os.chmod(path, int(f.get("mode", "000644"), 8))
+    for (name, c) in sorted(config.get("commands", {}).items()):
+        env = dict(os.environ)
+        env.update(c.get("env", {}))
+        if subprocess.call(c["command"], shell=True, env=env, cwd=c.get("cwd")) != 0:
+            sys.exit(1)
+for cs in configsets:
+    for name in init["configSets"][cs]:
+        run_config(init[name])
+'''
+
+# The first $SANDBOX_API_THROTTLES calls fail, as when the API is throttled
+_cfn_get_metadata_stub = '''#!/bin/sh
+echo x >> %(sandbox)s/cfn-get-metadata.calls
+if [ $(wc -l < %(sandbox)s/cfn-get-metadata.calls) -le ${SANDBOX_API_THROTTLES:-0} ]; then
+  echo "Rate exceeded (Throttling)" >&2
+  exit 1
+fi
+cat %(sandbox)s/metadata.json
+'''
+
+_cfn_signal_stub = '''#!/bin/sh
+echo "$@" >> %(sandbox)s/cfn-signal.calls
+'''
+
+class _CloudFormationAPI(BaseHTTPRequestHandler):
+    """
+    Answers DescribeStackResource with the metadata of the sandbox whose
+    folder is the path of the request
+    """
+    def do_GET(self):
+        sandbox = self.path.split("/?")[0]
+        with open(sandbox + "/cfn-api.calls", "a") as f:
+            f.write("%s %s\n" % (self.path.split("/?")[1], self.headers.get("Authorization")))
+        with open(sandbox + "/metadata.json") as f:
+            detail = { "Metadata": f.read() }
+        self.send_response(200)
+        self.end_headers()
+        self.wfile.write(json.dumps({ "DescribeStackResourceResponse": {
+            "DescribeStackResourceResult": { "StackResourceDetail": detail } } }))
+    def log_message(self, *args):
+        pass
+
+_api_server = None
+
+def _api_endpoint():
+    global _api_server
+    if _api_server is None:
+        _api_server = HTTPServer(("127.0.0.1", 0), _CloudFormationAPI)
+        thread = threading.Thread(target=_api_server.serve_forever)
+        thread.daemon = True
+        thread.start()
+    return "http://127.0.0.1:%d" % _api_server.server_port
+
+def render(template_file, env=None, element="AnInstance"):
+    """
+    Renders the template and returns the plain definition of the element
+    """
+    from cloudcast import Stack
+    stack = Stack(description="sandbox", env=env or {}, resources_file=template_file)
+    return json.loads(stack.dump_json())["Resources"][element]
+
+class BootSandbox(object):
+    def __init__(self):
+        self.path = tempfile.mkdtemp(prefix="cloudcast-sandbox-")
+        self.bin = os.path.join(self.path, "bin")
+        self.refs = {}      # Values of references, "ref-<name>" if not given
+        os.mkdir(self.bin)
+        os.makedirs(os.path.join(self.path, "var", "log"))
+        os.mkdir(os.path.join(self.path, "root"))
+        params = dict(sandbox=self.path, python=sys.executable)
+        self._write_exec("cfn-init", _cfn_init_stub % params)
+        self._write_exec("cfn-get-metadata", _cfn_get_metadata_stub % params)
+        self._write_exec("cfn-signal", _cfn_signal_stub % params)
+        self._write_exec("pip", "#!/bin/sh\nexit 0\n")
+        # No EC2 instance metadata service around
+        self._write_exec("wget", "#!/bin/sh\nexit 1\n")
+        # Scripts in the instance are run by python 2
+        os.symlink(sys.executable, os.path.join(self.bin, "python"))
+
+    def _write_exec(self, name, content):
+        path = os.path.join(self.bin, name)
+        with open(path, "w") as f:
+            f.write(content)
+        os.chmod(path, stat.S_IRWXU)
+
+    def relocate(self, s):
+        return _relocated_paths.sub(lambda m: self.path + m.group(1), s)
+
+    def flatten(self, obj):
+        """
+        Returns the string that a CloudFormation expression evaluates to, with
+        references replaced by placeholder values
+        """
+        if isinstance(obj, basestring):
+            return self.relocate(obj)
+        if obj.has_key("Fn::Join"):
+            (token, members) = obj["Fn::Join"]
+            return token.join([ self.flatten(m) for m in members ])
+        if obj.has_key("Ref"):
+            return self.refs.get(obj["Ref"], "ref-" + obj["Ref"].replace("::", "-"))
+        if obj.has_key("Fn::GetAtt"):
+            return "att-" + "-".join(obj["Fn::GetAtt"])
+        if obj.has_key("Fn::Base64"):
+            return self.flatten(obj["Fn::Base64"])
+        raise RuntimeError("Can't flatten %s" % obj)
+
+    def _flatten_all(self, obj):
+        if type(obj) == dict:
+            if len(obj) == 1 and obj.keys()[0] in [ "Fn::Join", "Ref", "Fn::GetAtt" ]:
+                return self.flatten(obj)
+            return dict([ (self.relocate(k), self._flatten_all(v)) for (k, v) in obj.items() ])
+        elif type(obj) == list:
+            return [ self._flatten_all(v) for v in obj ]
+        elif isinstance(obj, basestring):
+            return self.relocate(obj)
+        return obj
+
+    def publish_metadata(self, resource):
+        """
+        Makes the metadata of the rendered resource available to the stubs
+        """
+        with open(os.path.join(self.path, "metadata.json"), "w") as f:
+            json.dump(self._flatten_all(resource.get("Metadata", {})), f)
+
+    def run(self, script, env=None):
+        """
+        Runs a shell script in the sandbox, returns (exit code, output)
+        """
+        run_env = dict(os.environ)
+        run_env["PATH"] = self.bin + ":" + run_env["PATH"]
+        run_env.update(env or {})
+        proc = subprocess.Popen([ "bash", "-c", script ], env=run_env,
+                                stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+        output = proc.communicate()[0]
+        return (proc.returncode, output)
+
+    def boot(self, resource, env=None):
+        """
+        Runs the userdata of the rendered resource
+        """
+        self.publish_metadata(resource)
+        return self.run(self.flatten(resource["Properties"]["UserData"]), env)
+
+    def boot_cloudinit(self, resource, env=None):
+        """
+        Runs the multipart user data of the rendered resource as cloud-init
+        would, with its API calls going to the local stand-in
+        """
+        import email
+        self.publish_metadata(resource)
+        run_env = { "ISCM_CFN_ENDPOINT": _api_endpoint() + self.path }
+        run_env.update(env or {})
+        userdata = email.message_from_string(self.flatten(resource["Properties"]["UserData"]))
+        (code, output) = (0, "")
+        for part in userdata.walk():
+            if part.get_content_type() == "text/x-shellscript":
+                (code, output) = self.run(part.get_payload(), run_env)
+        return (code, output)
+
+    def count_calls(self, tool):
+        path = os.path.join(self.path, "%s.calls" % tool)
+        if not os.path.exists(path):
+            return 0
+        with open(path) as f:
+            return len(f.readlines())
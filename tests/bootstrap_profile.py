@@ -0,0 +1,71 @@
+'''
+Checks where the cfn-init tools come from with each bootstrap profile
+(pre-baked, wheelhouse, network), and that the version marker is only
+written when the expected version is installed.
+
+@author: David Losada Carballo <david@tuxpiper.com>
+'''
+
+import os
+from boot_sandbox import BootSandbox
+from cloudcast.iscm import _userdata_header
+from cloudcast.iscm.cfninit import BootstrapProfile, _default_get_pip_url, _default_aws_cfn_bootstrap_url
+
+version = "aws-cfn-bootstrap-1.3.16"
+
+def install(profile, installed=None, marker=None, wheelhouse=False):
+    """
+    Runs the install code of the profile in a sandbox, where the tools are
+    found in the given version after installing them. Returns the sandbox,
+    the output and the pip calls
+    """
+    sandbox = BootSandbox()
+    sandbox._write_exec("pip", "#!/bin/sh\necho \"$@\" >> %s/pip.calls\n" % sandbox.path)
+    if installed is not None:
+        # What pkg_resources finds for the installed package
+        info = os.path.join(sandbox.path, "site", "aws_cfn_bootstrap-%s.egg-info" % installed)
+        os.makedirs(info)
+        with open(os.path.join(info, "PKG-INFO"), "w") as f:
+            f.write("Metadata-Version: 1.0\nName: aws-cfn-bootstrap\nVersion: %s\n" % installed)
+    if marker is not None:
+        os.makedirs(os.path.join(sandbox.path, "etc", "cloudcast"))
+        with open(sandbox.relocate(BootstrapProfile.marker_path), "w") as f:
+            f.write(marker + "\n")
+    if wheelhouse:
+        os.makedirs(os.path.join(sandbox.path, "wheelhouse"))
+    script = _userdata_header + profile.get_install_sh(_default_get_pip_url, _default_aws_cfn_bootstrap_url)
+    script = sandbox.relocate(script).replace("/opt/wheelhouse", sandbox.path + "/wheelhouse")
+    (code, output) = sandbox.run(script, { "PYTHONPATH": os.path.join(sandbox.path, "site") })
+    assert code == 0, output
+    pip_calls = []
+    if os.path.exists(sandbox.path + "/pip.calls"):
+        pip_calls = open(sandbox.path + "/pip.calls").read().splitlines()
+    marker_path = sandbox.relocate(BootstrapProfile.marker_path)
+    written = open(marker_path).read().strip() if os.path.exists(marker_path) else None
+    return (written, output, pip_calls)
+
+# Pre-baked tools of the expected version are used as they are
+(written, output, pip_calls) = install(BootstrapProfile(), installed="1.3.16", marker=version)
+assert written == version and pip_calls == [] and "bootstrap:prebaked took" in output
+assert "bootstrap:network" not in output
+
+# A marker of another version doesn't count as pre-baked
+(written, output, pip_calls) = install(BootstrapProfile(), installed="1.3.16", marker="aws-cfn-bootstrap-1.3.9")
+assert "bootstrap:network took" in output and written == version
+
+# Offline install from a wheelhouse, the marker is left for baked images
+(written, output, pip_calls) = install(BootstrapProfile(wheelhouse="/opt/wheelhouse"), installed="1.3.16", wheelhouse=True)
+assert "bootstrap:wheelhouse took" in output and "bootstrap:network" not in output
+assert len(pip_calls) == 1 and pip_calls[0].startswith("install --no-index") and written == version
+
+# The wheelhouse isn't there, the tools come from the network
+(written, output, pip_calls) = install(BootstrapProfile(wheelhouse="/opt/wheelhouse"), installed="1.3.16")
+assert "bootstrap:network took" in output and written == version
+
+# Tools of another version are already installed: they're used, but the
+# marker doesn't claim the expected version
+(written, output, pip_calls) = install(BootstrapProfile(prebaked=False), installed="1.3.9")
+assert "bootstrap:network took" in output and written is None
+assert "are not %s" % version in output
+
+print "OK"
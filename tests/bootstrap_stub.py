@@ -0,0 +1,58 @@
+'''
+Checks the bootstrap stub mode: the payload is read from the metadata and
+run, and the wait condition is signaled with its outcome, also when the
+payload can't be read or fails.
+
+@author: David Losada Carballo <david@tuxpiper.com>
+'''
+
+import json
+from boot_sandbox import BootSandbox
+from cloudcast import Stack
+from cloudcast.template import EC2Instance, Resource, WaitConditionHandle
+from cloudcast.iscm import ISCM, BOOTSTRAP_PAYLOAD_MD_KEY
+from cloudcast.iscm.cfninit import CfnInit, CfnInitISCM
+
+def render(command):
+    stack = Stack(description="stub")
+    key = Resource("AWS::IAM::AccessKey", UserName="someone")
+    stack.add_element(key, "Key")
+    handle = WaitConditionHandle()
+    stack.add_element(handle, "Handle")
+    iscm = ISCM(
+        context = { "_iscm": { "cfninit_key": key } },
+        processors = [ CfnInitISCM(key) ],
+        modules = [ CfnInit(configs=[ { "commands": { "run": { "command": command } } } ]) ],
+        bootstrap_stub = True)
+    iscm.iscm_wc_signal_on_end(handle)
+    stack.add_element(EC2Instance(ImageId="ami-0b9c9f62", InstanceType="m1.small", iscm=iscm), "Web")
+    return json.loads(stack.dump_json())["Resources"]["Web"]
+
+def boot(resource):
+    sandbox = BootSandbox()
+    (code, output) = sandbox.boot(resource)
+    with open(sandbox.path + "/cfn-signal.calls") as f:
+        signals = f.read().splitlines()
+    assert len(signals) == 1, output
+    return (signals[0], output)
+
+# The wait condition handle is in the stub, not in the payload
+resource = render("true")
+assert "ISCM_WCHANDLE_URL=" not in json.dumps(resource["Metadata"][BOOTSTRAP_PAYLOAD_MD_KEY])
+(signal, output) = boot(resource)
+assert signal.startswith("-e 0 ") and signal.endswith("ref-Handle"), signal
+assert "successfully completed" in output
+
+# The payload fails
+(signal, output) = boot(render("exit 3"))
+assert not signal.startswith("-e 0 "), signal
+assert "The ISCM payload failed" in output and "successfully completed" not in output
+
+# The payload can't be read from the metadata
+resource = render("true")
+del resource["Metadata"][BOOTSTRAP_PAYLOAD_MD_KEY]
+(signal, output) = boot(resource)
+assert signal.startswith("-e 1 "), signal
+assert "Unable to read the ISCM payload" in output and "successfully completed" not in output
+
+print "OK"
@@ -0,0 +1,60 @@
+'''
+Checks that canonical renders are byte for byte the same across processes,
+even with the dictionaries iterated in different orders (as happens with
+different hash seeds).
+
+@author: David Losada Carballo <david@tuxpiper.com>
+'''
+
+import os, sys, subprocess, tempfile, shutil, json
+from cloudcast import Stack, template_hash
+
+templates = [
+    ("template2.rsc.py", { "instance_type": "m1.small" }),
+    ("template3.rsc.py", { "iscm_backend": "cloudinit" }),
+    ("template5.rsc.py", {}),
+    ("template6.rsc.py", { "other_base": True }),
+]
+
+def render(folder):
+    # Renders each template into the folder, and its hash alongside
+    for (k, (resources_file, env)) in enumerate(templates):
+        stack = Stack(description="canonical", env=env, resources_file=resources_file)
+        output = stack.dump_json(canonical=True)
+        assert stack.template_hash == template_hash(output)
+        with open(os.path.join(folder, "%d.json" % k), "w") as f:
+            f.write(output)
+        with open(os.path.join(folder, "%d.hash" % k), "w") as f:
+            f.write(stack.template_hash)
+
+if len(sys.argv) > 1:
+    render(sys.argv[1])
+    sys.exit(0)
+
+folders = []
+try:
+    for seed in [ "1", "2", "3" ]:
+        folders.append(tempfile.mkdtemp(prefix="cloudcast-canonical-"))
+        env = dict(os.environ, PYTHONHASHSEED=seed)
+        subprocess.check_call([ sys.executable, os.path.abspath(__file__), folders[-1] ], env=env)
+    for k in range(len(templates)):
+        outputs = [ open(os.path.join(f, "%d.json" % k)).read() for f in folders ]
+        hashes = [ open(os.path.join(f, "%d.hash" % k)).read() for f in folders ]
+        assert outputs[0] == outputs[1] == outputs[2], templates[k][0]
+        assert hashes[0] == hashes[1] == hashes[2] == template_hash(outputs[0])
+        # Keys come sorted, and there's no trailing whitespace
+        assert json.dumps(json.loads(outputs[0]), indent=2, separators=(',', ': '), sort_keys=True) == outputs[0]
+finally:
+    for f in folders:
+        shutil.rmtree(f)
+
+# The hash tells apart different templates
+stack = Stack(description="canonical", resources_file="template5.rsc.py")
+stack.dump_json(canonical=True)
+other = Stack(description="other", resources_file="template5.rsc.py")
+other.dump_json(canonical=True)
+assert stack.template_hash != other.template_hash
+# Not computed outside of canonical mode
+assert Stack(description="plain", resources_file="template5.rsc.py").template_hash is None
+
+print "OK"
@@ -0,0 +1,80 @@
+'''
+Checks the classification of the changes between two renders of a stack.
+
+@author: David Losada Carballo <david@tuxpiper.com>
+'''
+
+import os, copy, tempfile
+from cloudcast import Stack
+from cloudcast.diff import diff_stack, diff_templates, rendered_template, REPLACE, INTERRUPT, UPDATE
+
+def render(**env):
+    return Stack(description="impact", env=env, resources_file="template3.rsc.py")
+
+# Nothing changed, nothing to update
+previous = rendered_template(render())
+path = tempfile.mktemp(suffix=".json")
+try:
+    with open(path, "w") as f:
+        f.write(render().dump_json())
+    changes = diff_stack(render(), path)
+finally:
+    os.remove(path)
+assert changes.is_empty and changes.resources == [] and changes.format() == "no changes"
+
+# Changing the instance type interrupts the instance
+changes = diff_stack(render(instance_type="m3.large"), previous)
+assert not changes.is_empty
+assert changes.by_impact(INTERRUPT) == [ "AnInstance" ], changes.format()
+assert [ p["name"] for p in changes.resources[0]["properties"] ] == [ "InstanceType" ]
+
+# The userdata generated for another ISCM backend replaces it
+changes = diff_stack(render(iscm_backend="cloudinit"), previous)
+assert changes.by_impact(REPLACE) == [ "AnInstance" ], changes.format()
+assert "UserData" in [ p["name"] for p in changes.resources[0]["properties"] ]
+
+def modified(change):
+    t = copy.deepcopy(previous)
+    change(t)
+    return diff_templates(previous, t)
+
+# Metadata changes are updated in place
+def change_metadata(t):
+    t["Resources"]["AnInstance"]["Metadata"]["extra"] = { "key": "value" }
+changes = modified(change_metadata)
+assert changes.by_impact(UPDATE) == [ "AnInstance" ], changes.format()
+
+# Replacing a queue changes the instance metadata that refers to it
+def rename_queue(t):
+    t["Resources"]["SQSQueue1"]["Properties"] = { "QueueName": "renamed" }
+changes = modified(rename_queue)
+assert changes.by_impact(REPLACE) == [ "SQSQueue1" ], changes.format()
+assert changes.by_impact(UPDATE) == [ "AnInstance" ], changes.format()
+metadata = changes.resources[1]["properties"]
+assert [ (p["name"], p["cause"]) for p in metadata ] == [ ("Metadata", "SQSQueue1") ], metadata
+
+# Mapping changes reach the properties that look them up
+def change_ami(t):
+    t["Mappings"]["PreciseAMIs"]["us-east-1"]["ebs"] = "ami-12345678"
+changes = modified(change_ami)
+assert changes.others == [ "Mappings/PreciseAMIs" ]
+assert changes.by_impact(REPLACE) == [ "AnInstance" ], changes.format()
+assert changes.resources[0]["properties"][0]["cause"] == "PreciseAMIs"
+
+# Outputs, added and removed resources, unknown types
+def assorted(t):
+    t["Outputs"] = { "QueueUrl": { "Value": { "Ref": "SQSQueue1" } } }
+    t["Resources"]["Bucket"] = { "Type": "AWS::S3::Bucket" }
+    t["Resources"]["Topic"] = { "Type": "AWS::SNS::Topic", "Properties": {} }
+    del t["Resources"]["CloudFormationStackUser"]
+previous["Resources"]["Topic"] = { "Type": "AWS::SNS::Topic", "Properties": { "DisplayName": "x" } }
+changes = modified(assorted)
+assert changes.others == [ "Outputs" ], changes.others
+assert changes.by_impact("add") == [ "Bucket" ]
+assert changes.by_impact("remove") == [ "CloudFormationStackUser" ]
+topic = [ r for r in changes.resources if r["name"] == "Topic" ][0]
+assert topic["impact"] == REPLACE and topic["properties"][0]["assumed"]
+# The stack user key refers to the removed user
+assert "CloudFormationStackUserKey" in changes.by_impact(REPLACE), changes.format()
+
+print "OK"
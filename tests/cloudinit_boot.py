@@ -0,0 +1,106 @@
+'''
+Checks the boot of an instance configured through cloud-init, instead of
+cfn-init: the metadata is read from the API without the cfn tools, files
+and scripts are in place, values with quotes are kept as they are, and the
+wait condition is signaled.
+
+@author: David Losada Carballo <david@tuxpiper.com>
+'''
+
+import json, os, threading
+from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+from boot_sandbox import BootSandbox, render
+from cloudcast import Stack
+from cloudcast.elements import Parameter
+from cloudcast.template import EC2Instance, Resource
+from cloudcast.iscm import ISCM
+from cloudcast.iscm.cfninit import CfnInit
+from cloudcast.iscm.cloudinit import CloudInitISCM
+
+class WaitHandle(BaseHTTPRequestHandler):
+    signals = []
+    def do_PUT(self):
+        WaitHandle.signals.append(self.rfile.read(int(self.headers["Content-Length"])))
+        self.send_response(200)
+        self.end_headers()
+    def log_message(self, *args):
+        pass
+
+server = HTTPServer(("127.0.0.1", 0), WaitHandle)
+thread = threading.Thread(target=server.serve_forever)
+thread.daemon = True
+thread.start()
+
+wait_handle = "http://127.0.0.1:%d/wait-handle" % server.server_port
+
+sandbox = BootSandbox()
+# No cfn tools in this instance
+for tool in [ "cfn-init", "cfn-get-metadata", "cfn-signal" ]:
+    os.remove(os.path.join(sandbox.bin, tool))
+resource = render("template3.rsc.py", env={ "iscm_backend": "cloudinit" })
+assert not resource["Metadata"].has_key("AWS::CloudFormation::Init")
+# The values of the configs are in the metadata, not in the user data
+userdata = json.dumps(resource["Properties"]["UserData"])
+assert "Queue1" not in userdata and "dump-vars" not in userdata and "_ansible_facts" not in userdata
+(code, output) = sandbox.boot_cloudinit(resource, env={ "ISCM_WCHANDLE_URL": wait_handle })
+assert code == 0, output
+# The metadata was read once, with a signed request
+with open(os.path.join(sandbox.path, "cfn-api.calls")) as f:
+    calls = f.read().splitlines()
+assert len(calls) == 1, calls
+(query, authorization) = calls[0].split(" ", 1)
+assert "Action=DescribeStackResource" in query.split("&") and "LogicalResourceId=AnInstance" in query.split("&")
+assert authorization.startswith("AWS4-HMAC-SHA256 Credential=ref-CloudFormationStackUserKey/"), authorization
+assert oct(os.stat(sandbox.path + "/var/lib/cloudcast/metadata.json").st_mode & 0777) == "0600"
+with open(os.path.join(sandbox.path, "root", "queue.json")) as f:
+    assert f.read() == '{"Queue1": "att-SQSQueue1-QueueName"}'
+with open(os.path.join(sandbox.path, "root", "vars-shell_1.sh")) as f:
+    assert "QUEUE_NAME=att-SQSQueue1-QueueName" in f.read()
+with open(os.path.join(sandbox.path, "root", "vars-shell_2.sh")) as f:
+    assert "APP_ENV=production" in f.read()
+# The wait condition got the timings
+assert len(WaitHandle.signals) == 1, output
+assert '"Status": "SUCCESS"' in WaitHandle.signals[0]
+assert "cloudinit:default=" in WaitHandle.signals[0]
+
+# Values with quotes, resolved by CloudFormation, are written as they are
+# by both python 2 and 3
+stack = Stack(description="quoting")
+greeting = Parameter(Type="String")
+key = Resource("AWS::IAM::AccessKey", UserName="someone")
+stack.add_element(greeting, "Greeting")
+stack.add_element(key, "Key")
+stack.add_element(EC2Instance(ImageId="ami-0b9c9f62", InstanceType="m1.small", iscm=ISCM(
+    context = { "_iscm": { "cfninit_key": key } },
+    processors = [ CloudInitISCM(key, api_backoff=0) ],
+    modules = [ CfnInit(configs={ "quoting": {
+        "files": { "/root/it's.txt": { "content": greeting, "mode": "000600" } },
+        "commands": {
+            "env": { "command": 'printf "%s" "$GREETING" > /root/env.txt', "env": { "GREETING": greeting } },
+            "argv": { "command": [ "cp", "/root/it's.txt", "/root/argv.txt" ], "cwd": "/" }
+        }
+    } }) ]
+)), "Quoting")
+resource = json.loads(stack.dump_json(pretty=False))["Resources"]["Quoting"]
+value = """it's "quoted" \\ $HOME `date` \nISCM_COMMAND\n"""
+for python in [ "python", "python3" ]:
+    sandbox = BootSandbox()
+    sandbox.refs["Greeting"] = value
+    (code, output) = sandbox.boot_cloudinit(resource, env={ "ISCM_PYTHON": python })
+    assert code == 0, output
+    for path in [ "it's.txt", "argv.txt" ]:
+        with open(os.path.join(sandbox.path, "root", path)) as f:
+            assert f.read() == value, path
+    with open(os.path.join(sandbox.path, "root", "env.txt")) as f:
+        assert f.read() == value.rstrip("\n")
+
+# Failing to read the metadata is signaled
+WaitHandle.signals = []
+sandbox = BootSandbox()
+(code, output) = sandbox.boot_cloudinit(resource, env={ "ISCM_WCHANDLE_URL": wait_handle, "ISCM_API_RETRIES": "2",
+                                                        "ISCM_CFN_ENDPOINT": "http://127.0.0.1:1" })
+assert "Unable to fetch the instance metadata" in output, output
+assert len(WaitHandle.signals) == 1 and '"Status": "FAILURE"' in WaitHandle.signals[0], WaitHandle.signals
+
+server.shutdown()
+print "OK"
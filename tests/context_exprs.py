@@ -0,0 +1,90 @@
+'''
+Checks the ISCM context expressions: they are compiled once, their results
+are memoized per context version, and cyclic or unsettled resolutions
+are reported.
+
+@author: David Losada Carballo <david@tuxpiper.com>
+'''
+
+from cloudcast.iscm import ISCM, IscmContext, IscmExpr, q, expr, dicts, join
+
+class CountingExpr(IscmExpr):
+    # Counts its evaluations
+    def __init__(self, key):
+        self.key = key
+        self.evaluations = 0
+    def cache_key(self):
+        return ("counting", self.key)
+    def evaluate(self, context):
+        self.evaluations += 1
+        return context[self.key]
+
+def raises(f, message):
+    try:
+        f()
+    except RuntimeError, e:
+        assert message in str(e), str(e)
+        return
+    assert False, "%s not raised" % message
+
+context = IscmContext(env="production", base={ "a": 1 }, more={ "b": 2 })
+assert expr("env.upper()").resolve(context) == "PRODUCTION"
+assert q(".base.a").resolve(context) == 1
+assert dicts(q(".base"), q(".more"), { "c": 3 }).resolve(context) == { "a": 1, "b": 2, "c": 3 }
+# Evaluating python doesn't leak __builtins__ into the context
+assert not context.has_key("__builtins__")
+# Equal expressions share their compiled code
+assert expr("env.upper()").code is expr("env.upper()").code
+
+# Results are memoized for the context version
+counting = CountingExpr("env")
+for i in range(3):
+    assert dicts({ "env": counting }).resolve(context) == { "env": counting }
+    assert counting.resolve(context) == "production"
+assert counting.evaluations == 1
+# Memoized containers aren't shared with callers
+result = dicts(q(".base")).resolve(context)
+result["x"] = 1
+assert dicts(q(".base")).resolve(context) == { "a": 1 }
+# Setting an entry starts a new version
+version = context.version
+context["env"] = "staging"
+assert context.version > version
+assert counting.resolve(context) == "staging" and counting.evaluations == 2
+assert expr("env.upper()").resolve(context) == "STAGING"
+
+# Expressions resolving into expressions are followed, until they settle
+context["alias"] = q(".env")
+context["loop_a"] = q(".loop_b")
+context["loop_b"] = q(".loop_a")
+context["number"] = 1
+iscm = ISCM(context)
+assert iscm.context_lookup({ "e": q(".alias") }) == { "e": "staging" }
+raises(lambda: iscm.context_lookup({ "x": q(".loop_a") }), "Cyclic")
+# Members of dicts() that aren't dictionaries are reported, rather than spinning
+raises(lambda: dicts(q(".number")).resolve(iscm.context), "not a dictionary")
+nested = dicts({})
+nested.dicts = (nested,)
+raises(lambda: nested.resolve(iscm.context), "Cyclic")
+class Deeper(IscmExpr):
+    def __init__(self, n):
+        self.n = n
+    def cache_key(self):
+        return ("deeper", self.n)
+    def evaluate(self, context):
+        return Deeper(self.n + 1)
+raises(lambda: iscm.context_lookup({ "x": Deeper(0) }), "doesn't settle")
+
+# context_lookup leaves the given dictionary alone
+variables = { "e": q(".env"), "j": join("-", q(".env"), "x") }
+resolved = iscm.context_lookup(variables)
+assert resolved["e"] == "staging" and isinstance(variables["e"], IscmExpr)
+# Plain dictionaries can still be used as context, without memoization
+assert expr("a + 1").resolve({ "a": 1 }) == 2
+# As can other mappings, and an ISCM wraps them in a context of its own
+from collections import OrderedDict
+assert q(".a").resolve(OrderedDict(a=1)) == 1
+iscm = ISCM(context=OrderedDict(a=1))
+assert isinstance(iscm.context, IscmContext) and iscm.context_lookup({ "x": q(".a") }) == { "x": 1 }
+
+print "OK"
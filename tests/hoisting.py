@@ -0,0 +1,59 @@
+'''
+Checks the hoisting of large repeated literals into a generated mapping,
+and that the hoisted template renders back to the original one.
+
+@author: David Losada Carballo <david@tuxpiper.com>
+'''
+
+import json
+from cloudcast import Stack
+from cloudcast.template import Output, Resource
+from cloudcast._hoist import HOISTED_MAPPING_NAME
+
+big = "x" * 600
+script = "echo ${AWS::Region} " + "y" * 600
+
+def render(**kwargs):
+    stack = Stack(description="hoisting")
+    for name in [ "TopicA", "TopicB" ]:
+        stack.add_element(Resource("AWS::SNS::Topic", DisplayName=big,
+            TopicName={ "Fn::Sub": script },
+            KmsMasterKeyId={ "Fn::Sub": [ script, { "Var": big } ] },
+            Subscription=[ { "Fn::If": [ big, big, "short" ] } ],
+            Tags={ "Fn::Join": [ big, [ "a", "b" ] ] }), name)
+        stack.add_element(Output(Description=big, Value=big, Export={ "Name": big }), name + "Output")
+    return json.loads(stack.dump_json(pretty=False, **kwargs))
+
+def unhoist(obj, mapping):
+    # Replaces the lookups of the hoisted literals by their values
+    if type(obj) == dict:
+        if obj.keys() == [ "Fn::FindInMap" ] and obj["Fn::FindInMap"][0] == HOISTED_MAPPING_NAME:
+            return mapping[obj["Fn::FindInMap"][1]][obj["Fn::FindInMap"][2]]
+        return dict([ (k, unhoist(v, mapping)) for (k, v) in obj.items() ])
+    if type(obj) == list:
+        return [ unhoist(v, mapping) for v in obj ]
+    return obj
+
+plain = render()
+hoisted = render(hoist_threshold=512)
+mapping = hoisted["Mappings"].pop(HOISTED_MAPPING_NAME)
+hoisted["Mappings"] = plain.get("Mappings", {})
+assert sorted(sum([ g.values() for g in mapping.values() ], [])) == [ big ]
+props = hoisted["Resources"]["TopicA"]["Properties"]
+assert props["DisplayName"] == { "Fn::FindInMap": [ HOISTED_MAPPING_NAME, "G0", "L000" ] }
+# Template strings of Fn::Sub, condition names and delimiters stay literal
+assert props["TopicName"] == { "Fn::Sub": script }
+assert props["KmsMasterKeyId"]["Fn::Sub"][0] == script
+assert props["KmsMasterKeyId"]["Fn::Sub"][1]["Var"] == props["DisplayName"]
+assert props["Subscription"][0]["Fn::If"][0] == big and props["Subscription"][0]["Fn::If"][1] == props["DisplayName"]
+assert props["Tags"]["Fn::Join"][0] == big
+# Of the outputs, only values are hoisted
+output = hoisted["Outputs"]["TopicAOutput"]
+assert output == { "Description": big, "Value": props["DisplayName"], "Export": { "Name": big } }, output
+# Rendering the lookups back gives the original template
+assert unhoist(hoisted, mapping) == dict(plain, Mappings=plain.get("Mappings", {}))
+
+# Nothing to hoist below the threshold
+assert not render(hoist_threshold=1000).get("Mappings", {}).has_key(HOISTED_MAPPING_NAME)
+
+print "OK"
@@ -0,0 +1,78 @@
+'''
+Checks that launchables are rendered from the deepest baked image found in
+the stack's image registry, with both of the local registry backends.
+
+@author: David Losada Carballo <david@tuxpiper.com>
+'''
+
+import json, os, shutil, tempfile
+from cloudcast import Stack
+from cloudcast.images import JSONImageRegistry, SqliteImageRegistry
+
+BASE_AMI = "ami-64e27e0c"   # us-east-1 ebs in template2
+
+def render(registry):
+    stack = Stack(description="images", env={ "instance_type": "m1.small" },
+                  image_registry=registry, resources_file="template2.rsc.py")
+    resource = json.loads(stack.dump_json())["Resources"]["AnInstance"]
+    launchable = stack.elements.launchables[0]
+    return (resource, launchable)
+
+def run_configsets(resource):
+    members = resource["Properties"]["UserData"]["Fn::Base64"]["Fn::Join"][1]
+    userdata = "".join([ m for m in members if isinstance(m, basestring) ])
+    marker = 'iscm_run_configsets "'
+    start = userdata.rindex(marker) + len(marker)
+    return userdata[start:userdata.index('"', start)]
+
+def deepest_build():
+    stack = Stack(description="images", env={ "instance_type": "m1.small" },
+                  resources_file="template2.rsc.py")
+    builds = stack.elements.launchables[0].iscm.get_possible_builds()
+    assert builds[-1]["status_id"] == ""
+    return builds[0]
+
+folder = tempfile.mkdtemp(prefix="cloudcast-images-")
+try:
+    for (k, cls) in enumerate([ JSONImageRegistry, SqliteImageRegistry ]):
+        path = os.path.join(folder, "registry-%d" % k)
+        registry = cls(path, region="us-east-1")
+        deepest = deepest_build()
+        #
+        # Nothing registered: the base image is used, every phase runs
+        (resource, launchable) = render(registry)
+        assert resource["Properties"]["ImageId"] == { "Fn::FindInMap": [ "TrustyAMIs", { "Ref": "AWS::Region" }, "ebs" ] }
+        assert launchable.selected_image is None
+        assert run_configsets(resource) == "default"
+        #
+        # Images baked from other base images, or in other regions, are ignored
+        registry.register(deepest["status_id"], "ami-otherbase", base_image="ami-00000000")
+        cls(path, region="us-west-2").register(deepest["status_id"], "ami-otherregion", base_image=BASE_AMI)
+        (resource, launchable) = render(registry)
+        assert launchable.selected_image is None
+        #
+        # The baked image is picked, the remaining phases run on boot
+        registry.register(deepest["status_id"], "ami-baked1", base_image=BASE_AMI)
+        registry.register(deepest["status_id"], "ami-baked2", base_image=BASE_AMI)
+        (resource, launchable) = render(cls(path, region="us-east-1"))
+        assert resource["Properties"]["ImageId"] == "ami-baked2", resource["Properties"]["ImageId"]
+        assert launchable.selected_image["status_id"] == deepest["status_id"]
+        remaining = [ p.phase_name for p in deepest["run_phases"] ]
+        assert remaining == [ "AnsibleConfig", "Ansible-Boot" ], remaining
+        assert run_configsets(resource) == ",".join(remaining)
+        #
+        # Records without a base image match any
+        other = cls(path + "-any", region="us-east-1")
+        other.register(deepest["status_id"], "ami-anybase")
+        (resource, launchable) = render(other)
+        assert resource["Properties"]["ImageId"] == "ami-anybase"
+        #
+        try:
+            registry.register("", "ami-nope")
+            assert False, "base images can't be registered"
+        except RuntimeError:
+            pass
+finally:
+    shutil.rmtree(folder)
+
+print "OK"
@@ -0,0 +1,73 @@
+'''
+Checks that an ISCM prototype is deployed once for all the launchables
+using it, and that each launchable gets its own resource name and wait
+condition handle.
+
+@author: David Losada Carballo <david@tuxpiper.com>
+'''
+
+import json, os, shutil, tempfile
+import cloudcast.iscm.ansible
+from cloudcast import Stack
+from cloudcast.images import JSONImageRegistry
+
+deploys = []
+config_deploy = cloudcast.iscm.ansible.AnsibleConfig.deploy
+def counting_deploy(self, iscm):
+    deploys.append(self)
+    return config_deploy(self, iscm)
+cloudcast.iscm.ansible.AnsibleConfig.deploy = counting_deploy
+
+def render(env=None, registry=None):
+    stack = Stack(description="prototype", env=env or {}, image_registry=registry,
+                  resources_file="template6.rsc.py")
+    return json.loads(stack.dump_json())["Resources"]
+
+def userdata(resource):
+    return resource["Properties"]["UserData"]["Fn::Base64"]["Fn::Join"][1]
+
+def following(members, marker):
+    # The members that follow the given string
+    return [ members[k + 1] for (k, m) in enumerate(members[:-1]) if m == marker ]
+
+resources = render()
+assert len(deploys) == 1
+names = [ "Web1", "Web2", "Fleet1", "Fleet2" ]
+for name in names:
+    members = userdata(resources[name])
+    assert following(members, 'AWS__STACKEL_NAME="') == [ name ], following(members, 'AWS__STACKEL_NAME="')
+    facts_script = resources[name]["Metadata"]["AWS::CloudFormation::Init"]["_ansible_install_facts"]["files"].values()[0]["content"]
+    assert following(facts_script["Fn::Join"][1], 'AWS__STACKEL_NAME="') == [ name ]
+    # Only the wait condition handle differs, otherwise
+    handles = [ following(m["Fn::Join"][1], 'ISCM_WCHANDLE_URL="')[0] for m in members
+                if type(m) == dict and 'ISCM_WCHANDLE_URL="' in m.get("Fn::Join", [ None, [] ])[1] ]
+    if name.startswith("Web"):
+        assert handles == [ { "Ref": name + "Handle" } ], handles
+    else:
+        assert handles == []
+# Otherwise, the metadata is the same
+def anonymous(resource, name):
+    return json.dumps(resource["Metadata"]).replace('"%s"' % name, '"X"')
+assert len(set([ anonymous(resources[name], name) for name in names ])) == 1
+
+# Baked images apply to all of them
+folder = tempfile.mkdtemp(prefix="cloudcast-prototype-")
+try:
+    stack = Stack(description="prototype", resources_file="template6.rsc.py")
+    deepest = stack.get_element("Web1").iscm.get_possible_builds()[0]["status_id"]
+    registry = JSONImageRegistry(os.path.join(folder, "images.json"))
+    registry.register(deepest, "ami-baked", base_image="ami-0b9c9f62")
+    resources = render(registry=registry)
+    for name in names:
+        assert resources[name]["Properties"]["ImageId"] == "ami-baked"
+        assert "_ansible_install_facts" in resources[name]["Metadata"]["AWS::CloudFormation::Init"]
+    # Unless the image doesn't apply to some of them
+    try:
+        render(env={ "other_base": "yes" }, registry=registry)
+        assert False, "launchables of a prototype booting from different entry points"
+    except RuntimeError, e:
+        assert "same entry point" in str(e)
+finally:
+    shutil.rmtree(folder)
+
+print "OK"
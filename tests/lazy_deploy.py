@@ -0,0 +1,43 @@
+'''
+Checks that ISCMs are only deployed when the launchables using them are
+dumped, and only once.
+
+@author: David Losada Carballo <david@tuxpiper.com>
+'''
+
+import cloudcast.iscm.ansible
+from cloudcast import Stack
+
+reads = []
+read_playbook_file = cloudcast.iscm.ansible._read_playbook_file
+def counting_read(path):
+    reads.append(path)
+    return read_playbook_file(path)
+cloudcast.iscm.ansible._read_playbook_file = counting_read
+
+def load():
+    return Stack(description="lazy", env={ "instance_type": "m1.small" },
+                 resources_file="template2.rsc.py")
+
+# Loading the stack doesn't deploy the ISCM, nor read the playbooks
+stack = load()
+iscm = stack.get_element("AnInstance").iscm
+assert not iscm.deployed and iscm.metadata == {}
+assert reads == []
+
+# Dumping does, once
+first = stack.dump_json()
+assert iscm.deployed
+assert len(reads) > 0
+n_reads = len(reads)
+assert stack.dump_json() == first
+assert len(reads) == n_reads
+
+# Asking for the entry points deploys too
+stack = load()
+iscm = stack.get_element("AnInstance").iscm
+assert len(iscm.get_possible_builds()) == 2
+assert iscm.deployed
+assert load().dump_json() == first
+
+print "OK"
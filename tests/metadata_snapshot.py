@@ -0,0 +1,67 @@
+'''
+Checks that the instance metadata is fetched exactly once per boot, with
+several shell modules, cfn-init and the ansible facts reading from the
+same snapshot.
+
+@author: David Losada Carballo <david@tuxpiper.com>
+'''
+
+import os, stat
+from boot_sandbox import BootSandbox, render
+from cloudcast.iscm.shell import _shellinit_file
+
+def mode(path):
+    return stat.S_IMODE(os.stat(path).st_mode)
+
+# Boot an instance with a cfn-init config and two shell modules
+sandbox = BootSandbox()
+(code, output) = sandbox.boot(render("template3.rsc.py"))
+assert code == 0, output
+assert sandbox.count_calls("cfn-get-metadata") == 1
+# The snapshot has the stack user secret key, only root reads it
+cache = sandbox.path + "/var/lib/cloudcast/metadata.json"
+assert mode(cache) == 0600 and mode(os.path.dirname(cache)) == 0700, oct(mode(cache))
+# Shell vars were loaded from the snapshot
+with open(os.path.join(sandbox.path, "root", "vars-shell_1.sh")) as f:
+    assert "QUEUE_NAME=att-SQSQueue1-QueueName" in f.read()
+with open(os.path.join(sandbox.path, "root", "vars-shell_2.sh")) as f:
+    assert "APP_ENV=production" in f.read()
+
+# Ansible facts are read from the snapshot, it's only fetched if missing
+sandbox = BootSandbox()
+resource = render("template2.rsc.py", env={ "instance_type": "m1.small" })
+sandbox.publish_metadata(resource)
+facts_config = resource["Metadata"]["AWS::CloudFormation::Init"]["_ansible_install_facts"]
+(facts_script, facts_file) = facts_config["files"].items()[0]
+assert facts_config["commands"]["ansible_get_facts"]["command"] == facts_script and facts_file["mode"] == "000700"
+facts_cmd = sandbox.path + facts_script
+os.makedirs(os.path.dirname(facts_cmd))
+with open(facts_cmd, "w") as f:
+    f.write(sandbox.flatten(facts_file["content"]).replace("/opt/cfn-ansible", sandbox.path + "/opt/cfn-ansible"))
+os.chmod(facts_cmd, 0700)
+env = { "ISCM_METADATA_CACHE": sandbox.path + "/var/lib/cloudcast/metadata.json", "ISCM_API_BACKOFF": "0" }
+for i in range(3):
+    (code, output) = sandbox.run(facts_cmd, env)
+    assert code == 0, output
+assert sandbox.count_calls("cfn-get-metadata") == 1
+assert os.path.getsize(sandbox.path + "/opt/cfn-ansible/etc/host_vars/localhost.json") > 0
+assert mode(env["ISCM_METADATA_CACHE"]) == 0600
+# The facts are read by the ansible user
+assert mode(sandbox.path + "/opt/cfn-ansible/etc/host_vars/localhost.json") & 0044
+# Failing to fetch the snapshot within the retry budget fails the command,
+# and leaves no partial snapshot behind
+os.remove(env["ISCM_METADATA_CACHE"])
+(code, output) = sandbox.run(facts_cmd, dict(env, SANDBOX_API_THROTTLES="100", ISCM_API_RETRIES="3"))
+assert code == 1 and "Unable to fetch the instance metadata" in output, output
+assert sandbox.count_calls("cfn-get-metadata") == 4
+assert os.listdir(os.path.dirname(env["ISCM_METADATA_CACHE"])) == []
+
+# The shell modules fetch the snapshot when it's missing
+sandbox = BootSandbox()
+sandbox.publish_metadata(resource)
+env = { "ISCM_METADATA_CACHE": sandbox.path + "/var/lib/cloudcast/metadata.json", "SHELL_ISCM_NAME": "x" }
+(code, output) = sandbox.run(". %s ; snapshot_metadata" % _shellinit_file, env)
+assert code == 0, output
+assert mode(env["ISCM_METADATA_CACHE"]) == 0600 and mode(sandbox.path + "/var/lib/cloudcast") == 0700
+
+print "OK"
@@ -0,0 +1,68 @@
+'''
+Checks which of the modules first imported by a template are kept after
+loading it: the cloudcast modules are, so the objects the template created
+with them keep working. The library, with its stack elements, is loaded
+afresh by each template.
+
+@author: David Losada Carballo <david@tuxpiper.com>
+'''
+
+import json, os, shutil, sys, tempfile
+import cloudcast
+from cloudcast import Stack
+
+template = """
+from _context import stack
+from cloudcast.template import *
+from cloudcast.library import stack_user
+from cloudcast.images import JSONImageRegistry
+from cloudcast.iscm.cfninit import CfnInit
+from cloudcast.iscm.phased import PhasedISCM, RunOnce, RunOnDeploy
+import helper
+
+stack.image_registry = JSONImageRegistry(%r)
+
+Web = EC2Instance(
+    ImageId = "ami-0b9c9f62",
+    InstanceType = helper.instance_type,
+    iscm = PhasedISCM(
+        context = { "_iscm": { "cfninit_key": stack_user.CloudFormationStackUserKey } },
+        phases = [ RunOnce("Base", [ CfnInit(commands={ "base": { "command": "echo base" } }) ]),
+                   RunOnDeploy("Boot", [ CfnInit(commands={ "boot": { "command": "echo boot" } }) ]) ]
+    )
+)
+"""
+
+# Not imported along with the package
+for modname in [ "cloudcast.images", "cloudcast.iscm", "cloudcast.iscm.phased" ]:
+    assert not sys.modules.has_key(modname), modname
+
+folder = tempfile.mkdtemp(prefix="cloudcast-modules-")
+try:
+    path = os.path.join(folder, "modules.rsc.py")
+    with open(path, "w") as f:
+        f.write(template % os.path.join(folder, "images.json"))
+    with open(os.path.join(folder, "helper.py"), "w") as f:
+        f.write('instance_type = "m1.small"\n')
+    stack = Stack(description="modules", resources_file=path)
+    # The cloudcast modules are kept, the rest of them are dropped
+    for modname in [ "cloudcast.images", "cloudcast.iscm", "cloudcast.iscm.cfninit", "cloudcast.iscm.phased" ]:
+        assert sys.modules.has_key(modname), modname
+    dropped = [ m for m in sys.modules if m in [ "helper", "_context", "cloudcast.library.stack_user" ] or
+                m.startswith("cloudcast._template_") ]
+    assert dropped == [], dropped
+    # The registry and the ISCM created by the template keep working
+    web = stack.get_element("Web")
+    status_id = [ b["status_id"] for b in web.iscm.get_possible_builds()
+                  if [ p.phase_name for p in b["run_phases"] ] == [ "Boot" ] ][0]
+    stack.image_registry.register(status_id, "ami-base", base_image="ami-0b9c9f62")
+    resource = json.loads(stack.dump_json())["Resources"]["Web"]
+    assert resource["Properties"]["ImageId"] == "ami-base"
+    assert sorted(resource["Metadata"]["AWS::CloudFormation::Init"]["configSets"].keys()) == [ "Boot", "default" ]
+    # Each template gets its own library elements
+    other = Stack(description="modules", resources_file=path)
+    assert other.get_element("CloudFormationStackUserKey") is not stack.get_element("CloudFormationStackUserKey")
+finally:
+    shutil.rmtree(folder)
+
+print "OK"
@@ -0,0 +1,73 @@
+'''
+Checks that the configs of independent modules are applied concurrently,
+with a log per branch, and that a failing branch stops the boot right away.
+Without wait -n (bash < 4.3), branches are run one after another.
+
+@author: David Losada Carballo <david@tuxpiper.com>
+'''
+
+import json, os, subprocess, time
+from boot_sandbox import BootSandbox, render
+from cloudcast import Stack
+from cloudcast.iscm import _userdata_header
+from cloudcast.iscm.cfninit import parallel_sh
+
+def read_events(sandbox):
+    # Returns { "start a": t, "end a": t, ... }
+    events = {}
+    with open(os.path.join(sandbox.path, "root", "branches.log")) as f:
+        for line in f:
+            (event, name, t) = line.split()
+            events["%s %s" % (event, name)] = float(t)
+    return events
+
+for backend in [ "cfninit", "cloudinit" ]:
+    boot = BootSandbox.boot if backend == "cfninit" else BootSandbox.boot_cloudinit
+    # Branches a and (b1, b2) overlap, c waits for all of them
+    sandbox = BootSandbox()
+    (code, output) = boot(sandbox, render("template4.rsc.py", env={ "iscm_backend": backend }),
+                          env={ "ISCM_WCHANDLE_URL": "https://wait-handle", "ISCM_API_BACKOFF": "0" })
+    assert code == 0, output
+    events = read_events(sandbox)
+    assert events["start a"] < events["end b1"] and events["start b1"] < events["end a"], events
+    assert events["end b1"] <= events["start b2"], events
+    assert events["start c"] >= max(events["end a"], events["end b2"]), events
+    logs = os.listdir(os.path.join(sandbox.path, "var", "log", "iscm-parallel"))
+    assert sorted(logs) == [ "default__1_1.log", "default__1_2.log" ], logs
+    if backend == "cfninit":
+        assert "-e 0" in open(os.path.join(sandbox.path, "cfn-signal.calls")).read()
+
+    # Branch a fails, b1 is stopped instead of sleeping its time away
+    sandbox = BootSandbox()
+    t0 = time.time()
+    (code, output) = boot(sandbox, render("template4.rsc.py", env={ "iscm_backend": backend, "exit_code_a": "3", "sleep_b": "60" }),
+                          env={ "ISCM_WCHANDLE_URL": "https://wait-handle", "ISCM_API_BACKOFF": "0" })
+    assert time.time() - t0 < 30, output
+    assert "A concurrent branch failed" in output, output
+    events = read_events(sandbox)
+    assert not events.has_key("start c") and not events.has_key("start b2"), events
+    if backend == "cfninit":
+        assert "-e 0" not in open(os.path.join(sandbox.path, "cfn-signal.calls")).read()
+    # Nothing is left running
+    time.sleep(1)
+    processes = subprocess.Popen([ "ps", "-eo", "args=" ], stdout=subprocess.PIPE).communicate()[0]
+    assert "sleep 60" not in processes.splitlines()
+
+# The configsets split for concurrency are only in the rendered template
+stack = Stack(description="parallel", env={}, resources_file="template4.rsc.py")
+init = json.loads(stack.dump_json())["Resources"]["AnInstance"]["Metadata"]["AWS::CloudFormation::Init"]
+assert sorted(init["configSets"].keys()) == [ "default", "default__1_1", "default__1_2", "default__2" ], init["configSets"]
+assert stack.get_element("AnInstance").iscm.processors[0].config_sets == {}
+
+# Without wait -n
+script = _userdata_header + parallel_sh + "\n".join([ "",
+    'iscm_has_wait_n() { return 1 ; }',
+    'step() { echo "step $1" ; [ $1 != fail ] ; }',
+    'iscm_run_parallel test: step one two ; echo "rc $?"',
+    'iscm_run_parallel test: step fail three ; echo "rc $?"', "" ])
+output = subprocess.Popen([ "bash", "-c", script ], stdout=subprocess.PIPE, stderr=subprocess.STDOUT).communicate()[0]
+assert [ l for l in output.splitlines() if l.startswith("step") or l.startswith("rc") ] == \
+    [ "step one", "step two", "rc 0", "step fail", "rc 1" ], output
+assert "lacks wait -n" in output
+
+print "OK"
@@ -0,0 +1,88 @@
+'''
+Checks the digests of the ISCM phases: they are memoized Merkle digests,
+equal to digesting the phases afresh, and the status ids they make up are
+stable across loads of the same template, and change with the playbooks.
+
+@author: David Losada Carballo <david@tuxpiper.com>
+'''
+
+import hashlib, os, shutil, subprocess, sys, tempfile
+from cloudcast import Stack
+from cloudcast._utils import stable_digest, DigestTree, DigestedStr
+
+# Digests of plain values, as documented
+assert stable_digest("abc") == hashlib.sha256("s:abc").hexdigest()
+assert stable_digest([ 1, None ]) == hashlib.sha256("l:" +
+    hashlib.sha256("n:1").hexdigest() + hashlib.sha256("n:null").hexdigest()).hexdigest()
+assert stable_digest({ "b": 1, "a": "x" }) == stable_digest({ "a": "x", "b": 1 })
+assert stable_digest(DigestedStr("abc")) == stable_digest("abc")
+assert stable_digest({ "k": DigestTree([ "v" ]) }) == stable_digest({ "k": [ "v" ] })
+
+def load(folder):
+    stack = Stack(description="digests", env={ "instance_type": "m1.small" },
+                  resources_file=os.path.join(folder, "template2.rsc.py"))
+    return stack.elements.launchables[0].iscm
+
+# Work on a copy of the template, so playbooks can be modified
+folder = tempfile.mkdtemp(prefix="cloudcast-digests-")
+shutil.copy("template2.rsc.py", folder)
+shutil.copytree("ansible", os.path.join(folder, "ansible"))
+
+iscm = load(folder)
+for p in iscm.phases:
+    assert p.get_digest() == stable_digest(p.get_dict_repr()), p
+builds = iscm.get_possible_builds()
+status_ids = [ b["status_id"] for b in builds ]
+assert len([ s for s in status_ids if s ]) > 0
+# The status ids are the running hash of the phase digests
+hashsum = hashlib.sha256()
+for p in iscm.phases:
+    hashsum.update(p.get_digest())
+    if p.phase_type == "run_once":
+        assert hashsum.hexdigest() in status_ids
+
+# Same template, same ids. Unchanged playbook files aren't read again
+iscm2 = load(folder)
+assert [ b["status_id"] for b in iscm2.get_possible_builds() ] == status_ids
+def playbook_contents(iscm):
+    for p in iscm.phases:
+        for config in p.actions["cfninit_configs"].values():
+            for f in config.get("files", {}).values():
+                if isinstance(f["content"], DigestedStr):
+                    yield f["content"]
+assert [ id(c) for c in playbook_contents(iscm) ] == [ id(c) for c in playbook_contents(iscm2) ]
+
+# Changing a playbook changes the ids
+with open(os.path.join(folder, "ansible", "playbook.yaml"), "a") as f:
+    f.write("\n# changed\n")
+iscm3 = load(folder)
+assert [ b["status_id"] for b in iscm3.get_possible_builds() ] != status_ids
+
+shutil.rmtree(folder)
+
+# Stack elements in the phases are digested as they're rendered, so the ids
+# don't depend on where the objects are in memory
+parameter_status_id = """
+from cloudcast import Stack
+from cloudcast.template import EC2Instance, Parameter, Resource
+from cloudcast.iscm.cfninit import CfnInit
+from cloudcast.iscm.phased import PhasedISCM, RunOnce
+def status_id():
+    stack = Stack(description="digests")
+    key = Resource("AWS::IAM::AccessKey", UserName="someone")
+    stack.add_element(key, "Key")
+    level = Parameter(Type="String", Default="info")
+    stack.add_element(level, "LogLevel")
+    web = EC2Instance(ImageId="ami-0b9c9f62", InstanceType="m1.small", iscm=PhasedISCM(
+        context = { "_iscm": { "cfninit_key": key } },
+        phases = [ RunOnce("Base", [ CfnInit(commands={ "log": { "command": "echo $LEVEL", "env": { "LEVEL": level } } }) ]) ]
+    ))
+    stack.add_element(web, "Web")
+    return web.iscm.get_possible_builds()[0]["status_id"]
+"""
+exec parameter_status_id
+assert status_id() == status_id()
+run = [ sys.executable, "-c", parameter_status_id + "print status_id()" ]
+assert subprocess.check_output(run).strip() == subprocess.check_output(run).strip() == status_id()
+
+print "OK"
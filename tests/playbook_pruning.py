@@ -0,0 +1,121 @@
+'''
+Checks that only the playbook files the runs need are embedded, following
+includes, imports, roles and vars files, and the report of the files left out.
+
+@author: David Losada Carballo <david@tuxpiper.com>
+'''
+
+import os, json, shutil, tempfile
+from cloudcast import Stack
+from cloudcast.template import EC2Instance, Resource
+from cloudcast.iscm.ansible import AnsibleISCM, format_playbooks_report
+
+files = {
+    "site.yml": """
+- hosts: all
+  vars_files:
+    - vars/common.yml
+    - [ "vars/missing.yml", "vars/fallback.yml" ]
+  roles:
+    - web
+    - { role: db, port: 5432 }
+    - galaxy.installed
+  tasks:
+    - include: tasks/setup.yml
+    - name: run a script
+      script: scripts/run.sh --now
+    - debug: msg="{{ some_var }}"
+""",
+    "other.yml": "- hosts: all\n  roles: [ unused ]\n",
+    "vars/common.yml": "a: 1\n",
+    "vars/fallback.yml": "b: 2\n",
+    "vars/unused.yml": "c: 3\n",
+    "group_vars/all.yml": "d: 4\n",
+    "tasks/setup.yml": "- include: more.yml\n",
+    "tasks/more.yml": "- debug: msg=more\n",
+    "tasks/unused.yml": "- debug: msg=unused\n",
+    "scripts/run.sh": "#!/bin/sh\n",
+    "scripts/unused.sh": "#!/bin/sh\n",
+    "roles/web/tasks/main.yml": "- include_role:\n    name: common\n",
+    "roles/web/templates/index.html.j2": "hello\n",
+    "roles/web/meta/main.yml": "dependencies: []\n",
+    "roles/common/tasks/main.yml": "- debug: msg=common\n",
+    "roles/db/tasks/main.yml": "- debug: msg=db\n",
+    "roles/unused/tasks/main.yml": "- debug: msg=unused\n",
+    "tests/test.yml": "- hosts: all\n",
+    ".git/config": "[core]\n",
+    "site.retry": "localhost\n",
+    "notes.bak": "old\n",
+}
+needed = [ "group_vars/all.yml", "roles/common/tasks/main.yml", "roles/db/tasks/main.yml",
+           "roles/web/meta/main.yml", "roles/web/tasks/main.yml", "roles/web/templates/index.html.j2",
+           "scripts/run.sh", "site.yml", "tasks/more.yml", "tasks/setup.yml", "vars/common.yml", "vars/fallback.yml" ]
+
+def render(folder, **kwargs):
+    stack = Stack(description="pruning")
+    key = Resource("AWS::IAM::AccessKey", UserName="someone")
+    stack.add_element(key, "Key")
+    iscm = AnsibleISCM(
+        config=dict(inst_home="/home/ubuntu", inst_user="ubuntu", inst_group="ubuntu", inst_playbook_dir="playbooks"),
+        playbooks_source=folder, stack_user_key=key, **kwargs)
+    stack.add_element(EC2Instance(ImageId="ami-0b9c9f62", InstanceType="m1.small", iscm=iscm), "Web")
+    t = json.loads(stack.dump_json(pretty=False))
+    embedded = t["Resources"]["Web"]["Metadata"]["AWS::CloudFormation::Init"]["_ansible_playbooks_install"]["files"].keys()
+    return (sorted([ os.path.relpath(f, "/home/ubuntu/playbooks") for f in embedded ]), iscm.playbooks_report())
+
+folder = tempfile.mkdtemp(prefix="cloudcast-pruning-")
+try:
+    for (path, contents) in files.items():
+        if not os.path.isdir(os.path.dirname(os.path.join(folder, path))):
+            os.makedirs(os.path.dirname(os.path.join(folder, path)))
+        with open(os.path.join(folder, path), "w") as f:
+            f.write(contents)
+    runs = dict(boot=dict(playbook="site.yml"))
+
+    (embedded, report) = render(folder, runs=runs, playbooks_ignore=[ "*.bak" ])
+    assert embedded == needed, embedded
+    assert sorted(report["embedded"]) == needed and report["not_pruned"] is None
+    reasons = dict([ (e["path"], e["reason"]) for e in report["excluded"] ])
+    assert sorted(reasons.keys()) == sorted(set(files.keys()) - set(needed))
+    assert sorted([ p for (p, r) in reasons.items() if r == "ignored" ]) == [ ".git/config", "notes.bak", "site.retry" ]
+    assert reasons["other.yml"] == "unreferenced" and reasons["roles/unused/tasks/main.yml"] == "unreferenced"
+    # Roles that aren't in the sources may be in the instance already
+    assert report["unresolved"] == [ dict(source="site.yml", reference="galaxy.installed") ], report["unresolved"]
+    text = format_playbooks_report(report)
+    assert "excluded (unreferenced): other.yml" in text and "unresolved reference in site.yml: galaxy.installed" in text
+
+    # Every run is taken into account
+    (embedded, report) = render(folder, runs=dict(boot=dict(playbook="site.yml"), build=dict(playbook="other.yml")))
+    assert "other.yml" in embedded and "roles/unused/tasks/main.yml" in embedded
+    assert "notes.bak" not in embedded and ".git/config" not in embedded
+
+    # References that depend on variables can't be followed, nothing is pruned
+    with open(os.path.join(folder, "tasks", "more.yml"), "w") as f:
+        f.write("- include: \"{{ distro }}.yml\"\n# grown\n")
+    (embedded, report) = render(folder, runs=runs)
+    assert "tasks/unused.yml" in embedded and "notes.bak" in embedded and "site.retry" not in embedded
+    assert "{{ distro }}.yml (in tasks/more.yml)" in report["not_pruned"], report["not_pruned"]
+
+    # Unless asked not to
+    (embedded, report) = render(folder, runs=runs, prune_playbooks=False)
+    assert len(embedded) == len(files) - 2 and report["not_pruned"] == "pruning disabled"
+
+    # Files read by lookups or looped over can't be told apart, nothing is pruned
+    for (name, path) in [ ("keys", "keys/id.pub"), ("certs", "certs/ca.pem") ]:
+        os.makedirs(os.path.join(folder, name))
+        with open(os.path.join(folder, path), "w") as f:
+            f.write("%s\n" % name)
+    for (k, (task, reference)) in enumerate([
+            ("authorized_key: user=ubuntu key=\"{{ lookup('file', 'keys/id.pub') }}\"",
+             "user=ubuntu key=\"{{ lookup('file', 'keys/id.pub') }}"),
+            ("copy: src={{ item }} dest=/etc/ssl/\n      with_fileglob: [ certs/* ]", "[ certs/* ]"),
+            ("copy: src={{ item }} dest=/etc/ssl/\n      with_fileglob:\n        - certs/*", "certs/*") ]):
+        with open(os.path.join(folder, "files%d.yml" % k), "w") as f:
+            f.write("- hosts: all\n  tasks:\n    - %s\n" % task)
+        (embedded, report) = render(folder, runs=dict(boot=dict(playbook="files%d.yml" % k)))
+        assert "keys/id.pub" in embedded and "certs/ca.pem" in embedded, embedded
+        assert "%s (in files%d.yml)" % (reference, k) in report["not_pruned"], report["not_pruned"]
+finally:
+    shutil.rmtree(folder)
+
+print "OK"
@@ -0,0 +1,109 @@
+'''
+Checks that launchables booting from a baked image don't carry the configs
+and metadata of the phases already in the image, and that they boot
+running the rest of the phases. Configsets split for concurrent configs
+follow the pruning.
+
+@author: David Losada Carballo <david@tuxpiper.com>
+'''
+
+import json, os, re, shutil, tempfile
+from cloudcast import Stack
+from cloudcast.template import EC2Instance, Resource
+from cloudcast.iscm.cfninit import CfnInit, Concurrently
+from cloudcast.iscm.phased import PhasedISCM, RunOnce, RunOnDeploy
+from cloudcast.images import JSONImageRegistry
+from boot_sandbox import BootSandbox
+
+def render(registry=None):
+    stack = Stack(description="prune", image_registry=registry, resources_file="template5.rsc.py")
+    return (stack, json.loads(stack.dump_json()))
+
+# The image for WebA and WebB, baked up to the Web phase
+(stack, unpruned) = render()
+web_status = stack.get_element("WebA").iscm.get_possible_builds()[1]["status_id"]
+assert [ p.phase_name for p in stack.get_element("WebA").iscm.get_possible_builds()[1]["run_phases"] ] == \
+    [ "Config", "AppA", "Boot" ]
+
+folder = tempfile.mkdtemp(prefix="cloudcast-prune-")
+try:
+    registry = JSONImageRegistry(os.path.join(folder, "images.json"))
+    registry.register(web_status, "ami-web", base_image="ami-0b9c9f62")
+    (stack, pruned) = render(registry)
+    (_, kept) = render(JSONImageRegistry(registry.path, prune_baked=False))
+finally:
+    shutil.rmtree(folder)
+
+web_a = pruned["Resources"]["WebA"]
+init = web_a["Metadata"]["AWS::CloudFormation::Init"]
+assert web_a["Properties"]["ImageId"] == "ami-web"
+assert sorted(init["configSets"].keys()) == [ "AppA", "Boot", "Config", "default" ], init["configSets"].keys()
+assert init["configSets"]["default"] == [ "Config-001", "AppA-001", "Boot-001" ], init["configSets"]["default"]
+assert sorted(init.keys()) == [ "AppA-001", "Boot-001", "Config-001", "configSets" ], init.keys()
+assert web_a["Metadata"]["_facts"] == { "config": "yes", "AppA": "yes" }
+# The status ids don't change with pruning
+assert stack.get_element("WebA").iscm.get_possible_builds()[1]["status_id"] == web_status
+# Without pruning, only the phases to run change
+assert kept["Resources"]["WebA"]["Properties"]["ImageId"] == "ami-web"
+assert kept["Resources"]["WebA"]["Metadata"] == unpruned["Resources"]["WebA"]["Metadata"]
+assert len(json.dumps(web_a)) < len(json.dumps(kept["Resources"]["WebA"]))
+# Launchables without a registered image keep everything
+assert pruned["Resources"]["Worker"] == unpruned["Resources"]["Worker"]
+
+# Booting runs the phases that weren't baked
+sandbox = BootSandbox()
+(code, output) = sandbox.boot(web_a)
+assert "Unknown" not in output and "Traceback" not in output, output
+steps = re.findall(r"^(\w+)$", output, re.M)
+assert steps == [ "config", "AppA", "boot" ], output
+assert sandbox.count_calls("cfn-signal") == 0
+
+# Concurrent configs in the baked phase and in the pending one
+def Step(name):
+    return CfnInit(commands={ "step-" + name: { "command": "echo %s" % name } })
+
+def render_concurrent(registry=None):
+    stack = Stack(description="prune", image_registry=registry)
+    key = Resource("AWS::IAM::AccessKey", UserName="someone")
+    stack.add_element(key, "Key")
+    stack.add_element(EC2Instance(ImageId="ami-0b9c9f62", InstanceType="m1.small", iscm=PhasedISCM(
+        context = { "_iscm": { "cfninit_key": key } },
+        phases = [ RunOnce("Base", [ Concurrently(Step("a"), Step("b")) ]),
+                   RunOnDeploy("Boot", [ Concurrently(Step("c"), Step("d")), Step("e") ]) ]
+    )), "Web")
+    return (stack, json.loads(stack.dump_json())["Resources"]["Web"])
+
+def runner_case(resource):
+    # The configsets named by the runner of the split configsets
+    userdata = BootSandbox().flatten(resource["Properties"]["UserData"])
+    return re.findall(r"^  '(\w+)'\) (.*) ;;$", userdata, re.M)
+
+(stack, unpruned) = render_concurrent()
+init = unpruned["Metadata"]["AWS::CloudFormation::Init"]
+assert sorted([ cs for cs in init["configSets"] if cs.startswith("Base__") ]) == [ "Base__1_1", "Base__1_2" ]
+assert [ cs for (cs, _) in runner_case(unpruned) ] == [ "Base", "Boot", "default" ]
+base_status = [ b["status_id"] for b in stack.get_element("Web").iscm.get_possible_builds()
+                if [ p.phase_name for p in b["run_phases"] ] == [ "Boot" ] ][0]
+folder = tempfile.mkdtemp(prefix="cloudcast-prune-")
+try:
+    registry = JSONImageRegistry(os.path.join(folder, "images.json"))
+    registry.register(base_status, "ami-base", base_image="ami-0b9c9f62")
+    (_, pruned) = render_concurrent(registry)
+finally:
+    shutil.rmtree(folder)
+init = pruned["Metadata"]["AWS::CloudFormation::Init"]
+assert sorted(init["configSets"].keys()) == [ "Boot", "Boot__1_1", "Boot__1_2", "Boot__2",
+    "default", "default__1_1", "default__1_2", "default__2" ], init["configSets"].keys()
+assert init["configSets"]["default__2"] == [ "Boot-003" ], init["configSets"]
+# The runner only names the configsets left, after the pruning
+for (cs, steps) in runner_case(pruned):
+    assert cs in init["configSets"], cs
+    for split in re.findall(r"'(\w+)'", steps):
+        assert split in init["configSets"], split
+sandbox = BootSandbox()
+(code, output) = sandbox.boot(pruned, env={ "ISCM_API_BACKOFF": "0" })
+assert code == 0 and "Unknown" not in output, output
+assert sorted(re.findall(r"^(\w)$", output, re.M)) == [ "c", "d", "e" ], output
+assert "Output of Boot__1_1:" in output and "Output of Boot__1_2:" in output, output
+
+print "OK"
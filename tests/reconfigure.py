@@ -0,0 +1,119 @@
+'''
+Checks the in-place reconfiguration setup: the content hashes of the
+configsets in the metadata, the cfn-hup hook, and the tool that tells which
+configsets changed.
+
+@author: David Losada Carballo <david@tuxpiper.com>
+'''
+
+import os, sys, json, shutil, tempfile, subprocess
+from cloudcast import Stack
+from cloudcast.template import EC2Instance, Resource
+from cloudcast.iscm import ISCM, ISCMPrototype
+from cloudcast.iscm.cfninit import CfnInit, CfnInitISCM, CONFIGSETS_MD_KEY, RECONFIGURE_CONFIGSET, \
+    RECONFIGURE_SCRIPT, CONFIGSET_HASHES_TOOL, configset_hashes_py
+from cloudcast.iscm.ansible import AnsibleISCM
+
+def cfninit_stack(web_files, facts="one", names=[ "Web" ]):
+    stack = Stack(description="reconfigure")
+    key = Resource("AWS::IAM::AccessKey", UserName="someone")
+    stack.add_element(key, "Key")
+    processor = CfnInitISCM(key, reconfigure_on_update=True)
+    iscm = ISCMPrototype(ISCM(
+        context = { "_iscm": { "cfninit_key": key } },
+        processors = [ processor ],
+        modules = [ CfnInit(configs={ "base": { "files": { "/etc/base": { "content": "base" } } },
+                                      "web": { "files": web_files } }) ]
+    ))
+    processor.iscm_cfninit_add_configset("Base", "base")
+    processor.iscm_cfninit_add_configset("Web", "web")
+    processor.iscm_cfninit_run_configsets("Base", "Web")
+    iscm.iscm.iscm_md_update_dict("facts", { "value": facts })
+    for name in names:
+        stack.add_element(EC2Instance(ImageId="ami-0b9c9f62", InstanceType="m1.small", iscm=iscm), name)
+    return json.loads(stack.dump_json(pretty=False))
+
+def hashes(t, name="Web"):
+    return t["Resources"][name]["Metadata"][CONFIGSETS_MD_KEY]["hashes"]
+
+t = cfninit_stack({ "/etc/web": { "content": "v1" } }, names=[ "Web", "Other" ])
+web = t["Resources"]["Web"]
+configsets = web["Metadata"][CONFIGSETS_MD_KEY]
+assert configsets["run"] == [ "Base", "Web" ]
+assert sorted(configsets["hashes"].keys()) == [ "Base", "Web", "default" ]
+# The same for the launchables of a prototype, but each one watches its own metadata
+assert hashes(t, "Other") == configsets["hashes"]
+init = web["Metadata"]["AWS::CloudFormation::Init"]
+assert init["configSets"][RECONFIGURE_CONFIGSET] == [ RECONFIGURE_CONFIGSET ]
+assert RECONFIGURE_CONFIGSET not in init["configSets"]["default"]
+reconfigure = init[RECONFIGURE_CONFIGSET]
+hook = reconfigure["files"]["/etc/cfn/hooks.d/cloudcast-reconfigure.conf"]["content"]["Fn::Join"][1]
+assert "Web" in hook and "action=%s\n" % RECONFIGURE_SCRIPT in hook
+other_hook = t["Resources"]["Other"]["Metadata"]["AWS::CloudFormation::Init"][RECONFIGURE_CONFIGSET]["files"]["/etc/cfn/hooks.d/cloudcast-reconfigure.conf"]
+assert "Other" in other_hook["content"]["Fn::Join"][1]
+assert reconfigure["files"][RECONFIGURE_SCRIPT]["mode"] == "000700"
+assert reconfigure["files"][CONFIGSET_HASHES_TOOL]["content"] == configset_hashes_py
+assert sorted(reconfigure["commands"].keys()) == [ "01-record-hashes", "02-start-cfn-hup" ]
+userdata = "".join([ e for e in web["Properties"]["UserData"]["Fn::Base64"]["Fn::Join"][1] if isinstance(e, basestring) ])
+assert "iscm_cfninit %s" % RECONFIGURE_CONFIGSET in userdata
+
+# Changing a config only changes the hash of its configsets
+changed = cfninit_stack({ "/etc/web": { "content": "v2" } })
+assert hashes(changed)["Base"] == configsets["hashes"]["Base"]
+assert hashes(changed)["Web"] != configsets["hashes"]["Web"]
+# Other metadata entries are read by any configset
+changed = cfninit_stack({ "/etc/web": { "content": "v1" } }, facts="two")
+assert [ cs for cs in configsets["hashes"] if hashes(changed)[cs] == configsets["hashes"][cs] ] == []
+
+# Not there unless asked for
+t = json.loads(Stack(description="plain", resources_file="template5.rsc.py").dump_json(pretty=False))
+assert not t["Resources"]["WebA"]["Metadata"].has_key(CONFIGSETS_MD_KEY)
+
+# Ansible runs are repeated when the playbooks change
+playbooks = tempfile.mkdtemp(prefix="cloudcast-reconfigure-")
+def ansible_stack():
+    stack = Stack(description="reconfigure")
+    key = Resource("AWS::IAM::AccessKey", UserName="someone")
+    stack.add_element(key, "Key")
+    stack.add_element(EC2Instance(ImageId="ami-0b9c9f62", InstanceType="m1.small", iscm=AnsibleISCM(
+        config=dict(inst_home="/home/ubuntu", inst_user="ubuntu", inst_group="ubuntu", inst_playbook_dir="playbooks"),
+        playbooks_source=playbooks, stack_user_key=key, reconfigure_on_update=True,
+        runs=dict(boot=dict(playbook="playbook.yaml", tags=[ "boot" ]))
+    )), "Web")
+    return json.loads(stack.dump_json(pretty=False))
+try:
+    shutil.rmtree(playbooks)
+    shutil.copytree(os.path.join(os.path.dirname(os.path.abspath(__file__)), "ansible"), playbooks)
+    before = hashes(ansible_stack())
+    with open(os.path.join(playbooks, "playbook.yaml"), "a") as f:
+        f.write("\n# a change\n")
+    after = hashes(ansible_stack())
+finally:
+    shutil.rmtree(playbooks)
+assert after["AnsibleConfig"] != before["AnsibleConfig"]
+assert after["Ansible-Boot"] != before["Ansible-Boot"]
+
+# The tool that compares the hashes in the instance
+folder = tempfile.mkdtemp(prefix="cloudcast-reconfigure-")
+try:
+    tool = os.path.join(folder, "hashes.py")
+    with open(tool, "w") as f:
+        f.write(configset_hashes_py)
+    env = dict(os.environ, ISCM_METADATA_CACHE=os.path.join(folder, "metadata.json"),
+               ISCM_CONFIGSET_HASHES=os.path.join(folder, "state", "hashes.json"))
+    def run(metadata, *args):
+        with open(env["ISCM_METADATA_CACHE"], "w") as f:
+            json.dump({ CONFIGSETS_MD_KEY: metadata }, f)
+        return subprocess.check_output([ sys.executable, tool ] + list(args), env=env).split()
+    metadata = dict(run=[ "Base", "Web" ], hashes={ "Base": "b1", "Web": "w1", "default": "d1" })
+    assert run(metadata, "changed") == [ "Base", "Web" ]
+    run(metadata, "record")
+    assert run(metadata, "changed") == []
+    metadata["hashes"].update(Web="w2", default="d2")
+    assert run(metadata, "changed") == [ "Web" ]
+    run(metadata, "record", "Web")
+    assert run(metadata, "changed") == []
+finally:
+    shutil.rmtree(folder)
+
+print "OK"
@@ -0,0 +1,3 @@
+#!/bin/bash
+
+set > /root/vars-$SHELL_ISCM_NAME.sh
@@ -0,0 +1,172 @@
+'''
+Checks the bundling of the Shell module scripts: the init library written
+once per instance, the minified scripts, and the gzipped ones.
+
+@author: David Losada Carballo <david@tuxpiper.com>
+'''
+
+import json, os, base64, gzip, subprocess
+from StringIO import StringIO
+from cloudcast import Stack
+from cloudcast.template import EC2Instance, Resource
+from cloudcast.iscm import ISCM
+from cloudcast.iscm.cfninit import CfnInitISCM
+from cloudcast.iscm.shell import Shell, minify_sh, _shellinit_file
+
+script = r"""#!/bin/bash
+# A comment, with an apostrophe: it's
+    greet() {
+        # indented comment
+        echo "hello $1"   # trailing comments stay
+    }
+
+msg='a string
+   # that spans lines
+  and keeps its indentation'
+echo "$msg" ${#msg} $(( 1 << 3 ))
+cat <<-"EOF"
+	# not a comment, part of the document
+	    indented
+	EOF
+cat <<EOF | sed 's/^/> /'
+  # neither is this
+EOF
+echo one \
+    # the comment ends the command
+greet world
+"""
+
+# Quoting and here-document cases that minifying must leave working
+edge_cases = [
+    # Here-documents inside command substitutions, and here-strings
+    'x=$(cat <<EOF\n  # kept\n\n  $HOME\nEOF\n)\necho "$x"\ncat <<< "  # a here-string"\n',
+    # Several here-documents in one line, the first one quoted
+    "paste - - <<'A' <<B\n  # a\nA\n  # b\nB\n",
+    # A delimiter that only ends the document at the start of the line
+    "cat <<END\n  END\n# still in the document\nEND\n",
+    # ANSI-C quoting with escaped quotes, spanning lines
+    "echo $'it\\'s\n  # inside'\n",
+    # Double quotes spanning lines, with escaped quotes and substitutions
+    'echo "a \\"quoted\\"\n    # line $(echo "  # nested")\n  end"\n',
+    # Hashes that don't start comments
+    "echo a#b ${#HOME} $((2#101)) x'#'y\n",
+    # Backquotes spanning lines
+    "echo `echo \"\n  # in backquotes\"`\n",
+    # Case statements and comments after them
+    'case "a#" in\n  a\\#) echo one ;;   # first\n  *) echo other ;;\nesac\n',
+]
+
+def run(code):
+    return subprocess.check_output([ "bash", "-c", code ])
+
+for code in edge_cases:
+    assert run(minify_sh(code)) == run(code), code
+
+minified = minify_sh(script)
+assert run(minified) == run(script)
+lines = minified.splitlines()
+assert lines[0] == "#!/bin/bash" and "greet() {" in lines and "" not in lines
+assert "# indented comment" not in minified and 'echo "hello $1"   # trailing comments stay' in lines
+assert "   # that spans lines" in lines and "\t# not a comment, part of the document" in lines
+assert "  # neither is this" in lines and "    # the comment ends the command" in lines
+init = open(_shellinit_file).read()
+assert len(minify_sh(init)) < len(init) and 'print "%s=\\"%s\\"" % (k, v.replace(\'"\', \'\\\\"\'))' in minify_sh(init)
+
+def render(**kwargs):
+    if not kwargs:
+        return json.loads(Stack(description="shell", env={}, resources_file="template3.rsc.py").dump_json(pretty=False))
+    stack = Stack(description="shell")
+    key = Resource("AWS::IAM::AccessKey", UserName="someone")
+    stack.add_element(key, "Key")
+    stack.add_element(EC2Instance(ImageId="ami-0b9c9f62", InstanceType="m1.small", iscm=ISCM(
+        context = { "_iscm": { "cfninit_key": key } },
+        processors = [ CfnInitISCM(key) ],
+        modules = [ Shell(scripts=[ Shell.runScript("scripts/dump-vars.sh") ], **kwargs),
+                    Shell(scripts=[ Shell.runScript("scripts/dump-vars.sh") ], **kwargs) ]
+    )), "Bundled")
+    return json.loads(stack.dump_json(pretty=False))
+
+# The init library is written once, by a config of its own that runs before
+# the modules, which source it from their init scripts. Scripts aren't
+# minified unless asked to
+t = render()
+init_configs = t["Resources"]["AnInstance"]["Metadata"]["AWS::CloudFormation::Init"]
+configs = [ c for c in init_configs.values() if type(c) == dict and c.get("commands", {}).has_key("runit") ]
+assert len(configs) == 2
+lib_configs = [ name for name in init_configs if name.startswith("shell_lib_") ]
+assert len(lib_configs) == 1, lib_configs
+assert init_configs["configSets"]["default"][0] == lib_configs[0]
+(lib, content) = init_configs[lib_configs[0]]["files"].items()[0]
+assert lib.startswith("/root/shell-iscm/lib-") and content["content"] == init
+assert json.dumps(t).count(json.dumps(init)[1:-1]) == 1
+for config in configs:
+    assert not [ path for path in config["files"] if "lib-" in path ]
+    name = [ path for path in config["files"] if path.startswith("/root/shell-iscm/init-") ][0]
+    assert config["files"][name]["content"]["Fn::Join"][1][-1] == ". %s\n" % lib
+t = render(minify=True)
+init_configs = t["Resources"]["Bundled"]["Metadata"]["AWS::CloudFormation::Init"]
+lib_configs = [ name for name in init_configs if name.startswith("shell_lib_") ]
+assert len(lib_configs) == 1 and init_configs[lib_configs[0]]["files"].values()[0]["content"] == minify_sh(init)
+
+# Unminified and gzipped
+t = render(compress=True)
+init_configs = t["Resources"]["Bundled"]["Metadata"]["AWS::CloudFormation::Init"]
+files = {}
+commands = {}
+for config in init_configs.values():
+    if type(config) == dict:
+        files.update(config.get("files", {}))
+        commands.update(config.get("commands", {}))
+libs = [ path for path in files if path.startswith("/root/shell-iscm/lib-") ]
+assert len(libs) == 1, libs
+lib = libs[0]
+assert lib.endswith(".sh.gz") and files[lib]["encoding"] == "base64"
+assert gzip.GzipFile(fileobj=StringIO(base64.b64decode(files[lib]["content"]))).read() == init
+assert commands["gunzip-%s" % lib.split("/")[-1][:-3]]["command"] == "gunzip -n -f %s" % lib
+script = gzip.GzipFile(fileobj=StringIO(base64.b64decode(files["/root/shell-iscm/shell_1.sh.gz"]["content"]))).read()
+assert script == "#!/bin/bash\n. /root/shell-iscm/init-shell_1.sh\n" + open("scripts/dump-vars.sh").read()
+
+
+# Modules that run concurrently all have the library in place when they
+# source it, even if the first module is the last one to run
+from boot_sandbox import BootSandbox
+from cloudcast.iscm.cfninit import CfnInit, Concurrently
+def dump_vars(name):
+    return Shell(name=name, scripts=[ Shell.runScript("scripts/dump-vars.sh") ])
+stack = Stack(description="shell", env={})
+key = Resource("AWS::IAM::AccessKey", UserName="someone")
+stack.add_element(key, "Key")
+stack.add_element(EC2Instance(ImageId="ami-0b9c9f62", InstanceType="m1.small", iscm=ISCM(
+    context = { "_iscm": { "cfninit_key": key } },
+    processors = [ CfnInitISCM(key, api_backoff=0) ],
+    modules = [ Concurrently([ CfnInit(commands={ "wait": { "command": "sleep 1" } }), dump_vars("a") ],
+                             dump_vars("b"), dump_vars("c")) ]
+)), "Concurrent")
+resource = json.loads(stack.dump_json(pretty=False))["Resources"]["Concurrent"]
+sandbox = BootSandbox()
+(code, output) = sandbox.boot(resource)
+assert code == 0, output
+for name in [ "a", "b", "c" ]:
+    dumped = open(sandbox.relocate("/root/vars-%s.sh" % name)).read()
+    assert "SHELL_ISCM_NAME=%s" % name in dumped and "load_shell_vars ()" in dumped, name
+libs = [ f for f in os.listdir(sandbox.relocate("/root/shell-iscm")) if "lib-" in f ]
+assert len(libs) == 1 and libs[0].startswith("lib-"), libs
+
+# With phases, the library goes in the first phase with Shell modules
+from cloudcast.iscm.phased import PhasedISCM, RunOnce
+stack = Stack(description="shell", env={})
+key = Resource("AWS::IAM::AccessKey", UserName="someone")
+stack.add_element(key, "Key")
+stack.add_element(EC2Instance(ImageId="ami-0b9c9f62", InstanceType="m1.small", iscm=PhasedISCM(
+    context = { "_iscm": { "cfninit_key": key } },
+    phases = [ RunOnce("Packages", [ CfnInit(commands={ "noop": { "command": "true" } }) ]),
+               RunOnce("Base", [ dump_vars("a") ]),
+               RunOnce("App", [ dump_vars("b") ]) ]
+)), "Phased")
+init_configs = json.loads(stack.dump_json(pretty=False))["Resources"]["Phased"]["Metadata"]["AWS::CloudFormation::Init"]
+lib_configs = [ name for name in init_configs if name.startswith("shell_lib_") ]
+assert len(lib_configs) == 1, lib_configs
+assert init_configs["configSets"]["Base"] == [ lib_configs[0], "Base-002" ], init_configs["configSets"]
+assert lib_configs[0] not in init_configs["configSets"]["Packages"] + init_configs["configSets"]["App"]
+
+print "OK"
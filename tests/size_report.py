@@ -0,0 +1,77 @@
+'''
+Checks the attribution of template bytes to elements, metadata keys,
+cfn-init configs, configsets and embedded files, and the diff between
+two reports.
+
+@author: David Losada Carballo <david@tuxpiper.com>
+'''
+
+import os, json, tempfile
+from cloudcast import Stack
+from cloudcast.report import size_report, format_diff, SizeReport, encoded_size
+from cloudcast.template import EC2Instance, Resource
+from cloudcast.iscm import ISCM
+from cloudcast.iscm.cfninit import CfnInitISCM, CfnEmbedFile
+
+INIT = "Metadata/AWS::CloudFormation::Init"
+
+# Phase configs and configsets
+stack = Stack(description="sizes", resources_file="template5.rsc.py")
+report = size_report(stack)
+t = json.loads(stack.dump_json(pretty=False))
+assert report.total == encoded_size(t)
+assert report.get("Resources")["bytes"] == encoded_size(t["Resources"])
+web_a = t["Resources"]["WebA"]
+assert report.get("Resources/WebA")["bytes"] == encoded_size(web_a)
+assert report.get("Resources/WebA/Properties/UserData")["bytes"] == encoded_size(web_a["Properties"]["UserData"])
+assert report.get("Resources/WebA/%s/Base-001" % INIT)["kind"] == "config"
+configset = report.get("Resources/WebA/%s/configset:Base" % INIT)
+assert configset["kind"] == "configset"
+assert configset["bytes"] == sum([ report.get("Resources/WebA/%s/%s" % (INIT, c))["bytes"]
+                                   for c in web_a["Metadata"]["AWS::CloudFormation::Init"]["configSets"]["Base"] ])
+assert report.get("Resources/WebA/Metadata/_facts")["raw_bytes"] == len("configyesBaseyesWebyesAppAyes")
+# Rows are nested in template order
+rows = [ r["path"] for r in report.rows ]
+assert rows.index("Resources") < rows.index("Resources/WebA") < rows.index("Resources/WebA/Properties/UserData")
+table = report.format(depth=1)
+assert "  WebA\n" in table and "Base-001" not in table
+
+# Ansible configs
+stack2 = Stack(description="sizes", env={ "instance_type": "m1.small" }, resources_file="template2.rsc.py")
+report2 = size_report(stack2)
+assert report2.get("Resources/AnInstance/%s/_ansible_playbooks_install" % INIT)["bytes"] > 0
+assert report2.get("Resources/AnInstance/Metadata/_ansible_facts")["kind"] == "metadata"
+
+# Embedded files count their decoded size as raw bytes
+def embed_stack(contents):
+    stack = Stack(description="embedded")
+    key = Resource("AWS::IAM::AccessKey", UserName="someone")
+    stack.add_element(key, "Key")
+    stack.add_element(EC2Instance(ImageId="ami-0b9c9f62", InstanceType="m1.small", iscm=ISCM(
+        context = { "_iscm": { "cfninit_key": key } },
+        processors = [ CfnInitISCM(key) ],
+        modules = [ CfnEmbedFile(contents=contents, dest_path="/opt/data.txt") ]
+    )), "Embedder")
+    return stack
+small = size_report(embed_stack("hello world\n" * 1000))
+files = [ r for r in small.rows if r["kind"] == "file" ]
+assert [ r["label"] for r in files ] == [ "file:/opt/data.txt.gz" ], files
+assert files[0]["raw_bytes"] == 12000
+assert files[0]["bytes"] < 12000
+
+# Diffs, also between saved reports
+big = size_report(embed_stack("".join([ "line %d\n" % i for i in range(5000) ])))
+path = tempfile.mktemp(suffix=".json")
+try:
+    small.save(path)
+    small = SizeReport.load(path)
+finally:
+    os.remove(path)
+changes = small.diff(big)
+assert changes[0]["path"] == "Resources", changes[0]
+assert "Resources/Embedder/%s/cfninit_000/file:/opt/data.txt.gz" % INIT in [ c["path"] for c in changes ]
+assert "Resources/Key" not in [ c["path"] for c in changes ]
+assert "(total)" in format_diff(small, big).splitlines()[-1]
+assert small.diff(small) == []
+
+print "OK"
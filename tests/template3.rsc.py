@@ -0,0 +1,54 @@
+'''
+Test/sample cloudcast template, with several shell modules
+
+@author: David Losada Carballo <david@tuxpiper.com>
+'''
+
+from cloudcast.template import *
+from cloudcast.library import stack_user
+from _context import stack
+
+from cloudcast.iscm import ISCM
+from cloudcast.iscm.cfninit import CfnInit, CfnInitISCM
+from cloudcast.iscm.shell import Shell
+from cloudcast.iscm.cloudinit import CloudInitISCM
+
+PreciseAMIs = Mapping({
+    "us-east-1" : { "ebs": "ami-0b9c9f62", "instance": "ami-6f969506" },
+    "us-west-2" : { "ebs": "ami-6335a453", "instance": "ami-4933a279" }
+})
+
+SQSQueue1 = Resource("AWS::SQS::Queue")
+
+AnInstance = EC2Instance(
+    ImageId = PreciseAMIs.find(AWS.Region, "ebs"),
+    InstanceType = stack.env.optional('instance_type', "m1.small"),
+    iscm = ISCM(
+        context = { "_iscm": { "cfninit_key": stack_user.CloudFormationStackUserKey } },
+        processors = [
+            CloudInitISCM(stack_user.CloudFormationStackUserKey)
+            if stack.env.optional('iscm_backend') == "cloudinit" else
+            CfnInitISCM(stack_user.CloudFormationStackUserKey,
+                        metadata_url = stack.env.optional('metadata_url'),
+                        api_backoff = stack.env.optional('api_backoff', 2))
+        ],
+        modules = [
+            CfnInit(configs=[{
+                "files": {
+                    "/root/queue.json": {
+                        "content" : { "Queue1": SQSQueue1['QueueName'] },
+                        "mode": "000644", "owner": "root", "group": "root"
+                    }
+                }
+            }]),
+            Shell(
+                shell_vars = { 'QUEUE_NAME': SQSQueue1['QueueName'] },
+                scripts = [ Shell.runScript("scripts/dump-vars.sh") ]
+            ),
+            Shell(
+                shell_vars = { 'APP_ENV': "production" },
+                scripts = [ Shell.runScript("scripts/dump-vars.sh") ]
+            )
+        ]
+    )
+)
@@ -0,0 +1,41 @@
+'''
+Test/sample cloudcast template, with modules that are applied concurrently
+
+@author: David Losada Carballo <david@tuxpiper.com>
+'''
+
+from cloudcast.template import *
+from cloudcast.library import stack_user
+from _context import stack
+
+from cloudcast.iscm import ISCM
+from cloudcast.iscm.cfninit import CfnInit, CfnInitISCM, Concurrently
+from cloudcast.iscm.cloudinit import CloudInitISCM
+
+def Step(name, sleep="0", exit_code="0"):
+    # Records when it starts and ends
+    return CfnInit(commands={
+        "step-" + name: {
+            "command": 'echo "start %s $(date +%%s.%%N)" >> /root/branches.log ; sleep %s ; ' % (name, sleep) +
+                       'echo "end %s $(date +%%s.%%N)" >> /root/branches.log ; exit %s' % (name, exit_code)
+        }
+    })
+
+AnInstance = EC2Instance(
+    ImageId = "ami-0b9c9f62",
+    InstanceType = "m1.small",
+    iscm = ISCM(
+        processors = [
+            CloudInitISCM(stack_user.CloudFormationStackUserKey, api_backoff = 0)
+            if stack.env.optional('iscm_backend') == "cloudinit" else
+            CfnInitISCM(stack_user.CloudFormationStackUserKey, api_backoff = 0)
+        ],
+        modules = [
+            Concurrently(
+                Step("a", sleep="2", exit_code=stack.env.optional('exit_code_a', "0")),
+                [ Step("b1", sleep=stack.env.optional('sleep_b', "2")), Step("b2") ]
+            ),
+            Step("c")
+        ]
+    )
+)
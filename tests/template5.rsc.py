@@ -0,0 +1,45 @@
+'''
+Test/sample cloudcast template, with launchables whose phases share a
+common prefix
+
+@author: David Losada Carballo <david@tuxpiper.com>
+'''
+
+from cloudcast.template import *
+from cloudcast.library import stack_user
+from _context import stack
+
+from cloudcast.iscm.cfninit import CfnInit
+from cloudcast.iscm.phased import PhasedISCM, RunAlways, RunOnce, RunOnDeploy
+
+def Step(name):
+    return CfnInit(commands={ "step-" + name: { "command": "echo %s" % name } })
+
+class Fact(object):
+    # Records a fact in the metadata
+    def __init__(self, name):
+        self.name = name
+    def install(self, iscm):
+        pass
+    def deploy(self, iscm):
+        iscm.iscm_md_update_dict("_facts", { self.name: "yes" })
+
+def Phases(image_id, *names):
+    # A configuration phase, then a RunOnce phase for each name, then boot
+    phases = [ RunAlways("Config", [ Step("config"), Fact("config") ]) ]
+    phases += [ RunOnce(name, [ Step(name), Fact(name) ]) for name in names ]
+    phases.append(RunOnDeploy("Boot", [ Step("boot") ]))
+    return dict(
+        ImageId = image_id,
+        InstanceType = "m1.small",
+        iscm = PhasedISCM(
+            context = { "_iscm": { "cfninit_key": stack_user.CloudFormationStackUserKey } },
+            phases = phases
+        )
+    )
+
+WebA = EC2Instance(**Phases("ami-0b9c9f62", "Base", "Web", "AppA"))
+WebALaunchConfig = EC2LaunchConfiguration(**Phases("ami-0b9c9f62", "Base", "Web", "AppA"))
+WebB = EC2Instance(**Phases("ami-0b9c9f62", "Base", "Web", "AppB"))
+Worker = EC2Instance(**Phases("ami-0b9c9f62", "Base", "Worker"))
+OtherBase = EC2Instance(**Phases("ami-11111111", "Base", "Worker"))
@@ -0,0 +1,42 @@
+'''
+Test/sample cloudcast template, with one ISCM prototype stamped onto
+several launchables
+
+@author: David Losada Carballo <david@tuxpiper.com>
+'''
+
+from cloudcast.template import *
+from cloudcast.library import stack_user
+from _context import stack
+
+from cloudcast.iscm import ISCMPrototype
+from cloudcast.iscm.ansible import AnsibleISCM
+
+WebISCM = ISCMPrototype(AnsibleISCM(
+    config = dict(
+        inst_home = "/home/ubuntu",
+        inst_user = "ubuntu",
+        inst_group = "ubuntu",
+        inst_playbook_dir = "playbooks"
+    ),
+    facts = dict(environment = "production"),
+    playbooks_source = "ansible",
+    stack_user_key = stack_user.CloudFormationStackUserKey,
+    runs = dict(
+        build = dict(playbook = "playbook.yaml", sudo = True, tags = [ "build" ]),
+        boot = dict(playbook = "playbook.yaml", sudo = True, tags = [ "boot" ])
+    )
+))
+
+Web1Handle = WaitConditionHandle()
+Web2Handle = WaitConditionHandle()
+
+Web1 = EC2Instance(ImageId = "ami-0b9c9f62", InstanceType = "m1.small", iscm = WebISCM)
+Web1.iscm.iscm_wc_signal_on_end(Web1Handle)
+Web2 = EC2Instance(ImageId = "ami-0b9c9f62", InstanceType = "m1.small", iscm = WebISCM)
+Web2.iscm.iscm_wc_signal_on_end(Web2Handle)
+Fleet1 = EC2LaunchConfiguration(ImageId = "ami-0b9c9f62", InstanceType = "m1.small", iscm = WebISCM)
+Fleet2 = EC2LaunchConfiguration(ImageId = "ami-0b9c9f62", InstanceType = "m1.small", iscm = WebISCM)
+
+if stack.env.get("other_base"):
+    OtherBase = EC2Instance(ImageId = "ami-11111111", InstanceType = "m1.small", iscm = WebISCM)
@@ -20,3 +20,12 @@ stack2 = Stack(
 )
 
 print stack2.dump_json()
+
+
+stack3 = Stack(
+	description = "Sample stack with several shell modules",
+	env = {},
+	resources_file = "template3.rsc.py"
+)
+
+print stack3.dump_json()
@@ -0,0 +1,78 @@
+'''
+Checks that the boot survives throttling of the metadata sources: failed
+calls are retried within the budget, a throttled metadata URL falls back to
+the CloudFormation API, and the instance signals its failure when the budget
+is exhausted.
+
+@author: David Losada Carballo <david@tuxpiper.com>
+'''
+
+import threading
+from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+from boot_sandbox import BootSandbox, render
+
+class ThrottlingHandler(BaseHTTPRequestHandler):
+    """
+    Serves the metadata snapshot, after answering the first `throttles`
+    requests with a throttling error
+    """
+    throttles = 0
+    requests = 0
+    metadata_file = None
+
+    def do_GET(self):
+        ThrottlingHandler.requests += 1
+        if ThrottlingHandler.requests <= ThrottlingHandler.throttles:
+            self.send_response(400)
+            self.end_headers()
+            self.wfile.write("<Code>Throttling</Code>")
+            return
+        self.send_response(200)
+        self.end_headers()
+        with open(ThrottlingHandler.metadata_file) as f:
+            self.wfile.write(f.read())
+
+    def log_message(self, *args):
+        pass
+
+server = HTTPServer(("127.0.0.1", 0), ThrottlingHandler)
+thread = threading.Thread(target=server.serve_forever)
+thread.daemon = True
+thread.start()
+metadata_url = "http://127.0.0.1:%d/metadata.json" % server.server_port
+
+def boot(throttles, api_throttles=0):
+    ThrottlingHandler.throttles = throttles
+    ThrottlingHandler.requests = 0
+    sandbox = BootSandbox()
+    ThrottlingHandler.metadata_file = sandbox.path + "/metadata.json"
+    resource = render("template3.rsc.py", env={ "metadata_url": metadata_url, "api_backoff": 0 })
+    (code, output) = sandbox.boot(resource, env={ "SANDBOX_API_THROTTLES": str(api_throttles),
+                                                  "ISCM_WCHANDLE_URL": "https://wait-handle" })
+    return (sandbox, code, output)
+
+# The metadata URL recovers within the retry budget
+(sandbox, code, output) = boot(throttles=3)
+assert code == 0, output
+assert ThrottlingHandler.requests == 4
+assert sandbox.count_calls("cfn-get-metadata") == 0
+assert sandbox.count_calls("cfn-signal") == 1
+
+# The metadata URL is always throttled, the API is used instead
+(sandbox, code, output) = boot(throttles=100, api_throttles=2)
+assert code == 0, output
+assert ThrottlingHandler.requests == 5
+assert sandbox.count_calls("cfn-get-metadata") == 3
+assert sandbox.count_calls("cfn-signal") == 1
+
+# Everything is throttled beyond the budget (the boot output is piped
+# through tee, so the exit code doesn't tell)
+(sandbox, code, output) = boot(throttles=100, api_throttles=100)
+assert "Unable to fetch the instance metadata" in output
+assert sandbox.count_calls("cfn-get-metadata") == 5
+assert sandbox.count_calls("cfn-signal") == 1
+with open(sandbox.path + "/cfn-signal.calls") as f:
+    assert f.read().startswith("-e 1 ")
+
+server.shutdown()
+print "OK"
@@ -0,0 +1,90 @@
+'''
+Checks the timing records of the boot steps: the wrapper of cfn-init
+commands, and the parsers and latency report of collected logs.
+
+@author: David Losada Carballo <david@tuxpiper.com>
+'''
+
+import json, os, shutil, tempfile, subprocess
+from cloudcast.iscm.timing import timed_command, parse_timing_log, parse_signal_data, \
+    latency_report, format_latency_report, TIMING_LOG
+
+folder = tempfile.mkdtemp(prefix="cloudcast-timing-")
+try:
+    timing_log = os.path.join(folder, "timing.jsonl")
+    output_log = os.path.join(folder, "output.log")
+    def run(step, command, **kwargs):
+        # cfn-init runs the commands with /bin/sh
+        wrapped = timed_command(step, command, **kwargs).replace(TIMING_LOG, timing_log)
+        return subprocess.call([ "/bin/sh", "-c", wrapped ], stdout=open(os.devnull, "w"))
+
+    assert run("ok", "true") == 0
+    assert run("fails", "exit 3") == 3
+    # The status is the command's, not the one of the tee writing the log
+    assert run("logged", "echo out; echo err >&2; exit 4", log=output_log) == 4
+    assert run("logged-ok", "echo again", log=output_log) == 0
+    assert open(output_log).read().split() == [ "out", "err", "again" ]
+    records = parse_timing_log(timing_log)
+    assert [ (r["step"], r["rc"]) for r in records ] == [ ("ok", 0), ("fails", 3), ("logged", 4), ("logged-ok", 0) ]
+    assert all([ r["start"] <= r["end"] for r in records ])
+    # Commands that are CloudFormation expressions
+    assert timed_command("expr", { "Ref": "X" })["Fn::Join"][1][1] == { "Ref": "X" }
+
+    # Blank lines are skipped
+    with open(timing_log, "w") as f:
+        f.write('{"step": "a", "start": 1.0, "end": 3.0, "rc": 0}\n\n{"step": "b", "start": 2, "end": 2.5, "rc": 1}\n')
+    assert [ r["step"] for r in parse_timing_log(timing_log) ] == [ "a", "b" ]
+finally:
+    shutil.rmtree(folder)
+
+# Signal data: step=duration entries, anything else is ignored
+records = parse_signal_data("boot=12.5 cfninit:Web=3.0 garbage shell:x=y cfninit:a=b=1")
+assert records == [ dict(step="boot", start=0.0, end=12.5), dict(step="cfninit:Web", start=0.0, end=3.0),
+                    dict(step="cfninit:a=b", start=0.0, end=1.0) ], records
+
+fleet = [
+    [ dict(step="boot", start=0, end=10), dict(step="shell:x", start=1, end=2, rc=0) ],
+    [ dict(step="boot", start=0, end=20), dict(step="shell:x", start=1, end=5, rc=1) ],
+    [ dict(step="boot", start=0, end=30) ],
+]
+report = latency_report(fleet)
+assert report["boot"] == dict(count=3, failures=0, min=10, mean=20, p50=20, p90=30, max=30), report["boot"]
+assert report["shell:x"]["count"] == 2 and report["shell:x"]["failures"] == 1 and report["shell:x"]["max"] == 4
+text = format_latency_report(report).splitlines()
+assert text[0].split() == [ "step", "count", "fail", "min", "mean", "p50", "p90", "max" ]
+# Slowest first
+assert [ l.split()[0] for l in text[1:] ] == [ "boot", "shell:x" ]
+assert text[1].split()[1:3] == [ "3", "0" ]
+assert latency_report([]) == {}
+
+# Phases are run by a single cfn-init call, timed as a whole, unless each
+# one of them is to be timed on its own
+from boot_sandbox import BootSandbox
+from cloudcast import Stack
+from cloudcast.template import EC2Instance, Resource
+from cloudcast.iscm.cfninit import CfnInit
+from cloudcast.iscm.phased import PhasedISCM, RunOnce
+
+def boot_phases(**kwargs):
+    stack = Stack(description="timing", env={})
+    key = Resource("AWS::IAM::AccessKey", UserName="someone")
+    stack.add_element(key, "Key")
+    iscm = PhasedISCM(
+        context = { "_iscm": { "cfninit_key": key } },
+        phases = [ RunOnce("Base", [ CfnInit(commands={ "noop": { "command": "true" } }) ]),
+                   RunOnce("App", [ CfnInit(commands={ "noop": { "command": "true" } }) ]) ],
+        **kwargs
+    )
+    iscm.set_phases_to_run(iscm.phases)
+    stack.add_element(EC2Instance(ImageId="ami-0b9c9f62", InstanceType="m1.small", iscm=iscm), "Phased")
+    sandbox = BootSandbox()
+    (code, output) = sandbox.boot(json.loads(stack.dump_json(pretty=False))["Resources"]["Phased"])
+    assert code == 0, output
+    calls = open(os.path.join(sandbox.path, "cfn-init.calls")).read().split()
+    steps = [ r["step"] for r in parse_timing_log(sandbox.relocate(TIMING_LOG)) if r["step"].startswith("cfninit:") ]
+    return (calls, steps)
+
+assert boot_phases() == ([ "Base,App" ], [ "cfninit:Base,App" ])
+assert boot_phases(time_configsets=True) == ([ "Base", "App" ], [ "cfninit:Base", "cfninit:App" ])
+
+print "OK"
@@ -0,0 +1,71 @@
+'''
+Checks the spans recorded while loading and rendering a stack, and their
+export in the Chrome trace format.
+
+@author: David Losada Carballo <david@tuxpiper.com>
+'''
+
+import os, json, tempfile
+from cloudcast import Stack, tracing
+
+# Nothing is recorded without an active tracer
+assert tracing.active() is None
+assert tracing.span("anything") is tracing.span("something else")
+
+path = tempfile.mktemp(suffix=".trace.json")
+try:
+    with tracing.traced(path) as tracer:
+        stack = Stack(description="traced", resources_file="template5.rsc.py")
+        stack.dump_json()
+        stack.get_element("WebA").iscm.get_possible_builds()
+    assert tracing.active() is None
+    with open(path, "r") as f:
+        trace = json.load(f)
+finally:
+    if os.path.exists(path):
+        os.remove(path)
+
+events = [ e for e in trace["traceEvents"] if e["ph"] == "X" ]
+assert len(events) == len(tracer.events)
+names = [ e["name"] for e in events ]
+for name in [ "load_resources", "run_resources_file", "find_stack_elements", "name_stack_elements",
+              "dump_to_template_obj", "encode", "contents EC2Instance('WebA')",
+              "iscm_apply EC2Instance('WebA')", "iscm_deploy PhasedISCM",
+              "install CfnInitISCM", "deploy RunOnce('Base')", "deploy CfnInit",
+              "get_possible_builds" ]:
+    assert name in names, name
+
+def find(name):
+    return [ e for e in events if e["name"] == name ]
+
+def within(inner, outer):
+    return outer["ts"] <= inner["ts"] and inner["ts"] + inner["dur"] <= outer["ts"] + outer["dur"] + 1
+
+# Spans nest as the stages do
+load = find("load_resources")[0]
+assert within(find("run_resources_file")[0], load)
+assert within(find("find_stack_elements")[0], load)
+dump = find("dump_to_template_obj")[0]
+assert within(find("contents EC2Instance('WebA')")[0], dump)
+assert within(find("iscm_apply EC2Instance('WebA')")[0], find("contents EC2Instance('WebA')")[0])
+assert len(find("iscm_deploy PhasedISCM")) == 5
+for e in find("deploy RunOnce('Base')"):
+    assert any([ within(e, d) for d in find("iscm_deploy PhasedISCM") ])
+assert find("encode")[0]["ts"] >= dump["ts"] + dump["dur"]
+# Parents come before their children
+assert names.index("load_resources") < names.index("run_resources_file")
+
+totals = tracer.totals()
+assert totals[0][0] == "load_resources" or totals[0][0] == "dump_to_template_obj", totals[0]
+assert dict([ (n, c) for (n, c, t) in totals ])["iscm_deploy PhasedISCM"] == 5
+
+# Errors are recorded in the span that raised them
+with tracing.traced() as tracer:
+    try:
+        with tracing.span("failing", reason="test"):
+            raise ValueError("broken")
+    except ValueError:
+        pass
+assert tracer.events[0]["args"] == { "reason": "test", "error": "ValueError: broken" }
+
+print "OK"